@@ -3,9 +3,12 @@ import base64
 import time
 import json
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import re
 import logging
 import threading
+import queue
 import sqlite3
 import csv
 import random
@@ -14,8 +17,9 @@ import hashlib
 import uuid
 from datetime import datetime, timedelta
 from typing import Dict, List, Optional, Tuple, Any, Union, Callable
-from dataclasses import dataclass, field
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from dataclasses import dataclass, field, replace
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, Future, as_completed
 from dotenv import load_dotenv
 from selenium import webdriver
 from selenium.webdriver.chrome.service import Service as ChromeService
@@ -106,55 +110,595 @@ logger.addHandler(error_handler)
 AI_CONFIGS = {
     "mistral": {
         "api_key": os.getenv("MISTRAL_API_KEY", ""),
-        "endpoint": "https://api.mistral.ai/v1/chat/completions",
-        "model": "mistral-large-latest"
+        "api": "openai",
+        "endpoint": os.getenv("MISTRAL_ENDPOINT", "https://api.mistral.ai/v1/chat/completions"),
+        "model": "mistral-large-latest",
+        "pricing": {"input": 2.0, "output": 6.0},  # USD per million tokens
+        "max_image_edge": 1280
     },
     "typegpt": {
         "api_key": os.getenv("TYPEGPT_API_KEY", ""),
-        "endpoint": "https://api.example.com/v1/chat/completions",
-        "model": "model-name"
+        "api": "openai",
+        "endpoint": os.getenv("TYPEGPT_ENDPOINT", "https://api.example.com/v1/chat/completions"),
+        "model": "model-name",
+        "pricing": {"input": 0.0, "output": 0.0},  # USD per million tokens
+        "max_image_edge": 1280
     },
     "openai": {
         "api_key": os.getenv("OPENAI_API_KEY", ""),
-        "endpoint": "https://api.openai.com/v1/chat/completions",
-        "model": "gpt-4-turbo-preview"
+        "api": "openai",
+        "endpoint": os.getenv("OPENAI_ENDPOINT", "https://api.openai.com/v1/chat/completions"),
+        "stream_usage": True,
+        "model": "gpt-4-turbo-preview",
+        "pricing": {"input": 10.0, "output": 30.0},  # USD per million tokens
+        "max_image_edge": 1536
     },
     "anthropic": {
         "api_key": os.getenv("ANTHROPIC_API_KEY", ""),
-        "endpoint": "https://api.anthropic.com/v1/messages",
-        "model": "claude-3-opus-20240229"
+        "api": "anthropic",
+        "endpoint": os.getenv("ANTHROPIC_ENDPOINT", "https://api.anthropic.com/v1/messages"),
+        "model": "claude-3-opus-20240229",
+        "pricing": {"input": 15.0, "output": 75.0},  # USD per million tokens
+        "max_image_edge": 1568
     },
     "gemini": {
         "api_key": os.getenv("GEMINI_API_KEY", ""),
-        "endpoint": "https://generativelanguage.googleapis.com/v1beta/models/gemini-pro:generateContent",
-        "model": "gemini-pro"
+        "api": "gemini",
+        "endpoint": os.getenv("GEMINI_ENDPOINT", "https://generativelanguage.googleapis.com/v1beta/models/gemini-pro:generateContent"),
+        "model": "gemini-pro",
+        "pricing": {"input": 0.5, "output": 1.5},  # USD per million tokens
+        "max_image_edge": 1536
     }
 }
 
 # Default AI provider
-DEFAULT_AI_PROVIDER = "mistral"
+DEFAULT_AI_PROVIDER = os.getenv("AI_PROVIDER", "mistral").lower()
 API_KEY = AI_CONFIGS[DEFAULT_AI_PROVIDER]["api_key"]
 API_ENDPOINT_URL = AI_CONFIGS[DEFAULT_AI_PROVIDER]["endpoint"]
 MODEL_NAME = AI_CONFIGS[DEFAULT_AI_PROVIDER]["model"]
 
+# Element scanner backend: "js" (MutationObserver-driven in-page index) or "cdp" (DOMSnapshot)
+ELEMENT_SCAN_BACKEND = os.getenv("ELEMENT_SCAN_BACKEND", "js").lower()
+ELEMENT_SCAN_LIMIT = int(os.getenv("ELEMENT_SCAN_LIMIT", "200"))
+# Approximate token budget for the element list sent with each decision
+PROMPT_ELEMENT_TOKEN_BUDGET = int(os.getenv("PROMPT_ELEMENT_TOKEN_BUDGET", "400"))
+# Approximate token budget for the whole per-step prompt suffix, and the share the last action feedback may use
+PROMPT_TOKEN_BUDGET = int(os.getenv("PROMPT_TOKEN_BUDGET", "550"))
+PROMPT_FEEDBACK_TOKENS = int(os.getenv("PROMPT_FEEDBACK_TOKENS", "60"))
+# Decision input: "auto" (text view, screenshot only when needed), "vision" (always screenshot) or "text"
+DECISION_MODE = os.getenv("DECISION_MODE", "auto").lower()
+# Approximate token budget for visible page text in text-only decisions
+PROMPT_TEXT_VIEW_TOKENS = int(os.getenv("PROMPT_TEXT_VIEW_TOKENS", "350"))
+# Multi-action plans: actions run per model call (1 = single actions) and seconds to wait for each post-condition
+PLAN_MAX_STEPS = int(os.getenv("PLAN_MAX_STEPS", "4"))
+PLAN_STEP_TIMEOUT = float(os.getenv("PLAN_STEP_TIMEOUT", "3.0"))
+# Screenshot annotation backend: "pil" or "opencv"
+ANNOTATION_BACKEND = os.getenv("ANNOTATION_BACKEND", "pil").lower()
+
+# Screenshot encoding for the LLM payload; the long edge defaults to the provider's input resolution
+SCREENSHOT_FORMAT = os.getenv("SCREENSHOT_FORMAT", "webp").lower()
+SCREENSHOT_QUALITY = int(os.getenv("SCREENSHOT_QUALITY", "85"))
+SCREENSHOT_MAX_EDGE = int(os.getenv("SCREENSHOT_MAX_EDGE", str(AI_CONFIGS[DEFAULT_AI_PROVIDER].get("max_image_edge", 0))))
+
+# Screenshot archive: WebP quality, report thumbnail width and near-duplicate dHash distance (bits, -1 = off)
+SCREENSHOT_ARCHIVE_QUALITY = int(os.getenv("SCREENSHOT_ARCHIVE_QUALITY", "80"))
+SCREENSHOT_THUMBNAIL_WIDTH = int(os.getenv("SCREENSHOT_THUMBNAIL_WIDTH", "320"))
+SCREENSHOT_DEDUP_DISTANCE = int(os.getenv("SCREENSHOT_DEDUP_DISTANCE", "-1"))
+
+# Pending screenshot/database writes before the agent waits for the background writer
+ARTIFACT_QUEUE_SIZE = int(os.getenv("ARTIFACT_QUEUE_SIZE", "16"))
+
+# Overlap screenshot capture/annotation and overlay updates with the main step on worker threads
+PIPELINE_ENABLED = os.getenv("PIPELINE_ENABLED", "true").lower() == "true"
+
+# Post-action settling: ceiling (s), required quiet time (s) and changed-pixel fraction still counted as stable
+SETTLE_MAX_WAIT = float(os.getenv("SETTLE_MAX_WAIT", "3.0"))
+SETTLE_QUIET_PERIOD = float(os.getenv("SETTLE_QUIET_PERIOD", "0.25"))
+SETTLE_CHANGE_RATIO = float(os.getenv("SETTLE_CHANGE_RATIO", "0.002"))
+
+# Optional Page.startScreencast frame buffer: timeline length, spacing (s) and JPEG quality
+SCREENCAST_ENABLED = os.getenv("SCREENCAST_ENABLED", "false").lower() == "true"
+SCREENCAST_BUFFER_SIZE = int(os.getenv("SCREENCAST_BUFFER_SIZE", "240"))
+SCREENCAST_MIN_INTERVAL = float(os.getenv("SCREENCAST_MIN_INTERVAL", "0.25"))
+SCREENCAST_QUALITY = int(os.getenv("SCREENCAST_QUALITY", "70"))
+
+# Pooled LLM HTTP client: keep-alive connections per host, connect timeout and streaming read timeout (s)
+LLM_POOL_SIZE = int(os.getenv("LLM_POOL_SIZE", "8"))
+LLM_CONNECT_TIMEOUT = float(os.getenv("LLM_CONNECT_TIMEOUT", "5"))
+LLM_READ_TIMEOUT = float(os.getenv("LLM_READ_TIMEOUT", "90"))
+
+# Providers the LLM router may use, in preference order, and seconds without a first token before a
+# second provider is started ("auto" = the primary's p95 time-to-first-token, 0 = never hedge)
+LLM_PROVIDERS = [name.strip().lower() for name in os.getenv("LLM_PROVIDERS", DEFAULT_AI_PROVIDER).split(",") if name.strip()]
+LLM_HEDGE_DEADLINE = (None if os.getenv("LLM_HEDGE_DEADLINE", "auto").lower() == "auto"
+                      else float(os.getenv("LLM_HEDGE_DEADLINE")))
+
+# Persistent decision cache: on/off, entry lifetime (s), max entries (LRU) and confidence needed to store a decision
+DECISION_CACHE_ENABLED = os.getenv("DECISION_CACHE_ENABLED", "true").lower() == "true"
+DECISION_CACHE_TTL = int(os.getenv("DECISION_CACHE_TTL", str(7 * 24 * 3600)))
+DECISION_CACHE_MAX_ENTRIES = int(os.getenv("DECISION_CACHE_MAX_ENTRIES", "5000"))
+DECISION_CACHE_MIN_CONFIDENCE = float(os.getenv("DECISION_CACHE_MIN_CONFIDENCE", "0.8"))
+
 if not API_KEY or not API_ENDPOINT_URL:
     logger.warning("Primary AI API key or base URL not found. Some AI features may be limited.")
 
-@dataclass
 class ElementInfo:
-    """Advanced element information structure."""
-    id: int
-    element: Any
-    tag_name: str
-    label: str
-    element_type: str
-    is_visible: bool
-    is_clickable: bool
-    is_form_field: bool
-    coordinates: Tuple[int, int, int, int]  # x, y, width, height
-    attributes: Dict[str, str]
-    text_content: str
-    confidence_score: float
+    """Advanced element information structure - a lightweight row view into an ElementTable."""
+    __slots__ = ('_table', '_row')
+
+    def __init__(self, table: 'ElementTable', row: int):
+        self._table = table
+        self._row = row
+
+    @property
+    def id(self) -> int:
+        """data-element-id assigned by the in-page index (stable across steps)."""
+        return int(self._table.ids[self._row])
+
+    @property
+    def fingerprint(self) -> int:
+        """53-bit hash of tag, normalized label, key attributes and DOM path."""
+        return int(self._table.fingerprints[self._row])
+
+    @property
+    def tag_name(self) -> str:
+        return self._table.tag_names[self._row]
+
+    @property
+    def label(self) -> str:
+        return self._table.labels[self._row]
+
+    @property
+    def element_type(self) -> str:
+        return self._table.element_types[self._row]
+
+    @property
+    def is_visible(self) -> bool:
+        return bool(self._table.visible[self._row])
+
+    @property
+    def is_clickable(self) -> bool:
+        return bool(self._table.clickable[self._row])
+
+    @property
+    def is_form_field(self) -> bool:
+        return bool(self._table.form_field[self._row])
+
+    @property
+    def coordinates(self) -> Tuple[int, int, int, int]:
+        """x, y, width, height"""
+        x, y, w, h = self._table.coordinates[self._row]
+        return int(x), int(y), int(w), int(h)
+
+    @property
+    def attributes(self) -> Dict[str, str]:
+        attributes = dict(zip(ElementTable.ATTRIBUTE_NAMES, self._table.attributes[self._row]))
+        attributes['frameSource'] = 'iframe' if self.frame_path else 'main'
+        return attributes
+
+    @property
+    def text_content(self) -> str:
+        return self._table.text_content[self._row]
+
+    @property
+    def confidence_score(self) -> float:
+        return float(self._table.confidence[self._row])
+
+    @property
+    def frame_path(self) -> str:
+        """iframe index path, '' for the main document."""
+        return self._table.frame_paths[self._row]
+
+    @property
+    def element(self) -> Any:
+        """WebElement, resolved lazily when an action targets this element."""
+        return self._table.handles.get(self.fingerprint)
+
+    @element.setter
+    def element(self, value: Any):
+        self._table.handles[self.fingerprint] = value
+
+    def __repr__(self) -> str:
+        return f"ElementInfo(id={self.id}, tag_name={self.tag_name!r}, label={self.label[:30]!r})"
+
+class ElementTable:
+    """Columnar element store backed by NumPy arrays.
+
+    Filtering, sorting and top-k selection are vectorized over the columns;
+    iterating or indexing with an int yields ElementInfo row views. Lookups by
+    id or fingerprint go through lazily built dict indexes.
+    """
+
+    ATTRIBUTE_NAMES = ('id', 'class', 'name', 'type', 'role')
+    NUMERIC_COLUMNS = ('ids', 'fingerprints', 'coordinates', 'confidence', 'visible', 'clickable', 'form_field')
+    OBJECT_COLUMNS = ('tag_names', 'labels', 'element_types', 'attributes', 'text_content', 'frame_paths')
+
+    def __init__(self, ids, coordinates, confidence, visible, clickable, form_field,
+                 tag_names, labels, element_types, attributes, text_content, frame_paths,
+                 fingerprints=None, handles: Dict[int, Any] = None):
+        self.ids = np.asarray(ids, dtype=np.int32)
+        self.fingerprints = (np.zeros(len(self.ids), dtype=np.int64) if fingerprints is None
+                             else np.asarray(fingerprints, dtype=np.int64))
+        self.coordinates = np.asarray(coordinates, dtype=np.float32).reshape(-1, 4)
+        self.confidence = np.asarray(confidence, dtype=np.float32)
+        self.visible = np.asarray(visible, dtype=bool)
+        self.clickable = np.asarray(clickable, dtype=bool)
+        self.form_field = np.asarray(form_field, dtype=bool)
+        self.tag_names = self._object_column(tag_names)
+        self.labels = self._object_column(labels)
+        self.element_types = self._object_column(element_types)
+        self.attributes = self._object_column(attributes, width=len(self.ATTRIBUTE_NAMES))
+        self.text_content = self._object_column(text_content)
+        self.frame_paths = self._object_column(frame_paths)
+        # WebElement handles, keyed by fingerprint and shared by every table derived from this one
+        self.handles = handles if handles is not None else {}
+        self._rows_by_id: Optional[Dict[int, int]] = None
+        self._rows_by_fingerprint: Optional[Dict[int, int]] = None
+
+    @staticmethod
+    def _object_column(values, width: int = None) -> np.ndarray:
+        if isinstance(values, np.ndarray) and values.dtype == object:
+            return values
+        values = list(values)
+        column = np.empty((len(values), width) if width else len(values), dtype=object)
+        for i, value in enumerate(values):
+            column[i] = value
+        return column
+
+    @classmethod
+    def empty(cls) -> 'ElementTable':
+        return cls([], [], [], [], [], [], [], [], [], [], [], [])
+
+    @classmethod
+    def from_columns(cls, columns: Dict[str, List]) -> 'ElementTable':
+        """Build a table straight from the scanner's columnar payload."""
+        flags = np.asarray(columns.get('flags', []), dtype=np.int32)
+        labels = columns.get('labels', [])
+        text = [t if t is not None else label for t, label in zip(columns.get('text', []), labels)]
+        return cls(
+            ids=columns.get('ids', []),
+            coordinates=columns.get('rects', []),
+            confidence=columns.get('confidence', []),
+            visible=(flags & 1) != 0,
+            clickable=(flags & 2) != 0,
+            form_field=(flags & 4) != 0,
+            tag_names=columns.get('tags', []),
+            labels=labels,
+            element_types=columns.get('types', []),
+            attributes=columns.get('attributes', []),
+            text_content=text,
+            frame_paths=columns.get('frames', []),
+            fingerprints=columns.get('fingerprints', [])
+        )
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def __iter__(self):
+        for row in range(len(self.ids)):
+            yield ElementInfo(self, row)
+
+    def __getitem__(self, key) -> Union[ElementInfo, 'ElementTable']:
+        if isinstance(key, (int, np.integer)):
+            row = int(key) + len(self.ids) if key < 0 else int(key)
+            if not 0 <= row < len(self.ids):
+                raise IndexError(f"element row {key} out of range")
+            return ElementInfo(self, row)
+        return self.take(key)
+
+    def take(self, rows) -> 'ElementTable':
+        """Return a new table holding the selected rows (index array, mask or slice)."""
+        if isinstance(rows, slice):
+            rows = np.arange(len(self.ids))[rows]
+        columns = {name: getattr(self, name)[rows] for name in self.NUMERIC_COLUMNS + self.OBJECT_COLUMNS}
+        return ElementTable(handles=self.handles, **columns)
+
+    def mask(self, visible: bool = None, clickable: bool = None, form_field: bool = None,
+             min_confidence: float = None) -> np.ndarray:
+        """Boolean row mask for the given flag and confidence constraints."""
+        selected = np.ones(len(self.ids), dtype=bool)
+        if visible is not None:
+            selected &= self.visible == visible
+        if clickable is not None:
+            selected &= self.clickable == clickable
+        if form_field is not None:
+            selected &= self.form_field == form_field
+        if min_confidence is not None:
+            selected &= self.confidence >= min_confidence
+        return selected
+
+    def where(self, **constraints) -> 'ElementTable':
+        """Filter rows by flags and confidence (see mask)."""
+        return self.take(self.mask(**constraints))
+
+    def sorted_by_priority(self) -> 'ElementTable':
+        """Visible elements first, then by descending confidence."""
+        order = np.lexsort((-self.confidence, ~self.visible))
+        return self.take(order)
+
+    def top_k(self, k: int, scores: np.ndarray = None) -> 'ElementTable':
+        """The k highest-scoring rows (confidence by default), best first."""
+        scores = self.confidence if scores is None else np.asarray(scores)
+        if k >= len(self.ids):
+            return self.take(np.argsort(-scores, kind='stable'))
+        candidates = np.argpartition(-scores, k)[:k]
+        return self.take(candidates[np.argsort(-scores[candidates], kind='stable')])
+
+    def scaled(self, factor: float) -> 'ElementTable':
+        """Copy with coordinates multiplied by factor, for drawing on a resized screenshot."""
+        table = self.take(slice(None))
+        table.coordinates = table.coordinates * np.float32(factor)
+        return table
+
+    def find(self, element_id: int) -> Optional[ElementInfo]:
+        """Row view for the element with the given id, if present."""
+        if self._rows_by_id is None:
+            self._rows_by_id = {int(element_id): row for row, element_id in enumerate(self.ids.tolist())}
+        row = self._rows_by_id.get(int(element_id))
+        return ElementInfo(self, row) if row is not None else None
+
+    def find_by_fingerprint(self, fingerprint: int) -> Optional[ElementInfo]:
+        """Row view for the element with the given fingerprint, if present."""
+        if self._rows_by_fingerprint is None:
+            self._rows_by_fingerprint = {fp: row for row, fp in enumerate(self.fingerprints.tolist())}
+        row = self._rows_by_fingerprint.get(int(fingerprint))
+        return ElementInfo(self, row) if row is not None else None
+
+    def concat(self, other: 'ElementTable') -> 'ElementTable':
+        columns = {
+            name: np.concatenate([getattr(self, name), getattr(other, name)])
+            for name in self.NUMERIC_COLUMNS + self.OBJECT_COLUMNS
+        }
+        self.handles.update(other.handles)
+        return ElementTable(handles=self.handles, **columns)
+
+    def apply_delta(self, removed_ids, upserts: 'ElementTable') -> 'ElementTable':
+        """Drop removed and re-emitted rows, then append the upserted ones.
+
+        A re-emitted row keeps its cached handle as long as its fingerprint is
+        unchanged; handles of removed or re-fingerprinted elements are dropped.
+        """
+        stale = set(removed_ids) | set(upserts.ids.tolist())
+        stale_rows = np.isin(self.ids, np.asarray(list(stale), dtype=np.int32))
+        live = set(upserts.fingerprints.tolist())
+        for fingerprint in self.fingerprints[stale_rows].tolist():
+            if fingerprint not in live:
+                self.handles.pop(fingerprint, None)
+        return self.take(~stale_rows).concat(upserts)
+
+class ElementRelevanceRanker:
+    """Local relevance ranking of elements against the objective.
+
+    Element labels and key attributes are embedded as hashed character n-gram
+    TF-IDF vectors in NumPy and compared with the objective (plus, at a lower
+    weight, the last action feedback) by cosine similarity. The prompt gets a
+    token-budgeted top-k instead of a fixed number of rows.
+    """
+
+    def __init__(self, ngram: int = 3, dimensions: int = 1 << 18, feedback_weight: float = 0.5,
+                 prior_weight: float = 0.2, offscreen_threshold: float = 0.2):
+        self.ngram = ngram
+        self.dimensions = dimensions
+        self.feedback_weight = feedback_weight
+        self.prior_weight = prior_weight
+        self.offscreen_threshold = offscreen_threshold
+
+    @staticmethod
+    def describe(element: ElementInfo) -> str:
+        """Prompt line for one element: ID TAG KIND "LABEL" CONFIDENCE (see PromptBudgetManager)."""
+        kind = "form" if element.is_form_field else "click" if element.is_clickable else "view"
+        if not element.is_visible:
+            kind += " off-screen"
+        label = re.sub(r'\s+', ' ', element.label[:40]).strip()
+        return f"{element.id} {element.tag_name} {kind} \"{label}\" {element.confidence_score:.1f}"
+
+    @staticmethod
+    def estimate_tokens(text: str) -> int:
+        """Rough token count (~4 bytes per token)."""
+        return max(1, len(text.encode('utf-8')) // 4)
+
+    def _hashed_ngrams(self, texts: List[str]) -> Tuple[np.ndarray, np.ndarray]:
+        """(text index, bucket) for every character n-gram of every text."""
+        padded = [' ' + re.sub(r'[\W_]+', ' ', text.lower()).strip() + ' ' for text in texts]
+        codes = np.frombuffer('\0'.join(padded).encode('utf-32-le'), dtype=np.uint32).astype(np.uint64)
+        windows = len(codes) - self.ngram + 1
+        if windows <= 0:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+
+        hashes = np.zeros(windows, dtype=np.uint64)
+        for k in range(self.ngram):
+            hashes = hashes * np.uint64(1000003) + codes[k:k + windows]
+
+        # Drop windows that straddle the separator between two texts
+        separators = np.concatenate([[0], np.cumsum(codes == 0)])
+        valid = separators[self.ngram:self.ngram + windows] == separators[:windows]
+        owners = np.repeat(np.arange(len(texts)), [len(text) + 1 for text in padded])[:windows]
+        return owners[valid], (hashes[valid] % np.uint64(self.dimensions)).astype(np.int64)
+
+    def relevance(self, elements: ElementTable, objective: str, feedback: str = '') -> np.ndarray:
+        """Cosine similarity (0..1) of each element to the objective and feedback."""
+        count = len(elements)
+        if not count or not (objective or feedback):
+            return np.zeros(count, dtype=np.float32)
+
+        attributes = elements.attributes
+        documents = [
+            f"{label} {attributes[row, 0]} {attributes[row, 2]} {attributes[row, 3]} {attributes[row, 4]} {tag}"
+            for row, (label, tag) in enumerate(zip(elements.labels, elements.tag_names))
+        ]
+        owners, buckets = self._hashed_ngrams(documents + [objective or '', feedback or ''])
+
+        # Term frequencies per (document, bucket) pair
+        pairs, tf = np.unique(owners * self.dimensions + buckets, return_counts=True)
+        pair_docs, pair_buckets = pairs // self.dimensions, pairs % self.dimensions
+        is_element = pair_docs < count
+
+        df = np.bincount(pair_buckets[is_element], minlength=self.dimensions)
+        idf = np.log((1 + count) / (1 + df)) + 1.0
+        weights = (1.0 + np.log(tf)) * idf[pair_buckets]
+
+        query = np.zeros(self.dimensions, dtype=np.float64)
+        query_weights = np.where(pair_docs == count, 1.0, self.feedback_weight)[~is_element]
+        np.add.at(query, pair_buckets[~is_element], weights[~is_element] * query_weights)
+        query_norm = np.linalg.norm(query)
+        if not query_norm:
+            return np.zeros(count, dtype=np.float32)
+
+        element_docs = pair_docs[is_element]
+        element_weights = weights[is_element]
+        dots = np.bincount(element_docs, element_weights * query[pair_buckets[is_element]], minlength=count)
+        norms = np.sqrt(np.bincount(element_docs, element_weights ** 2, minlength=count))
+        return (dots / (np.maximum(norms, 1e-9) * query_norm)).astype(np.float32)
+
+    def select(self, elements: ElementTable, objective: str, feedback: str = '',
+               token_budget: int = None, max_elements: int = None) -> ElementTable:
+        """Rank elements and keep the best ones that fit the prompt token budget.
+
+        Visible elements (confidence >= 0.3) are always candidates; off-screen
+        ones only when they are clearly relevant, so the model can target them
+        without first scrolling.
+        """
+        token_budget = PROMPT_ELEMENT_TOKEN_BUDGET if token_budget is None else token_budget
+        relevance = self.relevance(elements, objective, feedback)
+        scores = relevance + self.prior_weight * elements.confidence
+        candidates = np.flatnonzero(elements.mask(visible=True, min_confidence=0.3) |
+                                    (relevance >= self.offscreen_threshold))
+        ranked = candidates[np.argsort(-scores[candidates], kind='stable')]
+
+        selected, used = [], 0
+        for row in ranked.tolist():
+            cost = self.estimate_tokens(self.describe(elements[row]))
+            if used + cost > token_budget or (max_elements and len(selected) >= max_elements):
+                break
+            selected.append(row)
+            used += cost
+        return elements.take(np.asarray(selected, dtype=np.int64))
+
+class PromptBudgetManager:
+    """Layout and token budget of the decision prompt.
+    
+    SYSTEM_PROMPT is byte-identical on every step so providers can cache it
+    as a prefix; only settings fixed at startup, like the plan length, are
+    filled in. Everything that changes per step (objective, URL, previous
+    result, ranked elements) goes into a compact user-message suffix whose
+    size is bounded by the budget: URL and feedback are clipped first, and
+    the remaining tokens cap the element list.
+    """
+    
+    SYSTEM_PROMPT = """You are a powerful AI web automation agent. Your goal is to achieve objectives through precise actions.
+
+**INPUT (user message):**
+- Objective, current URL and the result of the previous action
+- Elements ranked by relevance, one per line: ID TAG KIND "LABEL" CONFIDENCE
+  KIND is form (input field), click (clickable) or view (text); "off-screen" marks elements outside the viewport
+- Screenshot with the same elements NUMBERED in colored boxes, or instead a text view:
+  the visible page text and element rows with viewport coordinates @X,Y WIDTHxHEIGHT
+
+**AVAILABLE ACTIONS:**
+1. NAVIGATE - Go to URL: {"url": "https://example.com"}
+2. CLICK - Click element: {"id": 1}
+3. TYPE - Type text: {"id": 1, "text": "search query"}
+4. HOVER - Hover element: {"id": 1}
+5. SCROLL - Scroll page: {"direction": "down", "pixels": 500}
+6. WAIT - Wait time: {"seconds": 2}
+7. PRESS_KEY - Press key: {"key": "Enter"}
+8. CLEAR - Clear input: {"id": 1}
+9. SELECT - Select option: {"id": 1, "option": "value"}
+10. TAKE_SCREENSHOT - Screenshot: {}
+11. EXECUTE_JS - JavaScript: {"script": "code"}
+12. REFRESH - Reload page: {}
+13. GO_BACK - Browser back: {}
+14. ANSWER - Complete task: {"text": "Final answer"}
+15. REQUEST_SCREENSHOT - Ask for the screenshot when the text view is not enough: {}
+
+**RESPONSE FORMAT (Required JSON):**
+{
+    "action": {
+        "name": "ACTION_NAME",
+        "parameters": {
+            "id": 1,
+            "text": "if_needed"
+        },
+        "expect": {"value": "if_needed"}
+    },
+    "then": [
+        {"name": "PRESS_KEY", "parameters": {"key": "Enter"}, "expect": {"url_changes": true}}
+    ],
+    "confidence": 0.9,
+    "thought": "Short observation of the page state",
+    "reasoning": "Why this action will help achieve the objective"
+}
+
+**PLANS (optional):**
+- "then" lists up to PLAN_FOLLOW_UPS follow-up actions that run without asking you again; use [] when unsure
+- Only target element IDs listed now, and end the plan with the action that loads a new page
+- "expect" is checked after each action: url_changes (true), url_contains, text_appears, value (input value after TYPE)
+- When a check fails, you get control back with the reason
+
+**CRITICAL RULES:**
+- Use ONLY the numbered IDs from the elements list
+- Always provide confidence score (0.0-1.0)
+- Keep the key order above: "action" comes first and is executed as soon as it is complete,
+  while "thought" and "reasoning" are still streaming
+- Without a screenshot, use REQUEST_SCREENSHOT rather than guessing at visual layout
+- Be specific and goal-oriented
+- Handle errors gracefully
+""".replace("PLAN_FOLLOW_UPS", str(max(0, PLAN_MAX_STEPS - 1)))
+    
+    ELEMENTS_HEADER = "Elements:"
+    
+    def __init__(self, budget: int = None, feedback_tokens: int = None, url_tokens: int = 60,
+                 min_element_tokens: int = 100):
+        self.budget = PROMPT_TOKEN_BUDGET if budget is None else budget
+        self.feedback_tokens = PROMPT_FEEDBACK_TOKENS if feedback_tokens is None else feedback_tokens
+        self.url_tokens = url_tokens
+        self.min_element_tokens = min_element_tokens
+        self.system_tokens = ElementRelevanceRanker.estimate_tokens(self.SYSTEM_PROMPT)
+    
+    @staticmethod
+    def clip(text: str, max_tokens: int) -> str:
+        """Cut text to roughly max_tokens, marking the cut with an ellipsis."""
+        text = re.sub(r'\s+', ' ', text or '').strip()
+        max_bytes = max_tokens * 4
+        encoded = text.encode('utf-8')
+        if len(encoded) <= max_bytes:
+            return text
+        return encoded[:max_bytes - 3].decode('utf-8', errors='ignore').rstrip() + '...'
+    
+    def context(self, objective: str, url: str, feedback: str, page_text: Optional[str] = None) -> str:
+        """Header lines of the dynamic suffix; the objective is never clipped."""
+        page_text_block = f"Page text:\n{page_text}\n" if page_text else ""
+        return (f"Objective: {(objective or '').strip()}\n"
+                f"URL: {self.clip(url, self.url_tokens)}\n"
+                f"Previous result: {self.clip(feedback, self.feedback_tokens)}\n"
+                f"{page_text_block}{self.ELEMENTS_HEADER}\n")
+    
+    def element_budget(self, objective: str, url: str, feedback: str) -> int:
+        """Tokens left for element lines once the header is in."""
+        context_tokens = ElementRelevanceRanker.estimate_tokens(self.context(objective, url, feedback))
+        return min(PROMPT_ELEMENT_TOKEN_BUDGET, max(self.min_element_tokens, self.budget - context_tokens))
+    
+    def build(self, objective: str, url: str, feedback: str, elements: ElementTable,
+              page_text: Optional[str] = None) -> Tuple[str, int]:
+        """(dynamic suffix, number of elements listed), dropping the lowest-ranked lines over budget.
+        
+        With page_text (a text-only decision, possibly empty) the text view goes
+        before the elements, and element rows carry their viewport coordinates.
+        """
+        context = self.context(objective, url, feedback, page_text)
+        remaining = self.element_budget(objective, url, feedback)
+        lines = []
+        for element in elements:
+            line = ElementRelevanceRanker.describe(element)
+            if page_text is not None:
+                x, y, w, h = element.coordinates
+                line += f" @{x},{y} {w}x{h}"
+            cost = ElementRelevanceRanker.estimate_tokens(line)
+            if cost > remaining:
+                break
+            lines.append(line)
+            remaining -= cost
+        return context + "\n".join(lines), len(lines)
 
 @dataclass
 class ActionResult:
@@ -205,6 +749,750 @@ class PerformanceMetrics:
     javascript_errors: List[str]
     timestamp: datetime
 
+class LLMClient:
+    """Shared keep-alive HTTP client for LLM provider calls.
+    
+    One requests.Session with a sized connection pool is shared by every
+    agent and pool browser in the process, so TCP and TLS setup happen once
+    per provider host instead of on each step. Connect and read timeouts are
+    separate: the read timeout bounds the gap between streamed chunks.
+    """
+    
+    _shared: Optional['LLMClient'] = None
+    _shared_lock = threading.Lock()
+    
+    def __init__(self, pool_size: int = None, connect_timeout: float = None, read_timeout: float = None):
+        self.connect_timeout = LLM_CONNECT_TIMEOUT if connect_timeout is None else connect_timeout
+        self.read_timeout = LLM_READ_TIMEOUT if read_timeout is None else read_timeout
+        pool_size = pool_size or LLM_POOL_SIZE
+        # Only retry failed connects; a POST that reached the provider is never resent
+        retries = Retry(total=2, connect=2, read=0, status=0, other=0, allowed_methods=None)
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retries)
+        self.session = requests.Session()
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.session.headers.update({'Connection': 'keep-alive'})
+    
+    @classmethod
+    def shared(cls) -> 'LLMClient':
+        """Process-wide client instance."""
+        with cls._shared_lock:
+            if cls._shared is None:
+                cls._shared = cls()
+            return cls._shared
+    
+    def post(self, url: str, headers: Dict[str, str], payload: Dict, stream: bool = False,
+             read_timeout: float = None) -> requests.Response:
+        return self.session.post(url, headers=headers, json=payload, stream=stream,
+                                 timeout=(self.connect_timeout, read_timeout or self.read_timeout))
+    
+    def warm_up(self, url: str):
+        """Open a pooled connection to the provider host in the background."""
+        parsed = urlparse(url)
+        if not parsed.scheme or not parsed.netloc:
+            return
+        
+        def connect():
+            try:
+                self.session.head(f"{parsed.scheme}://{parsed.netloc}/", timeout=(self.connect_timeout, 10))
+            except Exception as e:
+                logger.debug(f"LLM connection warm-up failed: {e}")
+        
+        threading.Thread(target=connect, name="llm-warm-up", daemon=True).start()
+    
+    def close(self):
+        self.session.close()
+
+@dataclass
+class LLMRequest:
+    """Provider-neutral chat request: system prompt plus optional text and screenshot."""
+    system_prompt: str
+    user_text: str = ""
+    image_b64: Optional[str] = None
+    image_mime_type: str = "image/png"
+    max_tokens: int = 1500
+    temperature: float = 0.2
+    json_mode: bool = True
+
+@dataclass
+class LLMCallMetrics:
+    """Telemetry of one LLM call as answered (or failed) by the router."""
+    provider: Optional[str]
+    model: Optional[str]
+    streamed: bool
+    started: float
+    request_bytes: int = 0
+    image_bytes: int = 0
+    input_tokens: int = 0
+    cached_tokens: int = 0
+    output_tokens: int = 0
+    ttft: Optional[float] = None
+    latency: float = 0.0
+    chunks: int = 0
+    attempts: int = 1        # providers started, including hedges and failovers
+    hedged: bool = False
+    failover: bool = False
+    retry: bool = False      # non-streaming retry after a failed stream
+    success: bool = False
+    error: Optional[str] = None
+    cost: float = 0.0        # USD from AI_CONFIGS pricing
+
+    @property
+    def tokens_per_second(self) -> Optional[float]:
+        """Output tokens per second after the first token (streamed calls only)."""
+        generating = self.latency - (self.ttft or 0.0)
+        return self.output_tokens / generating if self.streamed and self.output_tokens and generating > 0 else None
+
+class LLMProviderAdapter:
+    """Builds one provider's HTTP requests and extracts text from its responses.
+    
+    Subclasses implement build() and the two text extractors; iter_text()
+    handles the shared server-sent-events framing. Credentials and endpoint
+    are read from AI_CONFIGS on each call, so keys set at runtime apply.
+    """
+    
+    def __init__(self, name: str, config: Dict):
+        self.name = name
+        self.config = config
+    
+    @property
+    def api_key(self) -> str:
+        return self.config.get("api_key", "")
+    
+    @property
+    def endpoint(self) -> str:
+        return self.config.get("endpoint", "")
+    
+    @property
+    def model(self) -> str:
+        return self.config.get("model", "")
+    
+    @property
+    def available(self) -> bool:
+        return bool(self.api_key and self.endpoint)
+    
+    def cost(self, input_tokens: int, output_tokens: int) -> float:
+        """USD for a call at the configured per-million-token prices."""
+        pricing = self.config.get("pricing") or {}
+        return (input_tokens * pricing.get("input", 0.0) + output_tokens * pricing.get("output", 0.0)) / 1_000_000
+    
+    def build(self, request: LLMRequest, stream: bool) -> Tuple[str, Dict[str, str], Dict]:
+        """(url, headers, payload) for the request."""
+        raise NotImplementedError
+    
+    def stream_text(self, event: Dict) -> str:
+        """Text carried by one streamed event."""
+        raise NotImplementedError
+    
+    def response_text(self, data: Dict) -> str:
+        """Text of a non-streaming response body."""
+        raise NotImplementedError
+    
+    def event_usage(self, event: Dict) -> Dict[str, int]:
+        """Token counts (input_tokens, cached_tokens, output_tokens) reported in an event or response body."""
+        return {}
+    
+    def iter_text(self, response: requests.Response, usage: Dict[str, int] = None):
+        """Yield text chunks from an SSE response, reading it to the end.
+        
+        Token counts reported along the way are merged into `usage`.
+        """
+        for line in response.iter_lines():
+            if not line:
+                continue
+            line_text = line.decode('utf-8')
+            if not line_text.startswith('data:'):
+                continue  # event names and comments
+            data_str = line_text[5:].strip()
+            if data_str == '[DONE]':
+                continue  # read to the end so the connection goes back to the pool
+            try:
+                event = json.loads(data_str)
+                text = self.stream_text(event)
+                if usage is not None:
+                    usage.update(self.event_usage(event))
+            except (json.JSONDecodeError, AttributeError, TypeError):
+                continue
+            if text:
+                yield text
+
+class OpenAIChatAdapter(LLMProviderAdapter):
+    """OpenAI-compatible /chat/completions (OpenAI, Mistral, TypeGPT)."""
+    
+    def build(self, request: LLMRequest, stream: bool) -> Tuple[str, Dict[str, str], Dict]:
+        content = []
+        if request.user_text:
+            content.append({"type": "text", "text": request.user_text})
+        if request.image_b64:
+            content.append({
+                "type": "image_url",
+                "image_url": {"url": f"data:{request.image_mime_type};base64,{request.image_b64}"}
+            })
+        payload = {
+            "model": self.model,
+            "messages": [
+                {"role": "system", "content": request.system_prompt},
+                {"role": "user", "content": content}
+            ],
+            "max_tokens": request.max_tokens,
+            "temperature": request.temperature,
+            "stream": stream
+        }
+        if request.json_mode:
+            payload["response_format"] = {"type": "json_object"}
+        if stream and self.config.get("stream_usage"):
+            payload["stream_options"] = {"include_usage": True}
+        headers = {"Authorization": f"Bearer {self.api_key}", "Content-Type": "application/json"}
+        return self.endpoint, headers, payload
+    
+    def stream_text(self, event: Dict) -> str:
+        choices = event.get('choices') or [{}]
+        return choices[0].get('delta', {}).get('content') or ""
+    
+    def response_text(self, data: Dict) -> str:
+        return data["choices"][0]["message"]["content"]
+    
+    def event_usage(self, event: Dict) -> Dict[str, int]:
+        usage = event.get('usage')
+        if not usage:
+            return {}
+        return {
+            'input_tokens': usage.get('prompt_tokens', 0),
+            'cached_tokens': (usage.get('prompt_tokens_details') or {}).get('cached_tokens', 0),
+            'output_tokens': usage.get('completion_tokens', 0)
+        }
+
+class AnthropicMessagesAdapter(LLMProviderAdapter):
+    """Anthropic /v1/messages; JSON output is requested through the prompt only.
+    
+    The system prompt carries a cache_control breakpoint so the static
+    prefix is served from Anthropic's prompt cache on later steps.
+    """
+    
+    API_VERSION = "2023-06-01"
+    
+    def build(self, request: LLMRequest, stream: bool) -> Tuple[str, Dict[str, str], Dict]:
+        content = []
+        if request.image_b64:
+            content.append({
+                "type": "image",
+                "source": {"type": "base64", "media_type": request.image_mime_type, "data": request.image_b64}
+            })
+        content.append({"type": "text", "text": request.user_text or "Respond with the JSON decision."})
+        payload = {
+            "model": self.model,
+            "system": [{"type": "text", "text": request.system_prompt, "cache_control": {"type": "ephemeral"}}],
+            "messages": [{"role": "user", "content": content}],
+            "max_tokens": request.max_tokens,
+            "temperature": request.temperature,
+            "stream": stream
+        }
+        headers = {
+            "x-api-key": self.api_key,
+            "anthropic-version": self.API_VERSION,
+            "Content-Type": "application/json"
+        }
+        return self.endpoint, headers, payload
+    
+    def stream_text(self, event: Dict) -> str:
+        if event.get('type') != 'content_block_delta':
+            return ""
+        return event.get('delta', {}).get('text') or ""
+    
+    def response_text(self, data: Dict) -> str:
+        return "".join(block.get('text', '') for block in data.get('content', []) if block.get('type') == 'text')
+    
+    def event_usage(self, event: Dict) -> Dict[str, int]:
+        # message_start carries the input counts, message_delta the running output count
+        usage = event['message'].get('usage') if event.get('type') == 'message_start' else event.get('usage')
+        if not usage:
+            return {}
+        counts = {}
+        if 'input_tokens' in usage:
+            cached = usage.get('cache_read_input_tokens') or 0
+            counts['input_tokens'] = usage['input_tokens'] + cached + (usage.get('cache_creation_input_tokens') or 0)
+            counts['cached_tokens'] = cached
+        if 'output_tokens' in usage:
+            counts['output_tokens'] = usage['output_tokens']
+        return counts
+
+class GeminiAdapter(LLMProviderAdapter):
+    """Gemini generateContent; streaming goes to streamGenerateContent with alt=sse."""
+    
+    def build(self, request: LLMRequest, stream: bool) -> Tuple[str, Dict[str, str], Dict]:
+        parts = []
+        if request.image_b64:
+            parts.append({"inline_data": {"mime_type": request.image_mime_type, "data": request.image_b64}})
+        parts.append({"text": request.user_text or "Respond with the JSON decision."})
+        generation_config = {"temperature": request.temperature, "maxOutputTokens": request.max_tokens}
+        if request.json_mode:
+            generation_config["responseMimeType"] = "application/json"
+        payload = {
+            "systemInstruction": {"parts": [{"text": request.system_prompt}]},
+            "contents": [{"role": "user", "parts": parts}],
+            "generationConfig": generation_config
+        }
+        url = self.endpoint
+        if stream:
+            url = url.replace(":generateContent", ":streamGenerateContent")
+            url += ("&" if "?" in url else "?") + "alt=sse"
+        headers = {"x-goog-api-key": self.api_key, "Content-Type": "application/json"}
+        return url, headers, payload
+    
+    def stream_text(self, event: Dict) -> str:
+        return self.response_text(event)
+    
+    def response_text(self, data: Dict) -> str:
+        candidates = data.get('candidates') or [{}]
+        parts = candidates[0].get('content', {}).get('parts', [])
+        return "".join(part.get('text', '') for part in parts)
+    
+    def event_usage(self, event: Dict) -> Dict[str, int]:
+        usage = event.get('usageMetadata')
+        if not usage:
+            return {}
+        return {
+            'input_tokens': usage.get('promptTokenCount', 0),
+            'cached_tokens': usage.get('cachedContentTokenCount', 0),
+            'output_tokens': usage.get('candidatesTokenCount', 0)
+        }
+
+LLM_ADAPTERS = {
+    "openai": OpenAIChatAdapter,
+    "anthropic": AnthropicMessagesAdapter,
+    "gemini": GeminiAdapter
+}
+
+def create_llm_adapter(provider: str) -> LLMProviderAdapter:
+    """Adapter for a provider in AI_CONFIGS, chosen by its "api" entry."""
+    config = AI_CONFIGS[provider]
+    return LLM_ADAPTERS[config.get("api", "openai")](provider, config)
+
+class LLMRouter:
+    """Routes LLM requests across providers by observed time-to-first-token.
+    
+    Providers are tried fastest-first by median TTFT over a sliding window;
+    until a provider has MIN_SAMPLES it keeps its configured position.
+    Streamed requests are hedged: if the primary has not produced a token
+    within the hedge deadline, the next provider is started as well and
+    whichever produces a token first wins, while the other stream is closed.
+    A provider that fails before its first token hands over immediately.
+    Every call ends in an LLMCallMetrics record, passed to on_call if set.
+    """
+    
+    MIN_SAMPLES = 5
+    WINDOW = 50
+    
+    def __init__(self, providers: List[str] = None, client: LLMClient = None,
+                 hedge_deadline: Optional[float] = LLM_HEDGE_DEADLINE):
+        names = LLM_PROVIDERS if providers is None else providers
+        for name in names:
+            if name not in AI_CONFIGS:
+                logger.warning(f"Unknown LLM provider '{name}' ignored")
+        self.adapters = [create_llm_adapter(name) for name in names if name in AI_CONFIGS]
+        self.client = client or LLMClient.shared()
+        self.hedge_deadline = hedge_deadline  # seconds; None = primary's p95 TTFT, 0 = never hedge
+        self.ttft: Dict[str, deque] = {adapter.name: deque(maxlen=self.WINDOW) for adapter in self.adapters}
+        self.stats = {'requests': 0, 'hedged': 0, 'hedge_wins': 0, 'failovers': 0}
+        self.last_provider: Optional[str] = None
+        self.last_usage: Dict[str, int] = {}  # Token counts reported for the last answered request
+        self.last_call: Optional[LLMCallMetrics] = None
+        self.on_call: Optional[Callable[[LLMCallMetrics], None]] = None
+        self._lock = threading.Lock()
+    
+    @property
+    def available(self) -> List[LLMProviderAdapter]:
+        return [adapter for adapter in self.adapters if adapter.available]
+    
+    def percentile(self, provider: str, q: float) -> Optional[float]:
+        with self._lock:
+            samples = list(self.ttft.get(provider, ()))
+        return float(np.percentile(samples, q)) if samples else None
+    
+    def latency_summary(self) -> Dict[str, Dict[str, Any]]:
+        """p50/p95 time-to-first-token (s) and sample count per provider."""
+        return {
+            name: {'p50': self.percentile(name, 50), 'p95': self.percentile(name, 95), 'samples': len(samples)}
+            for name, samples in self.ttft.items()
+        }
+    
+    def ranked(self) -> List[LLMProviderAdapter]:
+        """Available providers, measured ones by median TTFT first, then the rest in configured order."""
+        def sort_key(item):
+            position, adapter = item
+            if len(self.ttft[adapter.name]) >= self.MIN_SAMPLES:
+                return (0, self.percentile(adapter.name, 50), position)
+            return (1, 0.0, position)
+        return [adapter for _, adapter in sorted(enumerate(self.available), key=sort_key)]
+    
+    def _hedge_after(self, primary: LLMProviderAdapter) -> Optional[float]:
+        if self.hedge_deadline is None:
+            if len(self.ttft[primary.name]) >= self.MIN_SAMPLES:
+                return self.percentile(primary.name, 95)
+            return None
+        return self.hedge_deadline if self.hedge_deadline > 0 else None
+    
+    def _record_ttft(self, provider: str, seconds: float):
+        with self._lock:
+            self.ttft[provider].append(seconds)
+    
+    def _finish_call(self, call: LLMCallMetrics, request: LLMRequest, adapter: Optional[LLMProviderAdapter],
+                     usage: Dict[str, int], error: Optional[str]):
+        """Fill in the call's totals from the answering (or last) provider and report it."""
+        call.latency = time.time() - call.started
+        call.image_bytes = len(request.image_b64) * 3 // 4 if request.image_b64 else 0
+        if adapter is not None:
+            call.provider, call.model = adapter.name, adapter.model
+        call.input_tokens = usage.get('input_tokens', 0)
+        call.cached_tokens = usage.get('cached_tokens', 0)
+        call.output_tokens = usage.get('output_tokens', 0)
+        call.cost = adapter.cost(call.input_tokens, call.output_tokens) if adapter is not None else 0.0
+        call.success, call.error = error is None, error
+        self.last_call = call
+        if self.on_call is not None:
+            try:
+                self.on_call(call)
+            except Exception as e:
+                logger.warning(f"LLM call telemetry failed: {e}")
+    
+    def _run_attempt(self, attempt: Dict, request: LLMRequest, events: queue.Queue):
+        adapter = attempt['adapter']
+        try:
+            url, headers, payload = adapter.build(request, stream=True)
+            attempt['response'] = self.client.post(url, headers, payload, stream=True)
+            attempt['request_bytes'] = len(attempt['response'].request.body or b'')
+            if attempt['cancelled'].is_set():
+                return
+            attempt['response'].raise_for_status()
+            for text in adapter.iter_text(attempt['response'], attempt['usage']):
+                if attempt['cancelled'].is_set():
+                    return
+                attempt['chunks'] += 1
+                events.put(('text', attempt, text))
+            events.put(('done', attempt, None))
+        except Exception as e:
+            if not attempt['cancelled'].is_set():
+                events.put(('error', attempt, e))
+        finally:
+            if attempt['response'] is not None:
+                attempt['response'].close()
+    
+    @staticmethod
+    def _cancel(attempt: Dict):
+        attempt['cancelled'].set()
+        response = attempt['response']
+        if response is not None:
+            try:
+                response.close()
+            except Exception:
+                pass
+    
+    def stream(self, request: LLMRequest):
+        """Yield text chunks of the response from the first provider to start answering."""
+        candidates = self.ranked()
+        if not candidates:
+            raise RuntimeError("No LLM provider is configured; set an API key for one of LLM_PROVIDERS")
+        self.stats['requests'] += 1
+        self.last_usage = {}
+        call = LLMCallMetrics(provider=None, model=None, streamed=True, started=time.time())
+        error: Optional[str] = "stream closed before the response ended"
+        events: queue.Queue = queue.Queue()
+        attempts: List[Dict] = []
+        
+        def launch():
+            attempt = {'adapter': candidates[len(attempts)], 'started': time.time(),
+                       'cancelled': threading.Event(), 'response': None, 'usage': {},
+                       'request_bytes': 0, 'chunks': 0}
+            attempts.append(attempt)
+            threading.Thread(target=self._run_attempt, args=(attempt, request, events),
+                             name=f"llm-{attempt['adapter'].name}", daemon=True).start()
+        
+        launch()
+        hedge_after = self._hedge_after(candidates[0])
+        hedge_attempt = None
+        winner = None
+        pending = 1
+        try:
+            while True:
+                timeout = None
+                if winner is None and hedge_attempt is None and hedge_after is not None and len(attempts) < len(candidates):
+                    timeout = max(0.0, attempts[0]['started'] + hedge_after - time.time())
+                try:
+                    kind, attempt, value = events.get(timeout=timeout)
+                except queue.Empty:
+                    self.stats['hedged'] += 1
+                    call.hedged = True
+                    logger.info(f"⏱️ {candidates[0].name} silent for {hedge_after:.2f}s - hedging with {candidates[len(attempts)].name}")
+                    launch()
+                    hedge_attempt = attempts[-1]
+                    pending += 1
+                    continue
+                
+                if winner is None:
+                    if kind == 'text':
+                        winner = attempt
+                        call.ttft = time.time() - call.started
+                        self._record_ttft(attempt['adapter'].name, time.time() - attempt['started'])
+                        self.last_provider = attempt['adapter'].name
+                        if attempt is hedge_attempt:
+                            self.stats['hedge_wins'] += 1
+                        for other in attempts:
+                            if other is not attempt:
+                                self._cancel(other)
+                        yield value
+                        continue
+                    pending -= 1
+                    failure = value or RuntimeError(f"{attempt['adapter'].name} returned an empty response")
+                    logger.warning(f"LLM provider {attempt['adapter'].name} failed before its first token: {failure}")
+                    if pending == 0:
+                        if len(attempts) == len(candidates):
+                            raise failure
+                        self.stats['failovers'] += 1
+                        call.failover = True
+                        launch()
+                        pending += 1
+                elif attempt is winner:
+                    if kind == 'text':
+                        yield value
+                    elif kind == 'done':
+                        self.last_usage = attempt['usage']
+                        error = None
+                        return
+                    else:
+                        raise value
+        except Exception as e:
+            error = str(e)
+            raise
+        finally:
+            for attempt in attempts:
+                if attempt is not winner:
+                    self._cancel(attempt)
+            answered = winner or attempts[-1]
+            call.attempts = len(attempts)
+            call.request_bytes, call.chunks = answered['request_bytes'], answered['chunks']
+            self._finish_call(call, request, answered['adapter'], answered['usage'], error)
+    
+    def complete(self, request: LLMRequest, read_timeout: float = 60, retry: bool = False) -> str:
+        """Non-streaming completion, trying providers in ranked order until one answers.
+        
+        `retry` marks the call's metrics as a retry of a failed streamed call.
+        """
+        last_error: Exception = RuntimeError("No LLM provider is configured; set an API key for one of LLM_PROVIDERS")
+        call = LLMCallMetrics(provider=None, model=None, streamed=False, started=time.time(), attempts=0, retry=retry)
+        adapter = None
+        for adapter in self.ranked():
+            call.attempts += 1
+            call.failover = call.attempts > 1
+            try:
+                url, headers, payload = adapter.build(request, stream=False)
+                response = self.client.post(url, headers, payload, read_timeout=read_timeout)
+                call.request_bytes = len(response.request.body or b'')
+                response.raise_for_status()
+                data = response.json()
+                text = adapter.response_text(data)
+            except Exception as e:
+                logger.warning(f"LLM provider {adapter.name} failed: {e}")
+                last_error = e
+                continue
+            self.last_provider = adapter.name
+            self.last_usage = adapter.event_usage(data)
+            call.ttft, call.chunks = time.time() - call.started, 1
+            self._finish_call(call, request, adapter, self.last_usage, None)
+            return text
+        self._finish_call(call, request, adapter, {}, str(last_error))
+        raise last_error
+    
+    def warm_up(self):
+        """Open pooled connections to every available provider host."""
+        for adapter in self.available:
+            self.client.warm_up(adapter.endpoint)
+
+class StreamingJSONParser:
+    """Incremental scanner for a JSON object arriving in chunks.
+    
+    Nesting and string state are carried across chunks, and each top-level
+    member is decoded as soon as its value is complete, so a caller can act
+    on one field (e.g. "action") while later fields are still streaming.
+    Text before the opening brace (code fences, whitespace) is ignored.
+    """
+    
+    def __init__(self):
+        self.text = ""
+        self.values: Dict[str, Any] = {}
+        self._pos = 0
+        self._start: Optional[int] = None   # index of the opening brace
+        self._end: Optional[int] = None     # index of the closing brace
+        self._depth = 0
+        self._in_string = False
+        self._escaped = False
+        self._state = 'key'                 # top-level position: key, colon, value, next
+        self._key: Optional[str] = None
+        self._token_start: Optional[int] = None
+    
+    @property
+    def complete(self) -> bool:
+        return self._end is not None
+    
+    def feed(self, chunk: str) -> List[str]:
+        """Add streamed text; returns the top-level keys whose values just completed."""
+        self.text += chunk
+        completed = []
+        text = self.text
+        i = self._pos
+        while i < len(text) and self._end is None:
+            ch = text[i]
+            if self._in_string:
+                if self._escaped:
+                    self._escaped = False
+                elif ch == '\\':
+                    self._escaped = True
+                elif ch == '"':
+                    self._in_string = False
+                    if self._depth == 1 and self._state == 'key':
+                        self._key = json.loads(text[self._token_start:i + 1])
+                        self._state = 'colon'
+                    elif self._depth == 1 and self._state == 'value':
+                        self._finish_value(text[self._token_start:i + 1], completed)
+            elif self._start is None:
+                if ch == '{':
+                    self._start, self._depth = i, 1
+            elif ch == '"':
+                self._in_string = True
+                if self._depth == 1 and self._state in ('key', 'value'):
+                    self._token_start = i
+            elif ch in '{[':
+                if self._depth == 1 and self._state == 'value' and self._token_start is None:
+                    self._token_start = i
+                self._depth += 1
+            elif ch in '}]':
+                self._depth -= 1
+                if self._depth == 1 and self._state == 'value':
+                    self._finish_value(text[self._token_start:i + 1], completed)
+                elif self._depth == 0:
+                    if self._state == 'value' and self._token_start is not None:
+                        self._finish_value(text[self._token_start:i], completed)
+                    self._end = i
+            elif self._depth == 1:
+                if ch == ':' and self._state == 'colon':
+                    self._state, self._token_start = 'value', None
+                elif ch == ',':
+                    if self._state == 'value' and self._token_start is not None:
+                        self._finish_value(text[self._token_start:i], completed)
+                    self._state = 'key'
+                elif self._state == 'value' and self._token_start is None and not ch.isspace():
+                    self._token_start = i  # number, true, false or null
+            i += 1
+        self._pos = i
+        return completed
+    
+    def _finish_value(self, value_text: str, completed: List[str]):
+        try:
+            self.values[self._key] = json.loads(value_text)
+            completed.append(self._key)
+        except (json.JSONDecodeError, TypeError):
+            pass
+        self._state, self._token_start = 'next', None
+    
+    def result(self) -> Dict:
+        """Decode the whole object (raises like json.loads if it is incomplete)."""
+        if self._end is not None:
+            return json.loads(self.text[self._start:self._end + 1])
+        return json.loads(self.text)
+
+
+class DecisionCache:
+    """Persistent cache of LLM decisions keyed by objective and page state.
+    
+    The key combines the normalized objective, a URL pattern (numeric path
+    segments and query values masked), the (id, fingerprint) set of the
+    elements in the prompt and the last-action feedback with numbers masked. Element
+    ids are part of the key, so a cached decision always names an element
+    that means the same thing. Only confident decisions that executed
+    successfully are stored; ANSWER carries page-specific content and is
+    never cached.
+    """
+    
+    UNCACHEABLE_ACTIONS = ("ANSWER", "REQUEST_SCREENSHOT")
+    
+    def __init__(self, db: 'AdvancedDatabase', enabled: bool = DECISION_CACHE_ENABLED,
+                 ttl: float = DECISION_CACHE_TTL, max_entries: int = DECISION_CACHE_MAX_ENTRIES,
+                 min_confidence: float = DECISION_CACHE_MIN_CONFIDENCE):
+        self.db = db
+        self.enabled = enabled
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.min_confidence = min_confidence
+        self.stats = {'hits': 0, 'misses': 0, 'stored': 0, 'evicted': 0, 'invalidated': 0}
+    
+    @property
+    def hit_rate(self) -> float:
+        lookups = self.stats['hits'] + self.stats['misses']
+        return self.stats['hits'] / lookups if lookups else 0.0
+    
+    @staticmethod
+    def normalize_text(text: str, mask_numbers: bool = False) -> str:
+        text = (text or '').lower()
+        if mask_numbers:  # Durations and counts in action feedback
+            text = re.sub(r'\d+(\.\d+)?', '#', text)
+        return re.sub(r'\s+', ' ', text).strip()
+    
+    @staticmethod
+    def url_pattern(url: str) -> str:
+        """scheme://host/path?keys with numeric path segments masked and query values dropped."""
+        parsed = urlparse(url or '')
+        path = re.sub(r'/\d+(?=/|$)', '/#', parsed.path)
+        query = '&'.join(sorted(parse_qs(parsed.query, keep_blank_values=True)))
+        return f"{parsed.scheme}://{parsed.netloc.lower()}{path}" + (f"?{query}" if query else "")
+    
+    def key(self, objective: str, url: str, elements: 'ElementTable', last_action_feedback: str) -> str:
+        element_set = sorted(zip(elements.ids.tolist(), elements.fingerprints.tolist()))
+        material = json.dumps([
+            self.normalize_text(objective), self.url_pattern(url), element_set,
+            self.normalize_text(last_action_feedback, mask_numbers=True)
+        ])
+        return hashlib.sha256(material.encode('utf-8')).hexdigest()
+    
+    def get(self, cache_key: str) -> Optional[Dict]:
+        """Cached decision for the key, or None on a miss (or when disabled)."""
+        if not self.enabled:
+            return None
+        try:
+            cached = self.db.get_cached_decision(cache_key, self.ttl)
+        except sqlite3.Error as e:
+            logger.warning(f"Decision cache lookup failed: {e}")
+            cached = None
+        if cached is None:
+            self.stats['misses'] += 1
+            return None
+        self.stats['hits'] += 1
+        return json.loads(cached)
+    
+    def put(self, cache_key: str, objective: str, url: str, decision: Dict):
+        """Store a decision that executed successfully, if it is confident and cacheable."""
+        action = decision.get('action') or {}
+        try:
+            confidence = float(decision.get('confidence', 0))
+        except (TypeError, ValueError):
+            return
+        if not self.enabled or confidence < self.min_confidence or action.get('name') in self.UNCACHEABLE_ACTIONS:
+            return
+        try:
+            self.stats['evicted'] += self.db.put_cached_decision(
+                cache_key, self.normalize_text(objective), self.url_pattern(url),
+                json.dumps(decision), confidence, self.max_entries
+            )
+            self.stats['stored'] += 1
+        except sqlite3.Error as e:
+            logger.warning(f"Decision cache store failed: {e}")
+    
+    def invalidate(self, cache_key: str):
+        """Drop a cached decision that failed when replayed."""
+        try:
+            self.db.delete_cached_decision(cache_key)
+            self.stats['invalidated'] += 1
+        except sqlite3.Error as e:
+            logger.warning(f"Decision cache invalidation failed: {e}")
+
 class CaptchaSolver:
     """Advanced CAPTCHA solving capabilities."""
     
@@ -236,13 +1524,13 @@ class CaptchaSolver:
                 logger.error(f"CAPTCHA solving failed: {e}")
         return None
     
-    def solve_image_captcha(self, image_path: str) -> Optional[str]:
-        """Solve image-based CAPTCHA using OCR."""
+    def solve_image_captcha(self, image: Union[str, bytes]) -> Optional[str]:
+        """Solve image-based CAPTCHA using OCR (image file path or encoded bytes)."""
         try:
             import pytesseract
             from PIL import Image
             
-            img = Image.open(image_path)
+            img = Image.open(BytesIO(image) if isinstance(image, bytes) else image)
             # Preprocess image for better OCR
             img = img.convert('L')  # Convert to grayscale
             img = ImageEnhance.Contrast(img).enhance(2)
@@ -398,6 +1686,69 @@ class AdvancedDatabase:
                 )
             ''')
             
+            # Content-addressed screenshot archive
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS screenshots (
+                    sha256 TEXT PRIMARY KEY,
+                    dhash TEXT NOT NULL,
+                    path TEXT NOT NULL,
+                    thumbnail_path TEXT,
+                    width INTEGER,
+                    height INTEGER,
+                    bytes INTEGER,
+                    label TEXT,
+                    first_seen TEXT,
+                    last_seen TEXT,
+                    hits INTEGER DEFAULT 1
+                )
+            ''')
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_screenshots_last_seen ON screenshots (last_seen)')
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_screenshots_path ON screenshots (path)')
+            
+            # LLM decisions keyed by objective and page state
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS decision_cache (
+                    cache_key TEXT PRIMARY KEY,
+                    objective TEXT,
+                    url_pattern TEXT,
+                    decision TEXT NOT NULL,
+                    confidence REAL,
+                    created_at REAL NOT NULL,
+                    last_used REAL NOT NULL,
+                    hits INTEGER DEFAULT 0
+                )
+            ''')
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_decision_cache_last_used ON decision_cache (last_used)')
+            
+            # One row per LLM call: payload size, tokens, latency and cost
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS llm_calls (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    timestamp TEXT NOT NULL,
+                    step INTEGER,
+                    provider TEXT,
+                    model TEXT,
+                    streamed BOOLEAN,
+                    success BOOLEAN,
+                    error TEXT,
+                    request_bytes INTEGER,
+                    image_bytes INTEGER,
+                    input_tokens INTEGER,
+                    cached_tokens INTEGER,
+                    output_tokens INTEGER,
+                    ttft REAL,
+                    latency REAL,
+                    chunks INTEGER,
+                    tokens_per_second REAL,
+                    attempts INTEGER,
+                    hedged BOOLEAN,
+                    failover BOOLEAN,
+                    retry BOOLEAN,
+                    cost REAL
+                )
+            ''')
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_llm_calls_timestamp ON llm_calls (timestamp)')
+            
             conn.commit()
     
     def log_action(self, action_result: ActionResult):
@@ -419,8 +1770,120 @@ class AdvancedDatabase:
             ))
             conn.commit()
 
-class AdvancedEmailManager:
-    """Advanced email management system."""
+    def log_llm_call(self, call: LLMCallMetrics, step: int = None):
+        """Log one LLM call's telemetry."""
+        with sqlite3.connect(self.db_path) as conn:
+            conn.execute('''
+                INSERT INTO llm_calls
+                (timestamp, step, provider, model, streamed, success, error, request_bytes, image_bytes,
+                 input_tokens, cached_tokens, output_tokens, ttft, latency, chunks, tokens_per_second,
+                 attempts, hedged, failover, retry, cost)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ''', (
+                datetime.fromtimestamp(call.started).isoformat(), step, call.provider, call.model,
+                call.streamed, call.success, call.error, call.request_bytes, call.image_bytes,
+                call.input_tokens, call.cached_tokens, call.output_tokens, call.ttft, call.latency,
+                call.chunks, call.tokens_per_second, call.attempts, call.hedged, call.failover,
+                call.retry, call.cost
+            ))
+            conn.commit()
+    
+    def llm_call_summary(self, since: datetime) -> List[Dict[str, Any]]:
+        """Per-provider totals and averages of the LLM calls made since a point in time."""
+        with sqlite3.connect(self.db_path) as conn:
+            conn.row_factory = sqlite3.Row
+            rows = conn.execute('''
+                SELECT provider, model, COUNT(*) AS calls, SUM(NOT success) AS failures,
+                       AVG(ttft) AS avg_ttft, AVG(latency) AS avg_latency, AVG(tokens_per_second) AS tokens_per_second,
+                       SUM(request_bytes) AS request_bytes, SUM(image_bytes) AS image_bytes,
+                       SUM(input_tokens) AS input_tokens, SUM(cached_tokens) AS cached_tokens,
+                       SUM(output_tokens) AS output_tokens, AVG(chunks) AS avg_chunks,
+                       SUM(hedged) AS hedged, SUM(failover) AS failovers, SUM(retry) AS retries, SUM(cost) AS cost
+                FROM llm_calls WHERE timestamp >= ?
+                GROUP BY provider, model ORDER BY calls DESC
+            ''', (since.isoformat(),)).fetchall()
+        return [dict(row) for row in rows]
+
+    def find_screenshot(self, sha256: str) -> Optional[str]:
+        """Path of a stored screenshot with the given content hash."""
+        with sqlite3.connect(self.db_path) as conn:
+            row = conn.execute('SELECT path FROM screenshots WHERE sha256 = ?', (sha256,)).fetchone()
+        return row[0] if row else None
+    
+    def recent_screenshot_hashes(self, limit: int) -> List[Tuple[str, str]]:
+        """(path, dhash) of the most recently seen screenshots."""
+        with sqlite3.connect(self.db_path) as conn:
+            return conn.execute(
+                'SELECT path, dhash FROM screenshots ORDER BY last_seen DESC LIMIT ?', (limit,)
+            ).fetchall()
+    
+    def add_screenshot(self, sha256: str, dhash: str, path: str, thumbnail_path: str,
+                       width: int, height: int, size: int, label: str = None):
+        """Record a newly archived screenshot."""
+        now = datetime.now().isoformat()
+        with sqlite3.connect(self.db_path) as conn:
+            conn.execute('''
+                INSERT OR REPLACE INTO screenshots
+                (sha256, dhash, path, thumbnail_path, width, height, bytes, label, first_seen, last_seen, hits)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, 1)
+            ''', (sha256, dhash, path, thumbnail_path, width, height, size, label, now, now))
+            conn.commit()
+    
+    def touch_screenshot(self, path: str):
+        """Count another reference to an archived screenshot."""
+        with sqlite3.connect(self.db_path) as conn:
+            conn.execute(
+                'UPDATE screenshots SET hits = hits + 1, last_seen = ? WHERE path = ?',
+                (datetime.now().isoformat(), path)
+            )
+            conn.commit()
+    
+    def screenshot_thumbnail(self, path: str) -> Optional[str]:
+        """Thumbnail path for an archived screenshot."""
+        with sqlite3.connect(self.db_path) as conn:
+            row = conn.execute('SELECT thumbnail_path FROM screenshots WHERE path = ?', (path,)).fetchone()
+        return row[0] if row else None
+
+    def get_cached_decision(self, cache_key: str, max_age: float) -> Optional[str]:
+        """Cached decision JSON for a key, counting the hit; expired entries are dropped."""
+        now = time.time()
+        with sqlite3.connect(self.db_path) as conn:
+            row = conn.execute(
+                'SELECT decision, created_at FROM decision_cache WHERE cache_key = ?', (cache_key,)
+            ).fetchone()
+            if not row:
+                return None
+            if now - row[1] > max_age:
+                conn.execute('DELETE FROM decision_cache WHERE cache_key = ?', (cache_key,))
+                return None
+            conn.execute(
+                'UPDATE decision_cache SET hits = hits + 1, last_used = ? WHERE cache_key = ?', (now, cache_key)
+            )
+        return row[0]
+    
+    def put_cached_decision(self, cache_key: str, objective: str, url_pattern: str, decision: str,
+                            confidence: float, max_entries: int) -> int:
+        """Store a decision and evict least recently used entries beyond max_entries; returns the eviction count."""
+        now = time.time()
+        with sqlite3.connect(self.db_path) as conn:
+            conn.execute('''
+                INSERT OR REPLACE INTO decision_cache
+                (cache_key, objective, url_pattern, decision, confidence, created_at, last_used, hits)
+                VALUES (?, ?, ?, ?, ?, ?, ?, 0)
+            ''', (cache_key, objective, url_pattern, decision, confidence, now, now))
+            return conn.execute('''
+                DELETE FROM decision_cache WHERE cache_key IN (
+                    SELECT cache_key FROM decision_cache ORDER BY last_used DESC LIMIT -1 OFFSET ?
+                )
+            ''', (max_entries,)).rowcount
+    
+    def delete_cached_decision(self, cache_key: str):
+        """Forget a cached decision."""
+        with sqlite3.connect(self.db_path) as conn:
+            conn.execute('DELETE FROM decision_cache WHERE cache_key = ?', (cache_key,))
+
+class AdvancedEmailManager:
+    """Advanced email management system."""
     
     def __init__(self):
         self.smtp_server = "smtp.gmail.com"
@@ -499,6 +1962,12 @@ class AdvancedReportGenerator:
                 .success {{ border-left-color: #28a745; }}
                 .error {{ border-left-color: #dc3545; }}
                 .screenshot {{ max-width: 300px; border-radius: 5px; margin: 10px 0; }}
+                .llm-calls {{ width: 100%; border-collapse: collapse; font-size: 0.9em; }}
+                .llm-calls th, .llm-calls td {{ padding: 8px; border-bottom: 1px solid #ddd; text-align: right; }}
+                .llm-calls th:first-child, .llm-calls td:first-child {{ text-align: left; }}
+                .filmstrip {{ display: flex; gap: 8px; overflow-x: auto; padding: 10px 0; }}
+                .filmstrip figure {{ margin: 0; text-align: center; font-size: 0.8em; color: #666; }}
+                .filmstrip img {{ width: 240px; border-radius: 5px; border: 1px solid #ddd; }}
                 .footer {{ text-align: center; margin-top: 30px; color: #666; }}
             </style>
         </head>
@@ -533,6 +2002,10 @@ class AdvancedReportGenerator:
                     {self._generate_timeline_html(session_data.get('actions', []))}
                 </div>
                 
+                {self._generate_llm_calls_html(session_data.get('llm_calls', []))}
+                
+                {self._generate_filmstrip_html(session_data.get('filmstrip', []))}
+                
                 <div class="footer">
                     <p>Generated by Mega Advanced Browser Agent v2.0</p>
                 </div>
@@ -556,10 +2029,60 @@ class AdvancedReportGenerator:
             <div class="timeline-item {status_class}">
                 <strong>{action.action_type}</strong> - {action.message}
                 <br><small>{action.timestamp.strftime("%H:%M:%S")} | Duration: {action.duration:.2f}s</small>
-                {f'<br><img src="{action.screenshot_path}" class="screenshot" alt="Screenshot">' if action.screenshot_path else ''}
+                {self._screenshot_html(action.screenshot_path) if action.screenshot_path else ''}
             </div>
             """
         return timeline_html
+    
+    def _generate_llm_calls_html(self, summaries: List[Dict[str, Any]]) -> str:
+        """Generate the per-provider LLM call table (empty without calls)."""
+        if not summaries:
+            return ""
+        rows_html = "".join(f"""
+                        <tr>
+                            <td>{summary['provider'] or '-'} <small>{summary['model'] or ''}</small></td>
+                            <td>{summary['calls']} ({summary['failures']} failed, {summary['retries']} retries)</td>
+                            <td>{summary['avg_ttft'] or 0:.2f}s</td>
+                            <td>{summary['avg_latency']:.2f}s</td>
+                            <td>{summary['tokens_per_second'] or 0:.0f}</td>
+                            <td>{summary['input_tokens']} ({summary['cached_tokens']} cached) / {summary['output_tokens']}</td>
+                            <td>{summary['request_bytes'] / 1024:.0f} KB ({summary['image_bytes'] / 1024:.0f} KB images)</td>
+                            <td>{summary['avg_chunks'] or 0:.0f}</td>
+                            <td>{summary['hedged']} / {summary['failovers']}</td>
+                            <td>${summary['cost']:.4f}</td>
+                        </tr>""" for summary in summaries)
+        return f"""
+                <div class="timeline">
+                    <h2>LLM Calls</h2>
+                    <table class="llm-calls">
+                        <tr><th>Provider</th><th>Calls</th><th>Avg TTFT</th><th>Avg Latency</th><th>Tokens/s</th>
+                            <th>Tokens In / Out</th><th>Sent</th><th>Avg Chunks</th><th>Hedged / Failover</th><th>Cost</th></tr>
+                        {rows_html}
+                    </table>
+                </div>
+        """
+    
+    def _generate_filmstrip_html(self, filmstrip: List[Tuple[datetime, str]]) -> str:
+        """Generate the screencast filmstrip section (empty without screencast frames)."""
+        if not filmstrip:
+            return ""
+        frames_html = "".join(
+            f'<figure><img src="{data_uri}" alt="Frame"><figcaption>{frame_time.strftime("%H:%M:%S")}</figcaption></figure>'
+            for frame_time, data_uri in filmstrip
+        )
+        return f"""
+                <div class="timeline">
+                    <h2>Session Filmstrip</h2>
+                    <div class="filmstrip">{frames_html}</div>
+                </div>
+        """
+    
+    def _screenshot_html(self, screenshot_path: str) -> str:
+        """Thumbnail linking to the archived screenshot, relative to the reports directory."""
+        thumbnail_path = self.db.screenshot_thumbnail(screenshot_path) or screenshot_path
+        full_src = os.path.relpath(screenshot_path, 'reports')
+        thumb_src = os.path.relpath(thumbnail_path, 'reports')
+        return f'<br><a href="{full_src}"><img src="{thumb_src}" class="screenshot" alt="Screenshot" loading="lazy"></a>'
 
 class ChatInterface:
     """Clean, minimal chat interface with modern speech bubble design for AI agent responses."""
@@ -1175,125 +2698,2199 @@ class PerformanceMonitor:
             javascript_errors=error_messages,
             timestamp=datetime.now()
         )
-        
-        self.metrics_history.append(metrics)
-        return metrics
+        
+        self.metrics_history.append(metrics)
+        return metrics
+    
+    def optimize_page_load(self):
+        """Apply optimizations to improve page load."""
+        # Disable images
+        self.driver.execute_cdp_cmd('Emulation.setUserAgentOverride', {
+            "userAgent": self.driver.execute_script("return navigator.userAgent"),
+            "acceptLanguage": "en-US,en",
+            "platform": "Win32"
+        })
+        
+        # Block unnecessary resources
+        self.driver.execute_cdp_cmd('Network.setBlockedURLs', {
+            "urls": ["*.gif", "*.png", "*.jpg", "*.jpeg", "*.css"]
+        })
+        
+        # Enable cache
+        self.driver.execute_cdp_cmd('Network.setCacheDisabled', {'cacheDisabled': False})
+
+class SmartFormFiller:
+    """Intelligent form filling with AI assistance."""
+    
+    def __init__(self, driver):
+        self.driver = driver
+        self.field_mappings = {
+            'email': ['email', 'e-mail', 'mail', 'correo'],
+            'name': ['name', 'fullname', 'full_name', 'nombre'],
+            'phone': ['phone', 'tel', 'telephone', 'mobile', 'telefono'],
+            'address': ['address', 'street', 'direccion'],
+            'city': ['city', 'ciudad'],
+            'zip': ['zip', 'postal', 'postcode', 'codigo_postal'],
+            'country': ['country', 'pais'],
+            'password': ['password', 'pass', 'pwd', 'contrasena']
+        }
+        
+    def auto_fill_form(self, data: Dict[str, str], use_ai: bool = True):
+        """Automatically fill form with provided data."""
+        form_elements = self.driver.find_elements(By.CSS_SELECTOR, "input, textarea, select")
+        filled_count = 0
+        
+        for element in form_elements:
+            try:
+                # Get element attributes
+                element_type = element.get_attribute('type')
+                element_name = element.get_attribute('name') or ''
+                element_id = element.get_attribute('id') or ''
+                placeholder = element.get_attribute('placeholder') or ''
+                label_text = self._get_label_text(element)
+                
+                # Determine field type
+                field_key = self._identify_field_type(
+                    element_name, element_id, placeholder, label_text, element_type
+                )
+                
+                if field_key and field_key in data:
+                    # Fill the field
+                    if element.tag_name == 'select':
+                        Select(element).select_by_visible_text(data[field_key])
+                    elif element_type == 'checkbox':
+                        if data[field_key].lower() in ['true', 'yes', '1']:
+                            if not element.is_selected():
+                                element.click()
+                    elif element_type == 'radio':
+                        if element.get_attribute('value') == data[field_key]:
+                            element.click()
+                    else:
+                        element.clear()
+                        element.send_keys(data[field_key])
+                    
+                    filled_count += 1
+                    logger.info(f"Filled field {field_key} with value")
+                    
+            except Exception as e:
+                logger.error(f"Error filling form field: {e}")
+                
+        logger.info(f"Successfully filled {filled_count} form fields")
+        return filled_count
+    
+    def _identify_field_type(self, name: str, id: str, placeholder: str, label: str, input_type: str) -> Optional[str]:
+        """Identify the type of form field."""
+        combined_text = f"{name} {id} {placeholder} {label}".lower()
+        
+        for field_type, patterns in self.field_mappings.items():
+            for pattern in patterns:
+                if pattern in combined_text:
+                    return field_type
+                    
+        # Check input type
+        if input_type == 'email':
+            return 'email'
+        elif input_type == 'tel':
+            return 'phone'
+        elif input_type == 'password':
+            return 'password'
+            
+        return None
+    
+    def _get_label_text(self, element) -> str:
+        """Get label text for an input element."""
+        try:
+            # Try to find label by 'for' attribute
+            element_id = element.get_attribute('id')
+            if element_id:
+                label = self.driver.find_element(By.CSS_SELECTOR, f"label[for='{element_id}']")
+                return label.text
+        except:
+            pass
+            
+        try:
+            # Try to find parent label
+            parent = element.find_element(By.XPATH, "..")
+            if parent.tag_name == 'label':
+                return parent.text
+        except:
+            pass
+            
+        return ""
+
+class IncrementalElementIndex:
+    """Persistent in-page element index kept current by a MutationObserver.
+
+    The first call installs the index and scans the whole document. Later calls
+    only re-extract elements touched by DOM mutations (and re-measure rects after
+    scrolls or layout-affecting mutations), returning a delta that is merged into
+    the Python-side mirror.
+
+    The delta is a handle-free columnar payload (parallel arrays of ids, tags,
+    labels, flattened rects and flag bits), so Selenium never has to serialize
+    WebElement proxies for elements that are never acted on.
+    """
+
+    ID_ATTRIBUTE = 'data-element-id'
+
+    INDEX_SCRIPT = '''
+    if (!window.__aiElementIndex) {
+        const SELECTORS = 'a, button, input, textarea, select, [role="button"], [role="link"], ' +
+            '[onclick], [tabindex]:not([tabindex="-1"]), [contenteditable="true"], ' +
+            '[data-testid], [data-cy], .btn, .button, .link, .clickable, ' +
+            'form, label, option, summary, details, [href], [src]';
+        const OVERLAY_SELECTORS = '#ai-cursor, #ai-analysis-bubble, #ai-status-bar, #ai-progress-ring, ' +
+            '[id^="ai-chat-bubble-"], [id^="ai-typing-"], [id^="ai-avatar-"]';
+
+        const tracked = new Map();      // element -> record {id, fp, entry, sig, emitted}
+        const dirty = new Set();        // elements needing full re-extraction
+        const observedDocs = new WeakSet();
+        const byFingerprint = new Map();    // fingerprint -> element
+        const idByFingerprint = new Map();  // fingerprint -> last id, survives re-renders
+        const byId = new Map();             // id -> element currently owning it
+        let siblingCache = new Map();       // parent -> (child -> nth-of-type), per pass
+        let nextId = 1;
+        let fresh = true;
+        let layoutDirty = true;
+        let needsPrune = false;
+
+        const isOverlay = (node) => {
+            const el = node.nodeType === 1 ? node : node.parentElement;
+            return !!(el && el.closest && el.closest(OVERLAY_SELECTORS));
+        };
+
+        const track = (el) => {
+            if (isOverlay(el)) return;
+            if (!tracked.has(el)) {
+                // The id is assigned on first extraction, once the fingerprint is known
+                tracked.set(el, {id: null, fp: null, entry: null, sig: null, emitted: false});
+            }
+            dirty.add(el);
+        };
+
+        const scanSubtree = (root) => {
+            if (!root || root.nodeType !== 1) return;
+            if (root.matches(SELECTORS)) track(root);
+            root.querySelectorAll(SELECTORS).forEach(track);
+        };
+
+        // Mark every tracked element whose text/label may depend on this node
+        const markOwners = (node) => {
+            let el = node.nodeType === 1 ? node : node.parentElement;
+            while (el && (el = el.closest(SELECTORS))) {
+                if (tracked.has(el)) dirty.add(el);
+                el = el.parentElement;
+            }
+        };
+
+        // Style-affecting attribute changes can hide or reveal a whole subtree
+        const markSubtree = (el) => {
+            if (tracked.has(el)) dirty.add(el);
+            el.querySelectorAll(SELECTORS).forEach(child => {
+                if (tracked.has(child)) dirty.add(child);
+            });
+        };
+
+        const observe = (doc) => {
+            if (!doc || !doc.documentElement || observedDocs.has(doc)) return;
+            observedDocs.add(doc);
+            scanSubtree(doc.documentElement);
+            layoutDirty = true;
+
+            new MutationObserver(records => {
+                for (const record of records) {
+                    if (isOverlay(record.target)) continue;
+                    if (record.type === 'childList') {
+                        record.addedNodes.forEach(scanSubtree);
+                        if (record.removedNodes.length) needsPrune = true;
+                        markOwners(record.target);
+                        layoutDirty = true;
+                    } else if (record.type === 'attributes') {
+                        if (['data-element-id', 'data-snapshot-id'].includes(record.attributeName)) continue;
+                        const target = record.target;
+                        if (target.matches(SELECTORS)) track(target);
+                        if (['class', 'style', 'hidden'].includes(record.attributeName)) {
+                            markSubtree(target);
+                            layoutDirty = true;
+                        }
+                        markOwners(target);
+                    } else {
+                        markOwners(record.target);
+                    }
+                }
+            }).observe(doc.documentElement, {
+                subtree: true, childList: true, attributes: true, characterData: true
+            });
+
+            const win = doc.defaultView;
+            if (win) {
+                win.addEventListener('scroll', () => { layoutDirty = true; }, true);
+                win.addEventListener('resize', () => { layoutDirty = true; });
+            }
+        };
+
+        // Viewport offset of a document plus its iframe index path ('' for the main document)
+        const frameInfoFor = (doc, cache) => {
+            if (cache.has(doc)) return cache.get(doc);
+            let info = {x: 0, y: 0, path: ''};
+            const frame = doc !== document && doc.defaultView ? doc.defaultView.frameElement : null;
+            if (frame) {
+                const rect = frame.getBoundingClientRect();
+                const parent = frameInfoFor(frame.ownerDocument, cache);
+                const index = Array.from(frame.ownerDocument.querySelectorAll('iframe')).indexOf(frame);
+                info = {
+                    x: rect.x + parent.x,
+                    y: rect.y + parent.y,
+                    path: parent.path ? parent.path + '/' + index : String(index)
+                };
+            }
+            cache.set(doc, info);
+            return info;
+        };
+
+        // cyrb53 - 53-bit string hash, exact as a JS number and a Python int
+        const cyrb53 = (str) => {
+            let h1 = 0xdeadbeef, h2 = 0x41c6ce57;
+            for (let i = 0; i < str.length; i++) {
+                const ch = str.charCodeAt(i);
+                h1 = Math.imul(h1 ^ ch, 2654435761);
+                h2 = Math.imul(h2 ^ ch, 1597334677);
+            }
+            h1 = Math.imul(h1 ^ (h1 >>> 16), 2246822507);
+            h1 ^= Math.imul(h2 ^ (h2 >>> 13), 3266489909);
+            h2 = Math.imul(h2 ^ (h2 >>> 16), 2246822507);
+            h2 ^= Math.imul(h1 ^ (h1 >>> 13), 3266489909);
+            return 4294967296 * (2097151 & h2) + (h1 >>> 0);
+        };
+
+        const nthOfType = (node) => {
+            const parent = node.parentNode;
+            if (!parent || !parent.children) return 1;
+            let indexes = siblingCache.get(parent);
+            if (!indexes) {
+                indexes = new Map();
+                const counts = new Map();
+                for (const child of parent.children) {
+                    const count = (counts.get(child.tagName) || 0) + 1;
+                    counts.set(child.tagName, count);
+                    indexes.set(child, count);
+                }
+                siblingCache.set(parent, indexes);
+            }
+            return indexes.get(node) || 1;
+        };
+
+        // tag:nth-of-type chain up to the root, continuing through iframe hosts
+        const domPath = (el) => {
+            const parts = [];
+            let node = el;
+            while (node) {
+                parts.push(node.tagName.toLowerCase() + ':' + nthOfType(node));
+                const win = node.ownerDocument.defaultView;
+                node = node.parentElement || (win ? win.frameElement : null);
+            }
+            return parts.reverse().join('>');
+        };
+
+        const fingerprintOf = (el, info) => cyrb53([
+            info.tagName,
+            info.label.toLowerCase().replace(/\\d+/g, '#').replace(/\\s+/g, ' ').trim().substring(0, 64),
+            info.attributes.id, info.attributes.name, info.attributes.type, info.attributes.role,
+            el.getAttribute('href') || '',
+            domPath(el)
+        ].join('|'));
+
+        // Assign (or re-use) the element's id and register its fingerprint
+        const identify = (el, record) => {
+            const fp = fingerprintOf(el, record.entry);
+            if (record.id === null) {
+                // A re-rendered node inherits the id of the node it replaced
+                const previousId = idByFingerprint.get(fp);
+                const owner = previousId !== undefined ? byId.get(previousId) : null;
+                record.id = previousId !== undefined && (!owner || !owner.isConnected) ? previousId : nextId++;
+                byId.set(record.id, el);
+                el.setAttribute('data-element-id', record.id);
+            }
+            if (record.fp !== fp) {
+                if (record.fp !== null && byFingerprint.get(record.fp) === el) byFingerprint.delete(record.fp);
+                record.fp = fp;
+            }
+            byFingerprint.set(fp, el);
+            idByFingerprint.set(fp, record.id);
+        };
+
+        const refresh = (el, record) => {
+            record.entry = extract(el, el.ownerDocument);
+            identify(el, record);
+        };
+
+        const extract = (el, doc) => {
+            const style = doc.defaultView.getComputedStyle(el);
+            const tagName = el.tagName.toLowerCase();
+            const elementType = el.type || 'unknown';
+
+            // Fast text extraction with fallbacks
+            let label = '';
+            if (el.textContent && el.textContent.trim()) {
+                label = el.textContent.trim();
+            } else if (el.getAttribute('aria-label')) {
+                label = el.getAttribute('aria-label');
+            } else if (el.getAttribute('placeholder')) {
+                label = el.getAttribute('placeholder');
+            } else if (el.getAttribute('title')) {
+                label = el.getAttribute('title');
+            } else if (el.getAttribute('alt')) {
+                label = el.getAttribute('alt');
+            } else if (el.getAttribute('value')) {
+                label = el.getAttribute('value');
+            } else {
+                label = tagName;
+            }
+
+            return {
+                tagName: tagName,
+                label: label.substring(0, 100).replace(/\\s+/g, ' '),
+                elementType: elementType,
+                styleHidden: style.visibility === 'hidden' || style.display === 'none',
+                isFile: tagName === 'input' && elementType === 'file',
+                hasOnclick: !!(el.onclick || el.getAttribute('onclick')),
+                isClickable: !!(tagName === 'button' || tagName === 'a' ||
+                           el.onclick || el.getAttribute('onclick') ||
+                           el.getAttribute('role') === 'button'),
+                isFormField: ['input', 'textarea', 'select'].includes(tagName),
+                attributes: {
+                    id: el.id || '',
+                    class: typeof el.className === 'string' ? el.className : '',
+                    name: el.name || '',
+                    type: el.type || '',
+                    role: el.getAttribute('role') || ''
+                },
+                textContent: el.textContent ? el.textContent.substring(0, 100) : '',
+            };
+        };
+
+        const measure = (el, record, frames) => {
+            const doc = el.ownerDocument;
+            if (dirty.has(el) || !record.entry) refresh(el, record);
+            const info = record.entry;
+            const rect = el.getBoundingClientRect();
+            const offset = frameInfoFor(doc, frames);
+            const x = rect.x + offset.x, y = rect.y + offset.y;
+            const right = x + rect.width, bottom = y + rect.height;
+
+            if (info.isFile || info.styleHidden || rect.width <= 0 || rect.height <= 0 ||
+                y < -100 || x < -100 ||
+                bottom > window.innerHeight + 100 || right > window.innerWidth + 100) {
+                return null;
+            }
+
+            const isVisible = y >= 0 && x >= 0 && bottom <= window.innerHeight && right <= window.innerWidth;
+
+            // Fast confidence calculation
+            let confidence = 0.5;
+            if (isVisible) confidence += 0.2;
+            if (info.hasOnclick) confidence += 0.1;
+            if (info.tagName === 'button' || info.tagName === 'a') confidence += 0.1;
+            if (info.attributes.role) confidence += 0.1;
+
+            // Handle-free row; the WebElement is resolved lazily by data-element-id
+            return {
+                id: record.id,
+                info: info,
+                isVisible: isVisible,
+                rect: [Math.round(x), Math.round(y), Math.round(rect.width), Math.round(rect.height)],
+                confidence: Math.round(Math.min(confidence, 1.0) * 100) / 100,
+                framePath: offset.path
+            };
+        };
+
+        const prune = (removed) => {
+            for (const [el, record] of tracked) {
+                if (el.isConnected) continue;
+                tracked.delete(el);
+                dirty.delete(el);
+                if (record.fp !== null && byFingerprint.get(record.fp) === el) byFingerprint.delete(record.fp);
+                // The id may already belong to the node that replaced this one
+                if (byId.get(record.id) === el) {
+                    byId.delete(record.id);
+                    if (record.emitted) removed.push(record.id);
+                }
+            }
+            if (idByFingerprint.size > 2 * tracked.size + 1000) {
+                idByFingerprint.clear();
+                for (const record of tracked.values()) {
+                    if (record.fp !== null) idByFingerprint.set(record.fp, record.id);
+                }
+            }
+        };
+
+        window.__aiElementIndex = {
+            collect(full) {
+                if (full) {
+                    // Python side lost its mirror - re-emit every entry
+                    fresh = true;
+                    layoutDirty = true;
+                    for (const record of tracked.values()) {
+                        record.sig = null;
+                        record.emitted = false;
+                    }
+                }
+
+                // Same-origin iframes may have loaded (or reloaded) since the last step
+                observe(document);
+                document.querySelectorAll('iframe').forEach(iframe => {
+                    try {
+                        observe(iframe.contentDocument);
+                    } catch (e) {
+                        // Skip cross-origin iframes
+                    }
+                });
+
+                const reset = fresh;
+                fresh = false;
+                const removed = [];
+                // Columnar payload - parallel arrays, rects flattened as x, y, w, h
+                const columns = {
+                    ids: [], fingerprints: [], tags: [], labels: [], types: [], rects: [], flags: [],
+                    confidence: [], attributes: [], text: [], frames: []
+                };
+
+                if (needsPrune) {
+                    prune(removed);
+                    needsPrune = false;
+                }
+                siblingCache = new Map();
+
+                const frames = new Map();
+                const candidates = layoutDirty ? Array.from(tracked.keys()) : Array.from(dirty);
+                for (const el of candidates) {
+                    const record = tracked.get(el);
+                    if (!record) continue;
+                    try {
+                        const entry = measure(el, record, frames);
+                        if (entry) {
+                            const info = entry.info;
+                            const sig = [record.fp, info.label, entry.isVisible, info.isClickable, entry.rect.join(',')].join('|');
+                            if (sig !== record.sig) {
+                                record.sig = sig;
+                                record.emitted = true;
+                                const attrs = info.attributes;
+                                columns.ids.push(entry.id);
+                                columns.fingerprints.push(record.fp);
+                                columns.tags.push(info.tagName);
+                                columns.labels.push(info.label);
+                                columns.types.push(info.elementType);
+                                columns.rects.push(...entry.rect);
+                                columns.flags.push((entry.isVisible ? 1 : 0) | (info.isClickable ? 2 : 0) |
+                                                   (info.isFormField ? 4 : 0) | (entry.framePath ? 8 : 0));
+                                columns.confidence.push(entry.confidence);
+                                columns.attributes.push([attrs.id, attrs.class, attrs.name, attrs.type, attrs.role]);
+                                // Text is only shipped when it differs from the label
+                                columns.text.push(info.textContent.replace(/\\s+/g, ' ').trim() === info.label ? null : info.textContent);
+                                columns.frames.push(entry.framePath);
+                            }
+                        } else if (record.emitted) {
+                            record.sig = null;
+                            record.emitted = false;
+                            removed.push(record.id);
+                        }
+                    } catch (e) {
+                        // Skip errors for speed
+                    }
+                }
+
+                dirty.clear();
+                layoutDirty = false;
+                return {reset: reset, columns: columns, removed: removed, tracked: tracked.size};
+            },
+
+            // Targeted re-resolution of a stale reference by fingerprint
+            resolve(fp) {
+                let el = byFingerprint.get(fp);
+                if (!el || !el.isConnected) {
+                    // Likely re-rendered: fingerprint the nodes added since the last collect
+                    siblingCache = new Map();
+                    for (const candidate of dirty) {
+                        const record = tracked.get(candidate);
+                        if (record && candidate.isConnected) {
+                            try {
+                                refresh(candidate, record);
+                            } catch (e) {
+                                // Skip errors for speed
+                            }
+                        }
+                    }
+                    el = byFingerprint.get(fp);
+                }
+                if (!el || !el.isConnected) return null;
+                const framePath = frameInfoFor(el.ownerDocument, new Map()).path;
+                // Main-document elements come back as a handle in this same round-trip
+                return {id: tracked.get(el).id, framePath: framePath, element: framePath ? null : el};
+            }
+        };
+    }
+    return window.__aiElementIndex.collect(arguments[0]);
+    '''
+
+    RESOLVE_SCRIPT = 'return window.__aiElementIndex ? window.__aiElementIndex.resolve(arguments[0]) : null;'
+
+    def __init__(self, driver):
+        self.driver = driver
+        self.table = ElementTable.empty()
+        self.last_delta: Dict[str, int] = {}
+        self._needs_full = True
+
+    def collect(self) -> ElementTable:
+        """Apply the latest in-page delta and return the table of every indexed element."""
+        delta = self.driver.execute_script(self.INDEX_SCRIPT, self._needs_full) or {}
+        self._needs_full = False
+
+        if delta.get('reset'):
+            self.table = ElementTable.empty()
+        upserts = ElementTable.from_columns(delta.get('columns') or {})
+        removed = delta.get('removed', [])
+        self.table = self.table.apply_delta(removed, upserts)
+
+        self.last_delta = {
+            'reset': bool(delta.get('reset')),
+            'upserts': len(upserts),
+            'removed': len(removed),
+            'tracked': delta.get('tracked', 0)
+        }
+        return self.table
+
+    def resolve(self, fingerprint: int) -> Optional[Dict[str, Any]]:
+        """Look up the live element for a fingerprint: {id, framePath, element}, or None."""
+        try:
+            return self.driver.execute_script(self.RESOLVE_SCRIPT, fingerprint)
+        except Exception as e:
+            logger.warning(f"Fingerprint lookup failed: {e}")
+            return None
+
+    def reset(self):
+        """Forget the mirrored entries so the next collect starts from scratch."""
+        self.table = ElementTable.empty()
+        self._needs_full = True
+
+class DOMSnapshotElementScanner:
+    """Element scanner built on the CDP DOMSnapshot.captureSnapshot command.
+
+    A single protocol call returns the flattened DOM, layout bounds, computed
+    display/visibility and text for the whole frame tree - including shadow
+    roots and same-process cross-origin iframes that page JavaScript cannot
+    reach. Out-of-process iframes (site isolation) belong to separate CDP
+    targets and are not part of the snapshot.
+
+    The result fills the same ElementTable as IncrementalElementIndex, with
+    matching fingerprints and stable ids. Scanning writes nothing to the page;
+    the id attribute is set through DOM.resolveNode only when an action
+    targets an element. It uses its own attribute so ids never collide with
+    an in-page index left on the same page.
+    """
+
+    ID_ATTRIBUTE = 'data-snapshot-id'
+
+    COMPUTED_STYLES = ['display', 'visibility']
+    CANDIDATE_TAGS = frozenset({'a', 'button', 'input', 'textarea', 'select', 'form',
+                                'label', 'option', 'summary', 'details'})
+    CANDIDATE_ATTRIBUTES = frozenset({'onclick', 'href', 'src', 'data-testid', 'data-cy'})
+    CLASS_HINT = re.compile(r'(?:^|\s)(?:btn|button|link|clickable)(?:\s|$)')
+    OVERLAY_IDS = frozenset({'ai-cursor', 'ai-analysis-bubble', 'ai-status-bar', 'ai-progress-ring'})
+    OVERLAY_ID_PREFIXES = ('ai-chat-bubble-', 'ai-typing-', 'ai-avatar-')
+    TYPE_DEFAULTS = {'input': 'text', 'button': 'submit', 'textarea': 'textarea'}
+    TAG_FUNCTION = ("function(id) { if (!this.isConnected) return false; "
+                    "this.setAttribute('data-snapshot-id', id); return true; }")
+
+    def __init__(self, driver):
+        self.driver = driver
+        self.table = ElementTable.empty()
+        self.last_delta: Dict[str, int] = {}
+        self._next_id = 1
+        self._ids_by_fingerprint: Dict[int, int] = {}
+        self._backend_nodes: Dict[int, int] = {}
+
+    @staticmethod
+    def fingerprint(key: str) -> int:
+        """cyrb53 over UTF-16 code units - identical to the in-page index's hash."""
+        h1, h2 = 0xdeadbeef, 0x41c6ce57
+        units = key.encode('utf-16-le')
+        for i in range(0, len(units), 2):
+            ch = units[i] | (units[i + 1] << 8)
+            h1 = ((h1 ^ ch) * 2654435761) & 0xFFFFFFFF
+            h2 = ((h2 ^ ch) * 1597334677) & 0xFFFFFFFF
+        h1 = ((h1 ^ (h1 >> 16)) * 2246822507) & 0xFFFFFFFF
+        h1 ^= ((h2 ^ (h2 >> 13)) * 3266489909) & 0xFFFFFFFF
+        h2 = ((h2 ^ (h2 >> 16)) * 2246822507) & 0xFFFFFFFF
+        h2 ^= ((h1 ^ (h1 >> 13)) * 3266489909) & 0xFFFFFFFF
+        return 4294967296 * (2097151 & h2) + h1
+
+    def collect(self) -> ElementTable:
+        """Capture a snapshot of the frame tree and return the table of interactive elements."""
+        snapshot = self.driver.execute_cdp_cmd('DOMSnapshot.captureSnapshot', {
+            'computedStyles': self.COMPUTED_STYLES
+        })
+        viewport = self.driver.execute_cdp_cmd('Page.getLayoutMetrics', {})['cssLayoutViewport']
+        columns = {name: [] for name in ('ids', 'fingerprints', 'tags', 'labels', 'types', 'rects', 'flags',
+                                         'confidence', 'attributes', 'text', 'frames')}
+        self._backend_nodes = {}
+        candidates = 0
+
+        # Walk the frame tree from the main document: (document, viewport origin, frame path, host DOM path)
+        documents = snapshot.get('documents', [])
+        pending = [(0, 0.0, 0.0, '', '')] if documents else []
+        while pending:
+            doc_index, origin_x, origin_y, frame_path, host_path = pending.pop(0)
+            candidates += self._scan_document(snapshot, doc_index, origin_x, origin_y, frame_path,
+                                              host_path, viewport, columns, pending)
+
+        # Stable ids: an element keeps the id last seen with its fingerprint
+        used = set()
+        for fingerprint in columns['fingerprints']:
+            element_id = self._ids_by_fingerprint.get(fingerprint)
+            if element_id is None or element_id in used:
+                element_id = self._next_id
+                self._next_id += 1
+                self._ids_by_fingerprint[fingerprint] = element_id
+            used.add(element_id)
+            columns['ids'].append(element_id)
+        if len(self._ids_by_fingerprint) > 2 * len(used) + 1000:
+            self._ids_by_fingerprint = dict(zip(columns['fingerprints'], columns['ids']))
+
+        handles = self.table.handles
+        self.table = ElementTable.from_columns(columns)
+        live = set(columns['fingerprints'])
+        self.table.handles.update((fp, handle) for fp, handle in handles.items() if fp in live)
+
+        self.last_delta = {
+            'reset': True,
+            'upserts': len(self.table),
+            'removed': 0,
+            'tracked': candidates,
+            'documents': len(documents)
+        }
+        return self.table
+
+    def _scan_document(self, snapshot: Dict, doc_index: int, origin_x: float, origin_y: float,
+                       frame_path: str, host_path: str, viewport: Dict, columns: Dict[str, List],
+                       pending: List) -> int:
+        strings = snapshot['strings']
+        document = snapshot['documents'][doc_index]
+        nodes = document['nodes']
+        layout = document['layout']
+        parents = nodes['parentIndex']
+        node_types = nodes['nodeType']
+        node_names = nodes['nodeName']
+        count = len(parents)
+
+        layout_rows = np.full(count, -1, dtype=np.int64)
+        layout_rows[np.asarray(layout['nodeIndex'], dtype=np.int64)] = np.arange(len(layout['nodeIndex']))
+        listener_clickable = np.zeros(count, dtype=bool)
+        listener_clickable[np.asarray(nodes.get('isClickable', {}).get('index', []), dtype=np.int64)] = True
+        pseudo = set(nodes.get('pseudoType', {}).get('index', []))
+        content_documents = nodes.get('contentDocumentIndex', {'index': [], 'value': []})
+        child_documents = dict(zip(content_documents['index'], content_documents['value']))
+        scroll_x = document.get('scrollOffsetX', 0)
+        scroll_y = document.get('scrollOffsetY', 0)
+
+        # One pass over the flattened tree: tags, attributes, nth-of-type, candidates and overlay roots
+        tags = [''] * count
+        attributes: Dict[int, Dict[str, str]] = {}
+        nth_of_type = [1] * count
+        sibling_counts: Dict[Tuple[int, int], int] = {}
+        is_candidate = np.zeros(count, dtype=bool)
+        overlay = np.zeros(count, dtype=bool)
+        iframe_nodes = []
+        for node in range(count):
+            if node_types[node] != 1 or node in pseudo:
+                continue
+            tag = strings[node_names[node]].lower()
+            tags[node] = tag
+            key = (parents[node], node_names[node])
+            nth_of_type[node] = sibling_counts[key] = sibling_counts.get(key, 0) + 1
+            raw = nodes['attributes'][node]
+            attrs = {strings[raw[i]]: strings[raw[i + 1]] for i in range(0, len(raw) - 1, 2)} if raw else {}
+            attributes[node] = attrs
+            if tag == 'iframe':
+                iframe_nodes.append(node)
+            element_id = attrs.get('id', '')
+            if element_id in self.OVERLAY_IDS or element_id.startswith(self.OVERLAY_ID_PREFIXES):
+                overlay[node] = True
+            is_candidate[node] = (
+                tag in self.CANDIDATE_TAGS or
+                not self.CANDIDATE_ATTRIBUTES.isdisjoint(attrs) or
+                attrs.get('role') in ('button', 'link') or
+                attrs.get('contenteditable') == 'true' or
+                ('tabindex' in attrs and attrs['tabindex'] != '-1') or
+                bool(self.CLASS_HINT.search(attrs.get('class', '')))
+            )
+
+        # Overlay flags cover whole subtrees - propagate by pointer jumping
+        if overlay.any():
+            ancestors = np.asarray(parents, dtype=np.int64)
+            while True:
+                valid = np.flatnonzero(ancestors >= 0)
+                if not len(valid):
+                    break
+                overlay[valid] |= overlay[ancestors[valid]]
+                ancestors[valid] = ancestors[ancestors[valid]]
+
+        # Nodes are in pre-order, so every subtree is the contiguous range [node, subtree_end)
+        subtree_end = list(range(1, count + 1))
+        for node in range(count - 1, 0, -1):
+            parent = parents[node]
+            if parent >= 0 and subtree_end[node] > subtree_end[parent]:
+                subtree_end[parent] = subtree_end[node]
+        text_nodes = np.flatnonzero(np.asarray(node_types) == 3)
+        node_values = nodes['nodeValue']
+
+        dom_paths: Dict[int, str] = {}
+
+        def dom_path(node: int) -> str:
+            if node not in dom_paths:
+                parent = parents[node]
+                prefix = dom_path(parent) if parent >= 0 and node_types[parent] == 1 else host_path
+                segment = f"{tags[node]}:{nth_of_type[node]}"
+                dom_paths[node] = f"{prefix}>{segment}" if prefix else segment
+            return dom_paths[node]
+
+        def text_content(node: int, limit: int = 100) -> str:
+            lo, hi = np.searchsorted(text_nodes, [node, subtree_end[node]])
+            parts, size = [], 0
+            for text_node in text_nodes[lo:hi]:
+                value = strings[node_values[text_node]] if node_values[text_node] >= 0 else ''
+                parts.append(value)
+                size += len(value)
+                # Leave room for leading whitespace that the label trims away
+                if size > 4 * limit:
+                    break
+            return ''.join(parts)
+
+        # Queue child documents with their viewport origin and iframe index path
+        for position, node in enumerate(iframe_nodes):
+            child = child_documents.get(node)
+            row = layout_rows[node]
+            if child is None or row < 0:
+                continue
+            x, y = layout['bounds'][row][:2]
+            pending.append((child, origin_x + x - scroll_x, origin_y + y - scroll_y,
+                            f"{frame_path}/{position}" if frame_path else str(position), dom_path(node)))
+
+        view_width, view_height = viewport['clientWidth'], viewport['clientHeight']
+        candidates = np.flatnonzero(is_candidate & ~overlay & (layout_rows >= 0))
+        for node in candidates.tolist():
+            row = layout_rows[node]
+            tag = tags[node]
+            attrs = attributes[node]
+            display, visibility = (strings[i] if i >= 0 else '' for i in layout['styles'][row][:2])
+            element_type = attrs.get('type', '').lower() or self.TYPE_DEFAULTS.get(tag, '')
+            if tag == 'select':
+                element_type = 'select-multiple' if 'multiple' in attrs else 'select-one'
+            bx, by, width, height = layout['bounds'][row]
+            x, y = bx - scroll_x + origin_x, by - scroll_y + origin_y
+            right, bottom = x + width, y + height
+
+            if ((tag == 'input' and element_type == 'file') or visibility == 'hidden' or display == 'none' or
+                    width <= 0 or height <= 0 or y < -100 or x < -100 or
+                    bottom > view_height + 100 or right > view_width + 100):
+                continue
+
+            is_visible = x >= 0 and y >= 0 and bottom <= view_height and right <= view_width
+            content = text_content(node)
+            label = content.strip()
+            if not label:
+                label = next((attrs[name] for name in ('aria-label', 'placeholder', 'title', 'alt', 'value')
+                              if attrs.get(name)), tag)
+            label = re.sub(r'\s+', ' ', label[:100])
+            has_onclick = 'onclick' in attrs or (bool(listener_clickable[node]) and tag not in ('a', 'button'))
+            is_clickable = tag in ('button', 'a') or has_onclick or attrs.get('role') == 'button'
+            is_form_field = tag in ('input', 'textarea', 'select')
+            role = attrs.get('role', '')
+
+            confidence = 0.5 + (0.2 if is_visible else 0) + (0.1 if has_onclick else 0)
+            confidence += (0.1 if tag in ('button', 'a') else 0) + (0.1 if role else 0)
+
+            fingerprint = self.fingerprint('|'.join([
+                tag,
+                re.sub(r'\s+', ' ', re.sub(r'\d+', '#', label.lower(), flags=re.ASCII)).strip()[:64],
+                attrs.get('id', ''), attrs.get('name', ''), element_type, role,
+                attrs.get('href', ''),
+                dom_path(node)
+            ]))
+            self._backend_nodes[fingerprint] = nodes['backendNodeId'][node]
+
+            text = content[:100]
+            columns['fingerprints'].append(fingerprint)
+            columns['tags'].append(tag)
+            columns['labels'].append(label)
+            columns['types'].append(element_type or 'unknown')
+            columns['rects'].extend([round(x), round(y), round(width), round(height)])
+            columns['flags'].append((1 if is_visible else 0) | (2 if is_clickable else 0) |
+                                    (4 if is_form_field else 0) | (8 if frame_path else 0))
+            columns['confidence'].append(round(min(confidence, 1.0), 2))
+            columns['attributes'].append([attrs.get('id', ''), attrs.get('class', ''), attrs.get('name', ''),
+                                          element_type, role])
+            columns['text'].append(None if re.sub(r'\s+', ' ', text).strip() == label else text)
+            columns['frames'].append(frame_path)
+        return len(candidates)
+
+    def resolve(self, fingerprint: int) -> Optional[Dict[str, Any]]:
+        """Tag the live node for a fingerprint with its id attribute: {id, framePath, element}, or None.
+
+        Uses the backend node id from the last snapshot; if that node is gone,
+        one fresh snapshot is taken and the fingerprint looked up again.
+        """
+        for attempt in range(2):
+            if attempt:
+                self.collect()
+            info = self.table.find_by_fingerprint(fingerprint)
+            backend_node_id = self._backend_nodes.get(fingerprint)
+            if info is None or backend_node_id is None:
+                continue
+            try:
+                remote = self.driver.execute_cdp_cmd('DOM.resolveNode', {'backendNodeId': backend_node_id})
+                object_id = remote['object']['objectId']
+                tagged = self.driver.execute_cdp_cmd('Runtime.callFunctionOn', {
+                    'objectId': object_id,
+                    'functionDeclaration': self.TAG_FUNCTION,
+                    'arguments': [{'value': info.id}],
+                    'returnByValue': True
+                })
+                self.driver.execute_cdp_cmd('Runtime.releaseObject', {'objectId': object_id})
+                # Detached nodes still resolve - a re-rendered element needs a fresh snapshot
+                if tagged.get('result', {}).get('value'):
+                    return {'id': info.id, 'framePath': info.frame_path, 'element': None}
+            except Exception as e:
+                logger.warning(f"Could not resolve backend node {backend_node_id}: {e}")
+        return None
+
+    def reset(self):
+        """Forget the last snapshot; the next collect starts from scratch."""
+        self.table = ElementTable.empty()
+        self._backend_nodes = {}
+
+class PageStateTracker:
+    """Cheap structural key of the current page.
+
+    A small in-page MutationObserver folds every non-overlay mutation (type,
+    target tag, attribute name, added/removed counts) into a rolling FNV-1a
+    hash and counts input events, which change form state without touching
+    the DOM. The key combines that hash with the URL, element count, scroll
+    position, viewport size and a per-document token, so an unchanged key
+    means detected elements and the annotated screenshot can be reused.
+    Same-origin iframes are not observed.
+    """
+
+    STATE_SCRIPT = '''
+    if (!window.__aiPageState) {
+        const OVERLAY_SELECTORS = '#ai-cursor, #ai-analysis-bubble, #ai-status-bar, #ai-progress-ring, ' +
+            '[id^="ai-chat-bubble-"], [id^="ai-typing-"], [id^="ai-avatar-"]';
+        const IGNORED_ATTRIBUTES = ['data-element-id', 'data-snapshot-id'];
+        const token = Math.random().toString(36).slice(2, 10);
+        let hash = 0x811c9dc5;
+        let inputs = 0;
+
+        const mix = (text) => {
+            for (let i = 0; i < text.length; i++) hash = Math.imul(hash ^ text.charCodeAt(i), 16777619);
+        };
+        const isOverlay = (node) => {
+            const el = node.nodeType === 1 ? node : node.parentElement;
+            return !!(el && el.closest && el.closest(OVERLAY_SELECTORS));
+        };
+
+        new MutationObserver(records => {
+            for (const record of records) {
+                if (isOverlay(record.target)) continue;
+                if (record.type === 'attributes' && IGNORED_ATTRIBUTES.includes(record.attributeName)) continue;
+                if (record.type === 'childList') {
+                    const changed = [...record.addedNodes, ...record.removedNodes];
+                    if (changed.length && changed.every(isOverlay)) continue;
+                }
+                mix(record.type + record.target.nodeName + (record.attributeName || '') +
+                    record.addedNodes.length + ':' + record.removedNodes.length);
+            }
+        }).observe(document.documentElement, {
+            subtree: true, childList: true, attributes: true, characterData: true
+        });
+        document.addEventListener('input', () => { inputs++; }, true);
+        document.addEventListener('change', () => { inputs++; }, true);
+
+        window.__aiPageState = () => {
+            const overlayNodes = document.querySelectorAll(OVERLAY_SELECTORS + ', ' +
+                OVERLAY_SELECTORS.split(', ').map(selector => selector + ' *').join(', ')).length;
+            return [token, location.href, document.getElementsByTagName('*').length - overlayNodes,
+                    hash >>> 0, inputs, Math.round(window.scrollX), Math.round(window.scrollY),
+                    window.innerWidth, window.innerHeight].join('|');
+        };
+    }
+    return window.__aiPageState();
+    '''
+
+    # Short script for the common case - the observer is already installed
+    KEY_SCRIPT = 'return window.__aiPageState ? window.__aiPageState() : null;'
+
+    def __init__(self, driver):
+        self.driver = driver
+        self.last_key: Optional[str] = None
+
+    def capture(self) -> Optional[str]:
+        """Current page-state key, or None if it could not be computed."""
+        try:
+            return self.driver.execute_script(self.KEY_SCRIPT) or self.driver.execute_script(self.STATE_SCRIPT)
+        except Exception as e:
+            logger.warning(f"Could not compute page state key: {e}")
+            return None
+
+    def is_unchanged(self, key: Optional[str]) -> bool:
+        return key is not None and key == self.last_key
+
+    def remember(self, key: Optional[str]):
+        self.last_key = key
+
+    def invalidate(self):
+        """Forget the last key, e.g. after an action with effects the key cannot see (hover, focus)."""
+        self.last_key = None
+
+class PageTextView:
+    """Compact text rendering of the viewport for decisions without a screenshot.
+    
+    One script call collects the visible text blocks (headings, paragraphs,
+    list items, cells, labels) in document order and measures how much of
+    the viewport is covered by canvas, video, image and other media. The
+    screenshot_reason() heuristic decides when the text is not enough.
+    """
+    
+    TEXT_SCRIPT = '''
+    const maxBlocks = arguments[0], maxChars = arguments[1];
+    const OVERLAY_SELECTORS = '#ai-cursor, #ai-analysis-bubble, #ai-status-bar, #ai-progress-ring, ' +
+        '[id^="ai-chat-bubble-"], [id^="ai-typing-"], [id^="ai-avatar-"]';
+    const BLOCKS = 'h1,h2,h3,h4,h5,h6,p,li,td,th,dt,dd,label,figcaption,blockquote,pre,caption,summary,legend';
+    const vw = window.innerWidth, vh = window.innerHeight;
+    const visibleArea = (r) => Math.max(0, Math.min(r.right, vw) - Math.max(r.left, 0)) *
+                               Math.max(0, Math.min(r.bottom, vh) - Math.max(r.top, 0));
+    const blocks = [], seen = new Set();
+    for (const el of document.querySelectorAll(BLOCKS)) {
+        if (blocks.length >= maxBlocks) break;
+        if (el.closest(OVERLAY_SELECTORS) || el.querySelector(BLOCKS)) continue;  // innermost blocks only
+        if (!visibleArea(el.getBoundingClientRect())) continue;
+        const text = (el.innerText || '').replace(/\\s+/g, ' ').trim();
+        if (text.length < 2 || seen.has(text)) continue;
+        seen.add(text);
+        blocks.push([el.tagName.toLowerCase(), text.substring(0, maxChars)]);
+    }
+    let media = 0, canvases = 0;
+    for (const el of document.querySelectorAll('canvas, video, img, svg, iframe, embed, object')) {
+        if (el.closest(OVERLAY_SELECTORS) || (el.parentElement && el.parentElement.closest('svg'))) continue;
+        const area = visibleArea(el.getBoundingClientRect());
+        if (area < 2500) continue;  // icons
+        media += area;
+        if (el.tagName === 'CANVAS') canvases++;
+    }
+    return {blocks: blocks, media_ratio: Math.min(1, media / Math.max(1, vw * vh)), canvases: canvases};
+    '''
+    
+    def __init__(self, driver, max_blocks: int = 40, block_chars: int = 160, min_label_coverage: float = 0.7,
+                 max_media_ratio: float = 0.35):
+        self.driver = driver
+        self.max_blocks = max_blocks
+        self.block_chars = block_chars
+        self.min_label_coverage = min_label_coverage
+        self.max_media_ratio = max_media_ratio
+    
+    def capture(self) -> Optional[Dict]:
+        """Visible text blocks and media coverage, or None if the script failed."""
+        try:
+            return self.driver.execute_script(self.TEXT_SCRIPT, self.max_blocks, self.block_chars)
+        except Exception as e:
+            logger.warning(f"Could not read page text: {e}")
+            return None
+    
+    def screenshot_reason(self, view: Optional[Dict], elements: ElementTable, recent_failure: bool) -> Optional[str]:
+        """Why the screenshot is needed for this decision, or None if text is enough."""
+        if view is None:
+            return "page text unavailable"
+        if recent_failure:
+            return "previous action failed"
+        if view['canvases'] or view['media_ratio'] > self.max_media_ratio:
+            return f"canvas/media-heavy page ({view['media_ratio']:.0%} of the viewport)"
+        if not view['blocks'] and len(elements) < 3:
+            return "too little text"
+        if len(elements):
+            labeled = sum(len(label.strip()) >= 2 for label in elements.labels)
+            if labeled / len(elements) < self.min_label_coverage:
+                return f"unlabeled elements ({labeled}/{len(elements)} labeled)"
+        return None
+    
+    @staticmethod
+    def render(view: Optional[Dict], max_tokens: int) -> str:
+        """Text blocks as "tag: text" lines, cut off at the token budget."""
+        lines, remaining = [], max_tokens
+        for tag, text in (view or {}).get('blocks', []):
+            line = f"{tag}: {text}"
+            cost = ElementRelevanceRanker.estimate_tokens(line)
+            if cost > remaining:
+                break
+            lines.append(line)
+            remaining -= cost
+        return "\n".join(lines)
+
+class PlanVerifier:
+    """Cheap post-condition checks between the steps of a multi-action plan.
+    
+    A step's "expect" object may require url_changes (true), url_contains,
+    text_appears (visible page text) and value (the input value of the
+    step's element, or of the focused element). All checks run in one
+    script call, polled until they pass or the step timeout expires.
+    """
+    
+    CONDITION_SCRIPT = '''
+    const expect = arguments[0], idAttribute = arguments[1], elementId = arguments[2], startUrl = arguments[3];
+    const failures = [];
+    if (expect.url_changes && location.href === startUrl) failures.push('URL unchanged');
+    if (expect.url_contains && !location.href.includes(expect.url_contains))
+        failures.push('URL does not contain "' + expect.url_contains + '"');
+    if (expect.text_appears && !(document.body && document.body.innerText.includes(expect.text_appears)))
+        failures.push('"' + expect.text_appears + '" not on the page');
+    if (expect.value !== undefined && expect.value !== null) {
+        const el = elementId === null ? document.activeElement
+                                      : document.querySelector('[' + idAttribute + '="' + elementId + '"]');
+        const value = el ? (el.value !== undefined ? el.value : el.textContent) : null;
+        if (value !== String(expect.value)) failures.push('value is ' + JSON.stringify(value));
+    }
+    return failures;
+    '''
+    
+    CONDITIONS = ('url_changes', 'url_contains', 'text_appears', 'value')
+    POLL_INTERVAL = 0.1
+    
+    def __init__(self, driver, id_attribute: str, timeout: float = PLAN_STEP_TIMEOUT):
+        self.driver = driver
+        self.id_attribute = id_attribute
+        self.timeout = timeout
+    
+    @classmethod
+    def conditions(cls, step: Dict) -> Dict:
+        """The recognised conditions of a plan step's "expect" object."""
+        expect = step.get("expect") if isinstance(step, dict) else None
+        if not isinstance(expect, dict):
+            return {}
+        return {key: value for key, value in expect.items() if key in cls.CONDITIONS and value not in (None, "", False)}
+    
+    def verify(self, step: Dict, start_url: str) -> List[str]:
+        """Unmet conditions of the step (empty when all hold), waiting up to the timeout."""
+        expect = self.conditions(step)
+        if not expect:
+            return []
+        element_id = (step.get("parameters") or {}).get("id")
+        deadline = time.time() + self.timeout
+        while True:
+            try:
+                failures = self.driver.execute_script(self.CONDITION_SCRIPT, expect, self.id_attribute, element_id, start_url)
+            except Exception as e:
+                failures = [f"check failed: {e}"]  # Usually mid-navigation; try again
+            if not failures or time.time() >= deadline:
+                return failures
+            time.sleep(self.POLL_INTERVAL)
+
+class DevToolsChannel:
+    """Second DevTools websocket to the driver's page, usable from worker threads.
+    
+    Selenium drivers are not thread-safe, so background work (screenshot
+    capture, overlay updates) talks to Chrome over its own connection to
+    the page target instead. Calls are serialized on a lock; connect() must
+    run on the driver's thread and re-targets the channel after a tab switch.
+    """
+    
+    def __init__(self, driver):
+        self.driver = driver
+        self.window_handle: Optional[str] = None
+        self._ws = None
+        self._lock = threading.Lock()
+        self._ids = iter(range(1, 1 << 31))
+    
+    @staticmethod
+    def page_websocket_url(driver) -> Tuple[str, str]:
+        """(websocket URL, window handle) of the driver's current page target."""
+        address = driver.capabilities.get('goog:chromeOptions', {}).get('debuggerAddress')
+        if not address:
+            raise RuntimeError("driver exposes no DevTools debuggerAddress")
+        targets = requests.get(f"http://{address}/json", timeout=5).json()
+        pages = [target for target in targets if target.get('type') == 'page']
+        handle = driver.current_window_handle
+        current = [target for target in pages if target.get('id') == handle]
+        return (current or pages)[0]['webSocketDebuggerUrl'], handle
+    
+    @property
+    def connected(self) -> bool:
+        return self._ws is not None
+    
+    def connect(self) -> bool:
+        """Attach to the driver's current window, reusing the connection if it did not change."""
+        try:
+            if self._ws is not None and self.driver.current_window_handle == self.window_handle:
+                return True
+            url, handle = self.page_websocket_url(self.driver)
+            ws = websocket.create_connection(url, timeout=10, suppress_origin=True)
+        except Exception as e:
+            logger.debug(f"DevTools channel unavailable: {e}")
+            self.close()
+            return False
+        with self._lock:
+            previous, self._ws, self.window_handle = self._ws, ws, handle
+        if previous is not None:
+            previous.close()
+        return True
+    
+    def call(self, method: str, params: Dict = None, timeout: float = 10.0) -> Dict:
+        """Send a command and wait for its result; events arriving meanwhile are dropped."""
+        with self._lock:
+            if self._ws is None:
+                raise RuntimeError("DevTools channel is not connected")
+            message_id = next(self._ids)
+            self._ws.settimeout(timeout)
+            self._ws.send(json.dumps({'id': message_id, 'method': method, 'params': params or {}}))
+            while True:
+                message = json.loads(self._ws.recv())
+                if message.get('id') == message_id:
+                    if 'error' in message:
+                        raise RuntimeError(message['error'].get('message', message['error']))
+                    return message.get('result', {})
+    
+    def close(self):
+        with self._lock:
+            ws, self._ws = self._ws, None
+        if ws is not None:
+            try:
+                ws.close()
+            except Exception:
+                pass
+
+class OverlayUpdater:
+    """Applies visual overlay updates (status bar, progress, bubbles) off the critical path.
+    
+    Updates are keyed by overlay; a newer update replaces a pending one with
+    the same key, and a background thread evaluates whatever is pending in a
+    single Runtime.evaluate over the DevToolsChannel. Without a channel the
+    script runs synchronously through the driver as before.
+    """
+    
+    def __init__(self, driver, channel: DevToolsChannel, timer: 'StepTimer' = None):
+        self.driver = driver
+        self.channel = channel
+        self.timer = timer
+        self._pending: Dict[str, str] = {}
+        self._wake = threading.Condition()
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name="overlay-updater", daemon=True)
+        self._thread.start()
+    
+    def update(self, key: str, script: str):
+        if self._closed or not self.channel.connected:
+            self.driver.execute_script(script)
+            return
+        with self._wake:
+            self._pending.pop(key, None)  # Re-insert so updates apply in submission order
+            self._pending[key] = script
+            self._wake.notify()
+    
+    def _run(self):
+        while True:
+            with self._wake:
+                while not self._pending and not self._closed:
+                    self._wake.wait()
+                if self._closed and not self._pending:
+                    return
+                scripts, self._pending = list(self._pending.values()), {}
+            started = time.time()
+            # Each update is its own block so their const declarations do not collide
+            expression = "\n".join("try {" + script + "} catch (e) {}" for script in scripts)
+            try:
+                self.channel.call('Runtime.evaluate', {'expression': expression}, timeout=5)
+            except Exception as e:
+                logger.debug(f"Overlay update failed: {e}")
+            if self.timer is not None:
+                self.timer.record('overlay', started, time.time())
+    
+    def close(self):
+        with self._wake:
+            self._closed = True
+            self._wake.notify()
+        self._thread.join(timeout=2)
+
+class StepTimer:
+    """Wall-clock intervals of the phases of each agent step, recorded from any thread.
+    
+    Capture, annotation, overlay and persistence phases run on worker threads
+    while the main thread scans, decides and settles. The overlapped time of a
+    step is how long more than one thread was busy: the per-thread busy time
+    minus the length of the union of all intervals.
+    """
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._intervals: List[Tuple[str, float, float, str]] = []
+        self.step_started = time.time()
+        self.totals: Dict[str, float] = defaultdict(float)
+        self.steps = 0
+        self.wall_seconds = 0.0
+        self.overlap_seconds = 0.0
+    
+    def start_step(self):
+        with self._lock:
+            self._intervals = []
+            self.step_started = time.time()
+    
+    def record(self, name: str, started: float, ended: float):
+        with self._lock:
+            self._intervals.append((name, started, ended, threading.current_thread().name))
+    
+    @contextmanager
+    def phase(self, name: str):
+        started = time.time()
+        try:
+            yield
+        finally:
+            self.record(name, started, time.time())
+    
+    @staticmethod
+    def _union(intervals: List[Tuple[float, float]]) -> float:
+        total, covered_until = 0.0, float('-inf')
+        for started, ended in sorted(intervals):
+            total += max(0.0, ended - max(started, covered_until))
+            covered_until = max(covered_until, ended)
+        return total
+    
+    def finish_step(self) -> Dict[str, Any]:
+        """Log the step's wall time, per-phase seconds and overlapped seconds, and add them to the totals."""
+        with self._lock:
+            step_started, wall = self.step_started, time.time() - self.step_started
+            # Work queued in an earlier step only counts from this step's start
+            intervals = [(name, max(started, step_started), ended, thread)
+                         for name, started, ended, thread in self._intervals if ended > step_started]
+        phases: Dict[str, float] = defaultdict(float)
+        by_thread: Dict[str, List[Tuple[float, float]]] = defaultdict(list)
+        for name, started, ended, thread in intervals:
+            phases[name] += ended - started
+            by_thread[thread].append((started, ended))
+        busy = sum(self._union(spans) for spans in by_thread.values())
+        overlap = busy - self._union([span for spans in by_thread.values() for span in spans])
+        
+        self.steps += 1
+        self.wall_seconds += wall
+        self.overlap_seconds += overlap
+        for name, seconds in phases.items():
+            self.totals[name] += seconds
+        logger.info(f"⏱️ Step {self.steps}: {wall:.2f}s | " +
+                    " · ".join(f"{name} {seconds:.2f}" for name, seconds in phases.items()) +
+                    f" | {overlap:.2f}s overlapped")
+        return {'wall': wall, 'phases': dict(phases), 'overlap': overlap}
+
+class ScreenshotCapture:
+    """Viewport and region screenshots through CDP Page.captureScreenshot.
+    
+    Chrome encodes straight to the requested format, quality and scale, so
+    callers receive exactly the pixels they need instead of decoding and
+    re-encoding a full-viewport PNG. Clip rectangles are in CSS page pixels.
+    Drivers without CDP fall back to WebDriver screenshots cropped with PIL.
+    
+    send_cdp replaces driver.execute_cdp_cmd, e.g. with DevToolsChannel.call
+    for captures from worker threads; such captures raise on failure rather
+    than falling back to the (not thread-safe) driver.
+    """
+    
+    FORMATS = ('png', 'jpeg', 'webp')
+    ELEMENT_RECT_SCRIPT = """
+    const el = arguments[0];
+    el.scrollIntoView({block: 'center', inline: 'center'});
+    const r = el.getBoundingClientRect();
+    return [r.left + window.scrollX, r.top + window.scrollY, r.width, r.height];
+    """
+    
+    def __init__(self, driver, send_cdp: Callable[[str, Dict], Dict] = None):
+        self.driver = driver
+        self.send_cdp = send_cdp
+        self.cdp_available = send_cdp is not None or hasattr(driver, 'execute_cdp_cmd')
+    
+    def _cdp(self, method: str, params: Dict) -> Dict:
+        if self.send_cdp is not None:
+            return self.send_cdp(method, params)
+        return self.driver.execute_cdp_cmd(method, params)
+    
+    def capture(self, image_format: str = 'png', quality: int = None, clip: Dict[str, float] = None,
+                optimize_for_speed: bool = True) -> bytes:
+        """Capture the viewport, or the clip rectangle (x, y, width, height, optional scale)."""
+        image_format = 'jpeg' if image_format == 'jpg' else image_format
+        if image_format not in self.FORMATS:
+            raise ValueError(f"Unsupported capture format: {image_format}")
+        
+        if self.cdp_available:
+            params = {'format': image_format, 'optimizeForSpeed': optimize_for_speed}
+            if quality is not None and image_format != 'png':
+                params['quality'] = int(quality)
+            if clip:
+                params['clip'] = {'scale': 1, **clip}
+            try:
+                return base64.b64decode(self._cdp('Page.captureScreenshot', params)['data'])
+            except Exception as e:
+                if self.send_cdp is not None:
+                    raise
+                logger.warning(f"CDP screenshot failed, using WebDriver screenshot: {e}")
+        
+        return self._capture_webdriver(image_format, quality, clip)
+    
+    def capture_viewport(self, image_format: str = 'png', quality: int = None,
+                         max_edge: int = None) -> Tuple[bytes, float]:
+        """Capture the visible viewport scaled so its long edge fits max_edge.
+        
+        Returns the image bytes and the CSS-pixel-to-image scale factor.
+        """
+        if not self.cdp_available:
+            screenshot = self._capture_webdriver('png', None, None)
+            if not max_edge and image_format == 'png':
+                return screenshot, 1.0
+            image = Image.open(BytesIO(screenshot))
+            scale = min(1.0, max_edge / max(image.size)) if max_edge else 1.0
+            return self._encode(image, image_format, quality, scale), scale
+        
+        viewport = self._cdp('Page.getLayoutMetrics', {})['cssVisualViewport']
+        width, height = viewport['clientWidth'], viewport['clientHeight']
+        scale = min(1.0, max_edge / max(width, height)) if max_edge else 1.0
+        clip = {'x': viewport['pageX'], 'y': viewport['pageY'], 'width': width, 'height': height, 'scale': scale}
+        return self.capture(image_format, quality, clip), scale
+    
+    def capture_element(self, element, image_format: str = 'png', quality: int = None) -> bytes:
+        """Capture a single element, scrolling it into view first."""
+        x, y, width, height = self.driver.execute_script(self.ELEMENT_RECT_SCRIPT, element)
+        return self.capture(image_format, quality, {'x': x, 'y': y, 'width': max(width, 1), 'height': max(height, 1)})
+    
+    def _capture_webdriver(self, image_format: str, quality: Optional[int], clip: Optional[Dict[str, float]]) -> bytes:
+        screenshot = self.driver.get_screenshot_as_png()
+        if not clip and image_format == 'png':
+            return screenshot
+        image = Image.open(BytesIO(screenshot))
+        scale = 1.0
+        if clip:
+            scroll_x, scroll_y = self.driver.execute_script("return [window.scrollX, window.scrollY];")
+            left, top = clip['x'] - scroll_x, clip['y'] - scroll_y
+            image = image.crop((int(left), int(top), int(left + clip['width']), int(top + clip['height'])))
+            scale = clip.get('scale', 1)
+        return self._encode(image, image_format, quality, scale)
+    
+    @staticmethod
+    def _encode(image: Image.Image, image_format: str, quality: Optional[int], scale: float) -> bytes:
+        if scale != 1.0:
+            image = image.resize((max(1, round(image.width * scale)), max(1, round(image.height * scale))), Image.BILINEAR)
+        buffer = BytesIO()
+        if image_format == 'png':
+            image.save(buffer, format='PNG', compress_level=1)
+        else:
+            image.convert('RGB').save(buffer, format=image_format.upper(), quality=quality or 85)
+        return buffer.getvalue()
+
+@dataclass
+class ScreencastFrame:
+    """One JPEG frame pushed by Page.startScreencast."""
+    data: bytes
+    timestamp: float        # page-side capture time (epoch seconds)
+    received_at: float
+    css_width: float        # viewport size the frame shows, in CSS pixels
+    css_height: float
+    image_width: int
+    image_height: int
+    scroll_x: float
+    scroll_y: float
+
+    @property
+    def scale(self) -> float:
+        """CSS-pixel-to-image scale factor, for scaling element coordinates."""
+        return self.image_width / self.css_width if self.css_width else 1.0
+
+class ScreencastBuffer:
+    """Page.startScreencast session keeping the newest frames in memory.
+    
+    Selenium's execute_cdp_cmd cannot receive events, so the buffer opens its
+    own DevTools websocket to the driver's page target and reads frames on a
+    background thread. Chrome pushes a JPEG whenever the page repaints, so the
+    newest frame is always current without a capture round trip. Frames at
+    least SCREENCAST_MIN_INTERVAL apart are also kept in a ring of
+    SCREENCAST_BUFFER_SIZE as a visual timeline of the session.
+    """
+    
+    def __init__(self, driver, max_frames: int = None, max_edge: int = None, quality: int = None,
+                 min_interval: float = None):
+        self.driver = driver
+        self.max_edge = max_edge or SCREENSHOT_MAX_EDGE or 1920
+        self.quality = SCREENCAST_QUALITY if quality is None else quality
+        self.min_interval = SCREENCAST_MIN_INTERVAL if min_interval is None else min_interval
+        self.timeline: deque = deque(maxlen=max_frames or SCREENCAST_BUFFER_SIZE)
+        self.frame_count = 0
+        self._latest: Optional[ScreencastFrame] = None
+        self._new_frame = threading.Condition()
+        self._send_lock = threading.Lock()
+        self._ids = iter(range(1, 1 << 31))
+        self._ws = None
+        self._thread: Optional[threading.Thread] = None
+        self.window_handle: Optional[str] = None
+    
+    @property
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+    
+    def _page_websocket_url(self) -> str:
+        url, self.window_handle = DevToolsChannel.page_websocket_url(self.driver)
+        return url
+    
+    def _send(self, method: str, params: Dict = None):
+        with self._send_lock:
+            self._ws.send(json.dumps({'id': next(self._ids), 'method': method, 'params': params or {}}))
+    
+    def start(self) -> bool:
+        """Connect to the current page and start streaming frames."""
+        if self.running and self.driver.current_window_handle == self.window_handle:
+            return True
+        self.stop()
+        try:
+            self._ws = websocket.create_connection(self._page_websocket_url(), timeout=5, suppress_origin=True)
+            self._ws.settimeout(1.0)
+            self._send('Page.startScreencast', {
+                'format': 'jpeg', 'quality': self.quality,
+                'maxWidth': self.max_edge, 'maxHeight': self.max_edge, 'everyNthFrame': 1
+            })
+        except Exception as e:
+            logger.warning(f"Screencast unavailable: {e}")
+            self._ws = None
+            return False
+        self._thread = threading.Thread(target=self._run, name="screencast", daemon=True)
+        self._thread.start()
+        logger.info("🎞️ Screencast frame buffer started")
+        return True
+    
+    def stop(self):
+        """Stop streaming and close the DevTools connection."""
+        if self._ws is None:
+            return
+        ws, self._ws = self._ws, None
+        try:
+            with self._send_lock:
+                ws.send(json.dumps({'id': next(self._ids), 'method': 'Page.stopScreencast', 'params': {}}))
+            ws.close()
+        except Exception:
+            pass
+        if self._thread is not None:
+            self._thread.join(timeout=2)
+    
+    def _run(self):
+        ws = self._ws
+        while self._ws is ws:
+            try:
+                message = json.loads(ws.recv())
+            except websocket.WebSocketTimeoutException:
+                continue
+            except Exception:
+                break
+            if message.get('method') != 'Page.screencastFrame':
+                continue
+            params = message['params']
+            try:
+                self._send('Page.screencastFrameAck', {'sessionId': params['sessionId']})
+            except Exception:
+                break
+            self._add_frame(base64.b64decode(params['data']), params['metadata'])
+        logger.debug("Screencast reader stopped")
+    
+    def _add_frame(self, data: bytes, metadata: Dict):
+        now = time.time()
+        image_width, image_height = Image.open(BytesIO(data)).size
+        frame = ScreencastFrame(
+            data=data,
+            timestamp=metadata.get('timestamp', now),
+            received_at=now,
+            css_width=metadata.get('deviceWidth', image_width),
+            css_height=metadata.get('deviceHeight', image_height),
+            image_width=image_width,
+            image_height=image_height,
+            scroll_x=metadata.get('scrollOffsetX', 0.0),
+            scroll_y=metadata.get('scrollOffsetY', 0.0)
+        )
+        with self._new_frame:
+            self._latest = frame
+            self.frame_count += 1
+            if not self.timeline or frame.received_at - self.timeline[-1].received_at >= self.min_interval:
+                self.timeline.append(frame)
+            self._new_frame.notify_all()
     
-    def optimize_page_load(self):
-        """Apply optimizations to improve page load."""
-        # Disable images
-        self.driver.execute_cdp_cmd('Emulation.setUserAgentOverride', {
-            "userAgent": self.driver.execute_script("return navigator.userAgent"),
-            "acceptLanguage": "en-US,en",
-            "platform": "Win32"
-        })
-        
-        # Block unnecessary resources
-        self.driver.execute_cdp_cmd('Network.setBlockedURLs', {
-            "urls": ["*.gif", "*.png", "*.jpg", "*.jpeg", "*.css"]
-        })
-        
-        # Enable cache
-        self.driver.execute_cdp_cmd('Network.setCacheDisabled', {'cacheDisabled': False})
+    def latest(self) -> Optional[ScreencastFrame]:
+        """Newest frame, or None before the first one arrives."""
+        return self._latest
+    
+    def current_frame(self) -> Optional[ScreencastFrame]:
+        """Newest frame of the driver's current window; re-targets the screencast after a tab switch."""
+        if not self.running:
+            return None
+        try:
+            if self.driver.current_window_handle != self.window_handle:
+                self._latest = None
+                self.start()
+                return None
+        except Exception:
+            return None
+        return self._latest
+    
+    def wait_for_frame(self, newer_than: float = 0.0, timeout: float = 1.0) -> Optional[ScreencastFrame]:
+        """Block until a frame received after `newer_than` arrives; None on timeout."""
+        with self._new_frame:
+            self._new_frame.wait_for(lambda: self._latest is not None and self._latest.received_at > newer_than, timeout)
+            frame = self._latest
+        return frame if frame is not None and frame.received_at > newer_than else None
+    
+    def filmstrip(self, count: int = 12, width: int = 240) -> List[Tuple[datetime, str]]:
+        """Up to `count` evenly spaced timeline frames as (time, JPEG data URI) thumbnails."""
+        with self._new_frame:
+            frames = list(self.timeline)
+        if len(frames) > count:
+            frames = [frames[int(i)] for i in np.linspace(0, len(frames) - 1, count)]
+        strip = []
+        for frame in frames:
+            image = Image.open(BytesIO(frame.data))
+            image.draft('RGB', (width, width))
+            image.thumbnail((width, width * 4))
+            buffer = BytesIO()
+            image.convert('RGB').save(buffer, format='JPEG', quality=70)
+            strip.append((datetime.fromtimestamp(frame.received_at),
+                          f"data:image/jpeg;base64,{base64.b64encode(buffer.getvalue()).decode('ascii')}"))
+        return strip
 
-class SmartFormFiller:
-    """Intelligent form filling with AI assistance."""
+class VisualStabilityDetector:
+    """Wait until the page stops changing instead of sleeping a fixed time.
     
-    def __init__(self, driver):
+    Consecutive low-resolution grayscale frames are compared with cv2; the
+    page counts as settled once fewer than SETTLE_CHANGE_RATIO of the pixels
+    have changed for SETTLE_QUIET_PERIOD seconds, no layout shift has been
+    reported in that window, the scroll position is steady, no finite
+    animation is running and the document has finished parsing. The agent's own overlays are masked out of the
+    frames and ignored by the probe. wait() never exceeds its ceiling.
+    Frames come from a running ScreencastBuffer when one is given, otherwise
+    from a CDP capture per poll.
+    """
+    
+    PROBE_SCRIPT = '''
+    const OVERLAY_SELECTORS = '#ai-cursor, #ai-analysis-bubble, #ai-status-bar, #ai-progress-ring, ' +
+        '[id^="ai-chat-bubble-"], [id^="ai-typing-"], [id^="ai-avatar-"]';
+    if (!window.__aiSettle) {
+        const state = window.__aiSettle = {lastShift: -1e9};
+        try {
+            new PerformanceObserver(list => {
+                for (const entry of list.getEntries()) {
+                    if (!entry.hadRecentInput) state.lastShift = Math.max(state.lastShift, entry.startTime);
+                }
+            }).observe({type: 'layout-shift', buffered: true});
+        } catch (e) {}
+    }
+    const isOverlay = (el) => !!(el && el.closest && el.closest(OVERLAY_SELECTORS));
+    const animations = document.getAnimations ? document.getAnimations().filter(animation =>
+        animation.playState === 'running' && animation.effect &&
+        animation.effect.getTiming().iterations !== Infinity && !isOverlay(animation.effect.target)).length : 0;
+    const overlays = Array.from(document.querySelectorAll(OVERLAY_SELECTORS), el => {
+        const r = el.getBoundingClientRect();
+        return [r.left, r.top, r.right, r.bottom];
+    });
+    return [performance.now() - window.__aiSettle.lastShift, animations, document.readyState, overlays,
+            window.scrollX + ',' + window.scrollY];
+    '''
+    
+    PIXEL_DELTA = 12  # grayscale difference that counts as a changed pixel (absorbs JPEG noise)
+    POLL_INTERVAL = 0.05
+    
+    def __init__(self, driver, capture: ScreenshotCapture, max_wait: float = None,
+                 quiet_period: float = None, change_ratio: float = None, frame_edge: int = 240,
+                 screencast: ScreencastBuffer = None):
         self.driver = driver
-        self.field_mappings = {
-            'email': ['email', 'e-mail', 'mail', 'correo'],
-            'name': ['name', 'fullname', 'full_name', 'nombre'],
-            'phone': ['phone', 'tel', 'telephone', 'mobile', 'telefono'],
-            'address': ['address', 'street', 'direccion'],
-            'city': ['city', 'ciudad'],
-            'zip': ['zip', 'postal', 'postcode', 'codigo_postal'],
-            'country': ['country', 'pais'],
-            'password': ['password', 'pass', 'pwd', 'contrasena']
-        }
-        
-    def auto_fill_form(self, data: Dict[str, str], use_ai: bool = True):
-        """Automatically fill form with provided data."""
-        form_elements = self.driver.find_elements(By.CSS_SELECTOR, "input, textarea, select")
-        filled_count = 0
+        self.capture = capture
+        self.screencast = screencast
+        self._decoded: Optional[Tuple[ScreencastFrame, np.ndarray]] = None
+        self.max_wait = SETTLE_MAX_WAIT if max_wait is None else max_wait
+        self.quiet_period = SETTLE_QUIET_PERIOD if quiet_period is None else quiet_period
+        self.change_ratio = SETTLE_CHANGE_RATIO if change_ratio is None else change_ratio
+        self.frame_edge = frame_edge
+        self.stats = {'waits': 0, 'timeouts': 0, 'total_wait': 0.0}
+    
+    def _frame(self, overlays: List[List[float]]) -> np.ndarray:
+        source = self.screencast.current_frame() if self.screencast is not None else None
+        if source is not None:
+            if self._decoded is not None and self._decoded[0] is source:
+                return self._decoded[1]  # no repaint since the last poll
+            frame = cv2.imdecode(np.frombuffer(source.data, dtype=np.uint8), cv2.IMREAD_REDUCED_GRAYSCALE_4)
+            scale = frame.shape[1] / source.css_width
+        else:
+            frame_jpeg, scale = self.capture.capture_viewport('jpeg', quality=60, max_edge=self.frame_edge)
+            frame = cv2.imdecode(np.frombuffer(frame_jpeg, dtype=np.uint8), cv2.IMREAD_GRAYSCALE)
+        for left, top, right, bottom in overlays:
+            frame[max(0, int(top * scale)):max(0, int(np.ceil(bottom * scale))),
+                  max(0, int(left * scale)):max(0, int(np.ceil(right * scale)))] = 0
+        if source is not None:
+            self._decoded = (source, frame)
+        return frame
+    
+    def wait(self, max_wait: float = None, quiet_period: float = None) -> bool:
+        """Block until the page is visually stable; returns False if the ceiling was hit."""
+        max_wait = self.max_wait if max_wait is None else max_wait
+        quiet_period = min(self.quiet_period if quiet_period is None else quiet_period, max_wait)
+        started = time.time()
+        deadline = started + max_wait
+        previous = None
+        previous_scroll = None
+        previous_at = started
+        quiet_since = None
+        settled = False
         
-        for element in form_elements:
+        while True:
+            now = time.time()
             try:
-                # Get element attributes
-                element_type = element.get_attribute('type')
-                element_name = element.get_attribute('name') or ''
-                element_id = element.get_attribute('id') or ''
-                placeholder = element.get_attribute('placeholder') or ''
-                label_text = self._get_label_text(element)
-                
-                # Determine field type
-                field_key = self._identify_field_type(
-                    element_name, element_id, placeholder, label_text, element_type
-                )
-                
-                if field_key and field_key in data:
-                    # Fill the field
-                    if element.tag_name == 'select':
-                        Select(element).select_by_visible_text(data[field_key])
-                    elif element_type == 'checkbox':
-                        if data[field_key].lower() in ['true', 'yes', '1']:
-                            if not element.is_selected():
-                                element.click()
-                    elif element_type == 'radio':
-                        if element.get_attribute('value') == data[field_key]:
-                            element.click()
-                    else:
-                        element.clear()
-                        element.send_keys(data[field_key])
-                    
-                    filled_count += 1
-                    logger.info(f"Filled field {field_key} with value")
-                    
+                since_shift_ms, animations, ready_state, overlays, scroll = self.driver.execute_script(self.PROBE_SCRIPT)
+                frame = self._frame(overlays)
+                changed = (previous is None or previous.shape != frame.shape or scroll != previous_scroll or
+                           np.count_nonzero(cv2.absdiff(frame, previous) > self.PIXEL_DELTA) > self.change_ratio * frame.size)
+                busy = changed or animations or ready_state == 'loading' or since_shift_ms < quiet_period * 1000
+                previous, previous_scroll = frame, scroll
             except Exception as e:
-                logger.error(f"Error filling form field: {e}")
-                
-        logger.info(f"Successfully filled {filled_count} form fields")
-        return filled_count
+                logger.debug(f"Stability probe failed: {e}")
+                busy, previous = True, None
+            
+            if busy:
+                quiet_since = None
+            elif quiet_since is None:
+                quiet_since = previous_at  # unchanged since the previous frame
+            previous_at = now
+            if quiet_since is not None and now - quiet_since >= quiet_period:
+                settled = True
+                break
+            if now >= deadline:
+                break
+            time.sleep(min(self.POLL_INTERVAL, max(0.0, deadline - time.time())))
+        
+        elapsed = time.time() - started
+        self.stats['waits'] += 1
+        self.stats['total_wait'] += elapsed
+        if not settled:
+            self.stats['timeouts'] += 1
+        logger.debug(f"Page {'settled' if settled else 'still changing'} after {elapsed:.2f}s")
+        return settled
+
+class ScreenshotEncoder:
+    """Downscale and encode screenshots before they go into an LLM request.
+
+    Images are shrunk so the long edge is at most `max_edge` (the resolution
+    the model resizes to anyway) and encoded as JPEG, WebP or PNG. Callers
+    annotate after fitting, scaling element coordinates by the returned factor.
+    """
+
+    FORMATS = {
+        'jpeg': ('JPEG', 'image/jpeg', '.jpg'),
+        'webp': ('WEBP', 'image/webp', '.webp'),
+        'png': ('PNG', 'image/png', '.png'),
+    }
+
+    def __init__(self, image_format: str = None, quality: int = None, max_edge: int = None):
+        image_format = (image_format or SCREENSHOT_FORMAT).lower()
+        self.image_format = 'jpeg' if image_format == 'jpg' else image_format
+        if self.image_format not in self.FORMATS:
+            logger.warning(f"Unsupported screenshot format '{image_format}', using webp")
+            self.image_format = 'webp'
+        self.quality = max(1, min(100, quality if quality is not None else SCREENSHOT_QUALITY))
+        self.max_edge = SCREENSHOT_MAX_EDGE if max_edge is None else max_edge
+
+    @property
+    def mime_type(self) -> str:
+        return self.FORMATS[self.image_format][1]
+
+    @property
+    def extension(self) -> str:
+        return self.FORMATS[self.image_format][2]
+
+    def scale_for(self, size: Tuple[int, int]) -> float:
+        """Resize factor that brings the long edge down to max_edge (never upscales)."""
+        long_edge = max(size)
+        return min(1.0, self.max_edge / long_edge) if self.max_edge and long_edge else 1.0
+
+    def target_size(self, size: Tuple[int, int]) -> Tuple[int, int]:
+        scale = self.scale_for(size)
+        return max(1, round(size[0] * scale)), max(1, round(size[1] * scale))
+
+    def fit(self, image: Image.Image) -> Tuple[Image.Image, float]:
+        """Downscale a PIL image to max_edge; returns the image and the applied factor."""
+        original_width = image.width
+        target = self.target_size(image.size)
+        if target == image.size:
+            return image, 1.0
+        # JPEG sources can decode straight at a reduced size
+        image.draft('RGB', target)
+        if image.size != target:
+            image = image.resize(target, Image.BILINEAR, reducing_gap=2.0)
+        return image, target[0] / original_width
+
+    def fit_array(self, image: np.ndarray) -> Tuple[np.ndarray, float]:
+        """Downscale a BGR array to max_edge; returns the array and the applied factor."""
+        height, width = image.shape[:2]
+        target = self.target_size((width, height))
+        if target == (width, height):
+            return image, 1.0
+        return cv2.resize(image, target, interpolation=cv2.INTER_AREA), target[0] / width
+
+    def encode(self, image: Image.Image) -> bytes:
+        pil_format = self.FORMATS[self.image_format][0]
+        options = {'compress_level': 1} if pil_format == 'PNG' else {'quality': self.quality}
+        if pil_format == 'WEBP':
+            options['method'] = 0  # fastest encoder setting
+        buffer = BytesIO()
+        image.convert('RGB').save(buffer, format=pil_format, **options)
+        return buffer.getvalue()
+
+    def encode_array(self, image: np.ndarray) -> bytes:
+        params = {
+            'jpeg': [cv2.IMWRITE_JPEG_QUALITY, self.quality],
+            'webp': [cv2.IMWRITE_WEBP_QUALITY, self.quality],
+            'png': [cv2.IMWRITE_PNG_COMPRESSION, 1],
+        }[self.image_format]
+        ok, encoded = cv2.imencode(self.extension, image, params)
+        if not ok:
+            raise ValueError(f"{self.image_format} encoding failed")
+        return encoded.tobytes()
+
+class ScreenshotStore:
+    """Content-addressed screenshot archive with perceptual deduplication.
     
-    def _identify_field_type(self, name: str, id: str, placeholder: str, label: str, input_type: str) -> Optional[str]:
-        """Identify the type of form field."""
-        combined_text = f"{name} {id} {placeholder} {label}".lower()
+    Frames are keyed by a SHA-256 content hash and a 256-bit difference hash
+    (dHash). A frame whose content hash is already stored reuses that file
+    without being decoded, so repeated screenshots of an unchanged page cost a
+    hash instead of a write. With SCREENSHOT_DEDUP_DISTANCE >= 0, frames whose
+    dHash is within that many bits of a recent frame are merged as well; it is
+    off by default because a typed word or ticked checkbox barely moves the
+    dHash. New frames are archived as lossy WebP with a report thumbnail.
+    """
+    
+    HASH_SIZE = 16
+    RECENT_HASHES = 256
+    
+    def __init__(self, db: AdvancedDatabase, root: str = 'screenshots', quality: int = None,
+                 thumbnail_width: int = None, dedup_distance: int = None):
+        self.db = db
+        self.root = root
+        self.quality = SCREENSHOT_ARCHIVE_QUALITY if quality is None else quality
+        self.thumbnail_width = SCREENSHOT_THUMBNAIL_WIDTH if thumbnail_width is None else thumbnail_width
+        self.dedup_distance = SCREENSHOT_DEDUP_DISTANCE if dedup_distance is None else dedup_distance
+        self._stats = {'stored': 0, 'deduplicated': 0, 'bytes_written': 0}
+        self._lock = threading.Lock()
+        os.makedirs(os.path.join(root, 'thumbs'), exist_ok=True)
+    
+    @property
+    def stats(self) -> Dict[str, int]:
+        """Snapshot of the counters, which put() updates on the artifact writer thread."""
+        with self._lock:
+            return dict(self._stats)
+    
+    @classmethod
+    def dhash(cls, image: Image.Image) -> int:
+        """Difference hash: sign of horizontal gradients on a 17x16 grayscale thumbnail."""
+        pixels = np.asarray(image.convert('L').resize((cls.HASH_SIZE + 1, cls.HASH_SIZE), Image.BILINEAR), dtype=np.int16)
+        bits = (pixels[:, 1:] > pixels[:, :-1]).ravel()
+        return int.from_bytes(np.packbits(bits).tobytes(), 'big')
+    
+    def put(self, screenshot: bytes, label: str = None, content_key: bytes = None) -> str:
+        """Archive an encoded screenshot and return the path of its stored frame.
         
-        for field_type, patterns in self.field_mappings.items():
-            for pattern in patterns:
-                if pattern in combined_text:
-                    return field_type
-                    
-        # Check input type
-        if input_type == 'email':
-            return 'email'
-        elif input_type == 'tel':
-            return 'phone'
-        elif input_type == 'password':
-            return 'password'
-            
+        `content_key` replaces the encoded bytes as the content hash input, e.g.
+        the raw capture plus overlay geometry for annotated frames whose footer
+        timestamp would otherwise make every frame unique.
+        """
+        content_hash = hashlib.sha256(screenshot if content_key is None else content_key).hexdigest()
+        existing = self.db.find_screenshot(content_hash)
+        if existing is None:
+            image = Image.open(BytesIO(screenshot)).convert('RGB')
+            perceptual_hash = self.dhash(image)
+            if self.dedup_distance >= 0:
+                existing = self._find_similar(perceptual_hash)
+        if existing is not None:
+            self.db.touch_screenshot(existing)
+            with self._lock:
+                self._stats['deduplicated'] += 1
+            return existing
+        
+        path = os.path.join(self.root, content_hash[:2], f"{content_hash}.webp")
+        thumbnail_path = os.path.join(self.root, 'thumbs', f"{content_hash}.webp")
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        
+        buffer = BytesIO()
+        image.save(buffer, format='WEBP', quality=self.quality, method=4)
+        with open(path, 'wb') as f:
+            f.write(buffer.getvalue())
+        
+        thumbnail = image.copy()
+        thumbnail.thumbnail((self.thumbnail_width, self.thumbnail_width * 4), Image.BILINEAR)
+        thumbnail.save(thumbnail_path, format='WEBP', quality=70, method=4)
+        
+        self.db.add_screenshot(content_hash, f"{perceptual_hash:064x}", path, thumbnail_path,
+                               image.width, image.height, buffer.tell(), label)
+        bytes_written = buffer.tell() + os.path.getsize(thumbnail_path)
+        with self._lock:
+            self._stats['stored'] += 1
+            self._stats['bytes_written'] += bytes_written
+        return path
+    
+    def _find_similar(self, perceptual_hash: int) -> Optional[str]:
+        """Most recent stored frame within dedup_distance bits of the dHash."""
+        for path, stored_hash in self.db.recent_screenshot_hashes(self.RECENT_HASHES):
+            if bin(perceptual_hash ^ int(stored_hash, 16)).count('1') <= self.dedup_distance:
+                return path
         return None
+
+class ArtifactWriter:
+    """Bounded write-behind queue for screenshots and database rows.
     
-    def _get_label_text(self, element) -> str:
-        """Get label text for an input element."""
+    Jobs run in order on a single background thread. When the queue is full,
+    submit() blocks until the writer catches up, so a slow disk slows the
+    agent down instead of growing memory without limit.
+    """
+    
+    def __init__(self, max_pending: int = None):
+        self.jobs: queue.Queue = queue.Queue(maxsize=max_pending or ARTIFACT_QUEUE_SIZE)
+        self._stats = {'submitted': 0, 'completed': 0, 'failed': 0, 'blocked_seconds': 0.0}
+        self._lock = threading.Lock()
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name="artifact-writer", daemon=True)
+        self._thread.start()
+    
+    @property
+    def stats(self) -> Dict[str, float]:
+        """Snapshot of the counters; submit() runs on the main and pipeline threads, jobs on the writer."""
+        with self._lock:
+            return dict(self._stats)
+    
+    def _count(self, key: str, amount: float = 1):
+        with self._lock:
+            self._stats[key] += amount
+    
+    def submit(self, job: Callable, *args):
+        """Queue job(*args), waiting for room when the queue is full; runs inline once closed."""
+        if self._closed:
+            job(*args)
+            return
+        self._count('submitted')
         try:
-            # Try to find label by 'for' attribute
-            element_id = element.get_attribute('id')
-            if element_id:
-                label = self.driver.find_element(By.CSS_SELECTOR, f"label[for='{element_id}']")
-                return label.text
-        except:
-            pass
-            
+            self.jobs.put_nowait((job, args))
+        except queue.Full:
+            started = time.time()
+            self.jobs.put((job, args))
+            waited = time.time() - started
+            self._count('blocked_seconds', waited)
+            logger.debug(f"Artifact queue full, waited {waited:.2f}s")
+    
+    def flush(self):
+        """Block until every queued job has finished."""
+        self.jobs.join()
+    
+    def close(self, timeout: float = 30.0):
+        """Finish pending jobs and stop the writer thread."""
+        if self._closed:
+            return
+        self._closed = True
+        self.jobs.put(None)
+        self._thread.join(timeout)
+    
+    def _run(self):
+        while True:
+            item = self.jobs.get()
+            try:
+                if item is None:
+                    return
+                job, args = item
+                job(*args)
+                self._count('completed')
+            except Exception as e:
+                self._count('failed')
+                logger.error(f"Artifact write failed: {e}")
+            finally:
+                self.jobs.task_done()
+
+class AnnotationRenderer:
+    """Reusable renderer for the numbered element overlay sent to the model.
+
+    Fonts are loaded once and label glyphs are cached as alpha-mask sprites
+    (ids 1..N are pre-rendered), so annotating costs a few C-level draw and
+    paste calls per element: one thick outline, a badge, and the cached text.
+    Everything is drawn onto a single RGBA overlay that is composited over the
+    screenshot once, then encoded with fast PNG compression.
+    """
+
+    FONT_CANDIDATES = ("arial.ttf", "Arial.ttf", "DejaVuSans.ttf", "LiberationSans-Regular.ttf")
+
+    # ENHANCED color mapping with BRIGHT, VISIBLE colors
+    COLOR_MAP = {
+        'a': (0, 255, 0),             # Bright Green for links
+        'input': (255, 165, 0),       # Bright Orange for inputs
+        'textarea': (255, 140, 0),    # Dark Orange for textareas
+        'button': (0, 150, 255),      # Bright Blue for buttons
+        'select': (255, 0, 255),      # Magenta for selects
+        'form': (255, 20, 147),       # Deep Pink for forms
+        'label': (165, 42, 42),       # Brown for labels
+    }
+    LABEL_PADDING = 8
+    BADGE_ALPHA = 200
+
+    def __init__(self, prerender_ids: int = 200):
+        self.label_font = self._load_font(14)
+        self.small_font = self._load_font(11)
+        self._sprites: Dict[Tuple[str, int], Image.Image] = {}
+        for label_id in range(1, prerender_ids + 1):
+            self._sprite(str(label_id), self.label_font)
+
+    @classmethod
+    def _load_font(cls, size: int) -> ImageFont.ImageFont:
+        for name in cls.FONT_CANDIDATES:
+            try:
+                return ImageFont.truetype(name, size)
+            except (IOError, OSError):
+                continue
         try:
-            # Try to find parent label
-            parent = element.find_element(By.XPATH, "..")
-            if parent.tag_name == 'label':
-                return parent.text
-        except:
-            pass
+            return ImageFont.load_default(size=size)
+        except TypeError:
+            # Pillow < 10.1 has no scalable default font
+            return ImageFont.load_default()
+
+    @staticmethod
+    def _text_mask(text: str, font: ImageFont.ImageFont) -> Image.Image:
+        """Alpha mask of the rendered text, tightly cropped."""
+        left, top, right, bottom = font.getbbox(text)
+        mask = Image.new('L', (max(1, right - left), max(1, bottom - top)), 0)
+        ImageDraw.Draw(mask).text((-left, -top), text, font=font, fill=255)
+        return mask
+
+    def _sprite(self, text: str, font: ImageFont.ImageFont) -> Image.Image:
+        key = (text, id(font))
+        sprite = self._sprites.get(key)
+        if sprite is None:
+            sprite = self._sprites[key] = self._text_mask(text, font)
+        return sprite
+
+    @staticmethod
+    def type_indicator(tag_name: str, is_form_field: bool, is_clickable: bool) -> str:
+        if is_form_field:
+            return "📝" if tag_name == 'textarea' else "💬" if tag_name == 'input' else "📋"
+        return "👆" if is_clickable else "👁️"
+
+    def color_for(self, tag_name: str, is_form_field: bool, is_clickable: bool) -> Tuple[int, int, int]:
+        if is_form_field:
+            return self.COLOR_MAP.get(tag_name, (255, 165, 0))  # Bright Orange
+        if is_clickable:
+            return self.COLOR_MAP.get(tag_name, (0, 150, 255))  # Bright Blue
+        return self.COLOR_MAP.get(tag_name, (128, 128, 128))  # Gray default
+
+    def draw(self, image: Image.Image, elements: ElementTable, footer: str = None) -> Image.Image:
+        """Composite labels for the visible, confident rows (and an optional footer) over the image."""
+        overlay = Image.new('RGBA', image.size, (0, 0, 0, 0))
+        draw = ImageDraw.Draw(overlay)
+        padding = self.LABEL_PADDING
+
+        # Vectorized selection of visible, confident elements (labelled with their stable ids)
+        rows = np.flatnonzero(elements.mask(visible=True, min_confidence=0.3))
+        outline_widths = np.maximum(3, (elements.confidence[rows] * 5).astype(np.int32))
+        dot_sizes = np.maximum(6, (elements.confidence[rows] * 8).astype(np.int32))
+
+        for row, outline_width, dot_size in zip(rows.tolist(), outline_widths.tolist(), dot_sizes.tolist()):
+            element_info = elements[row]
+            try:
+                x, y, w, h = element_info.coordinates
+                tag_name = element_info.tag_name
+                color = self.color_for(tag_name, element_info.is_form_field, element_info.is_clickable)
+
+                # Single thick outline growing outwards from the element box
+                grow = outline_width - 1
+                draw.rectangle((x - grow, y - grow, x + w + grow, y + h + grow), outline=color, width=outline_width)
+
+                # Cached label sprite on a colored badge at the top-left
+                sprite = self._sprite(str(element_info.id), self.label_font)
+                label_width = sprite.width + padding * 2
+                label_height = sprite.height + padding * 2
+                label_x = max(2, x - 2)
+                label_y = max(2, y - label_height - 4)
+                draw.rectangle((label_x, label_y, label_x + label_width, label_y + label_height),
+                               fill=color + (self.BADGE_ALPHA,), outline=(255, 255, 255, 255), width=1)
+                overlay.paste((255, 255, 255, 255), (label_x + padding, label_y + padding), sprite)
+
+                # Element type indicator
+                type_indicator = self.type_indicator(tag_name, element_info.is_form_field, element_info.is_clickable)
+                overlay.paste((255, 255, 255, 255), (x + w - 15, y + 2), self._sprite(type_indicator, self.small_font))
+
+                # Confidence indicator
+                confidence = element_info.confidence_score
+                dot_color = (0, 255, 0) if confidence > 0.8 else (255, 255, 0) if confidence > 0.6 else (255, 0, 0)
+                conf_x = x + w - dot_size - 2
+                conf_y = y + h - dot_size - 2
+                draw.ellipse((conf_x, conf_y, conf_x + dot_size, conf_y + dot_size),
+                             fill=dot_color, outline=(255, 255, 255), width=1)
+
+            except Exception as e:
+                logger.warning(f"Error drawing label for element {element_info.id}: {e}")
+                continue
+
+        if footer:
+            left, top, right, bottom = draw.textbbox((0, 0), footer, font=self.small_font)
+            bg_padding = 8
+            img_width, img_height = image.size
+            bg_top = img_height - (bottom - top) - bg_padding * 2
+            draw.rectangle((0, bg_top, right - left + bg_padding * 2, img_height),
+                           fill=(0, 0, 0, 255), outline=(255, 255, 255, 255), width=1)
+            draw.text((bg_padding - left, bg_top + bg_padding - top), footer, font=self.small_font,
+                      fill=(255, 255, 255, 255))
+
+        return Image.alpha_composite(image.convert('RGBA'), overlay).convert('RGB')
+
+    def render(self, screenshot: bytes, elements: ElementTable, footer: str = None,
+               encoder: 'ScreenshotEncoder' = None) -> bytes:
+        """Annotate a screenshot and return the encoded image.
+        
+        Without an encoder the result is a full-size PNG (fast compression);
+        with one, the image is downscaled first, labels are drawn at the scaled
+        coordinates and the encoder's format is used.
+        """
+        image = Image.open(BytesIO(screenshot))
+        if encoder is None:
+            buffer = BytesIO()
+            self.draw(image, elements, footer).save(buffer, format="PNG", compress_level=1)
+            return buffer.getvalue()
+        image, scale = encoder.fit(image)
+        return encoder.encode(self.draw(image, elements.scaled(scale) if scale != 1.0 else elements, footer))
+
+class OpenCVAnnotationRenderer(AnnotationRenderer):
+    """AnnotationRenderer backend drawing straight into a NumPy array with OpenCV.
+
+    The screenshot is decoded with cv2.imdecode, geometry for all rows is
+    computed from the table's coordinate arrays at once, and outlines and
+    label badges are drawn in batches - one cv2.polylines / cv2.fillPoly call
+    per (color, thickness) group. Label text reuses the PIL-rendered sprite
+    masks, blended in with NumPy.
+    """
+
+    @staticmethod
+    def _stamp(plane: np.ndarray, mask: np.ndarray, x: int, y: int):
+        """Max-merge an 8-bit mask into a full-frame alpha plane at (x, y), clipped."""
+        height, width = plane.shape
+        x0, y0 = max(x, 0), max(y, 0)
+        x1, y1 = min(x + mask.shape[1], width), min(y + mask.shape[0], height)
+        if x0 < x1 and y0 < y1:
+            region = plane[y0:y1, x0:x1]
+            np.maximum(region, mask[y0 - y:y1 - y, x0 - x:x1 - x], out=region)
+
+    @staticmethod
+    def _blend_mask(image: np.ndarray, mask: np.ndarray, x: int, y: int, color: Tuple[int, int, int]):
+        """Alpha-blend a solid color through an 8-bit mask at (x, y), clipped to the image."""
+        height, width = image.shape[:2]
+        x0, y0 = max(x, 0), max(y, 0)
+        x1, y1 = min(x + mask.shape[1], width), min(y + mask.shape[0], height)
+        if x0 >= x1 or y0 >= y1:
+            return
+        alpha = mask[y0 - y:y1 - y, x0 - x:x1 - x, None].astype(np.float32) / 255.0
+        region = image[y0:y1, x0:x1]
+        region[:] = (region * (1.0 - alpha) + np.asarray(color, dtype=np.float32) * alpha).astype(np.uint8)
+
+    def _mask_array(self, text: str, font: ImageFont.ImageFont) -> np.ndarray:
+        key = ('array', text, id(font))
+        mask = self._sprites.get(key)
+        if mask is None:
+            mask = self._sprites[key] = np.asarray(self._sprite(text, font))
+        return mask
+
+    def draw_array(self, image: np.ndarray, elements: ElementTable, footer: str = None) -> np.ndarray:
+        """Annotate a BGR image array in place and return it."""
+        rows = np.flatnonzero(elements.mask(visible=True, min_confidence=0.3))
+        if len(rows):
+            x, y, w, h = elements.coordinates[rows].astype(np.int32).T
+            confidence = elements.confidence[rows]
+            thickness = np.maximum(3, (confidence * 5).astype(np.int32))
+            dot_size = np.maximum(6, (confidence * 8).astype(np.int32))
+            ids = elements.ids[rows].tolist()
+            tags = elements.tag_names[rows].tolist()
+            form_field = elements.form_field[rows].tolist()
+            clickable = elements.clickable[rows].tolist()
+            # BGR colors per row
+            colors = [self.color_for(tag, form, click)[::-1] for tag, form, click in zip(tags, form_field, clickable)]
+
+            masks = [self._mask_array(str(element_id), self.label_font) for element_id in ids]
+            padding = self.LABEL_PADDING
+            label_w = np.array([mask.shape[1] for mask in masks], dtype=np.int32) + padding * 2
+            label_h = np.array([mask.shape[0] for mask in masks], dtype=np.int32) + padding * 2
+            label_x = np.maximum(2, x - 2)
+            label_y = np.maximum(2, y - label_h - 4)
+
+            # Outline centre lines so each band covers the same pixels as the PIL path
+            inset = (thickness - 1) // 2
+            outlines = np.stack([
+                np.stack([x - inset, y - inset], axis=1), np.stack([x + w + inset, y - inset], axis=1),
+                np.stack([x + w + inset, y + h + inset], axis=1), np.stack([x - inset, y + h + inset], axis=1)
+            ], axis=1)
+            badges = np.stack([
+                np.stack([label_x, label_y], axis=1), np.stack([label_x + label_w, label_y], axis=1),
+                np.stack([label_x + label_w, label_y + label_h], axis=1), np.stack([label_x, label_y + label_h], axis=1)
+            ], axis=1)
+
+            groups: Dict[Tuple[Tuple[int, int, int], int], List[int]] = defaultdict(list)
+            for index, (color, width) in enumerate(zip(colors, thickness.tolist())):
+                groups[(color, width)].append(index)
+
+            # Semi-transparent badges: fill on a copy, blend once
+            badge_layer = image.copy()
+            for (color, _), members in groups.items():
+                cv2.fillPoly(badge_layer, list(badges[members]), color)
+            alpha = self.BADGE_ALPHA / 255.0
+            cv2.addWeighted(badge_layer, alpha, image, 1.0 - alpha, 0, dst=image)
+            cv2.polylines(image, list(badges), True, (255, 255, 255), 1)
+            for (color, width), members in groups.items():
+                cv2.polylines(image, list(outlines[members]), True, color, width)
+
+            indicator_masks = [
+                self._mask_array(self.type_indicator(tag, form, click), self.small_font)
+                for tag, form, click in zip(tags, form_field, clickable)
+            ]
+            dot_radius = dot_size // 2
+            dot_cx = x + w - 2 - dot_size + dot_radius
+            dot_cy = y + h - 2 - dot_size + dot_radius
+            # All label text is white: stamp every mask into one alpha plane, then blend once
+            text_alpha = np.zeros(image.shape[:2], dtype=np.uint8)
+            for index in range(len(rows)):
+                self._stamp(text_alpha, masks[index], int(label_x[index]) + padding, int(label_y[index]) + padding)
+                self._stamp(text_alpha, indicator_masks[index], int(x[index] + w[index] - 15), int(y[index]) + 2)
+            lift = cv2.multiply(255 - image, cv2.merge([text_alpha] * 3), scale=1 / 255)
+            cv2.add(image, lift, dst=image)
             
-        return ""
+            for index in range(len(rows)):
+                score = float(confidence[index])
+                dot_color = (0, 255, 0) if score > 0.8 else (0, 255, 255) if score > 0.6 else (0, 0, 255)
+                center = (int(dot_cx[index]), int(dot_cy[index]))
+                cv2.circle(image, center, int(dot_radius[index]), dot_color, -1)
+                cv2.circle(image, center, int(dot_radius[index]), (255, 255, 255), 1)
+
+        if footer:
+            mask = np.asarray(self._text_mask(footer, self.small_font))
+            bg_padding = 8
+            img_height = image.shape[0]
+            bg_top = img_height - mask.shape[0] - bg_padding * 2
+            bg_right = mask.shape[1] + bg_padding * 2
+            cv2.rectangle(image, (0, bg_top), (bg_right, img_height - 1), (0, 0, 0), -1)
+            cv2.rectangle(image, (0, bg_top), (bg_right, img_height - 1), (255, 255, 255), 1)
+            self._blend_mask(image, mask, bg_padding, bg_top + bg_padding, (255, 255, 255))
+
+        return image
+
+    def render(self, screenshot: bytes, elements: ElementTable, footer: str = None,
+               encoder: 'ScreenshotEncoder' = None) -> bytes:
+        """Annotate a screenshot and return the encoded image (see AnnotationRenderer.render)."""
+        image = cv2.imdecode(np.frombuffer(screenshot, dtype=np.uint8), cv2.IMREAD_COLOR)
+        if encoder is None:
+            ok, encoded = cv2.imencode('.png', self.draw_array(image, elements, footer),
+                                       [cv2.IMWRITE_PNG_COMPRESSION, 1])
+            if not ok:
+                raise ValueError("PNG encoding failed")
+            return encoded.tobytes()
+        image, scale = encoder.fit_array(image)
+        return encoder.encode_array(self.draw_array(image, elements.scaled(scale) if scale != 1.0 else elements, footer))
 
 class MegaAdvancedBrowserAgent:
     """Mega Advanced Browser Agent with all features."""
@@ -1306,10 +4903,27 @@ class MegaAdvancedBrowserAgent:
         self.db = AdvancedDatabase()
         self.email_manager = AdvancedEmailManager()
         self.report_generator = AdvancedReportGenerator(self.db)
+        self.screenshot_store = ScreenshotStore(self.db)
+        self.decision_cache = DecisionCache(self.db)
+        self._decision_cache_key: Optional[str] = None
+        self._decision_cache_url = ""
+        self._decision_from_cache = False
+        self.artifact_writer = ArtifactWriter()
+        # Separate renderer for the writer thread; FreeType fonts are not shared across threads
+        self._artifact_renderer: Optional[AnnotationRenderer] = None
         self.chat_interface = ChatInterface()  # Initialize clean chat interface
         self.captcha_solver = CaptchaSolver()
         self.macro_recorder = MacroRecorder()
         self.enable_ai = enable_ai
+        self.llm_client = LLMClient.shared()
+        self.llm_router = LLMRouter(client=self.llm_client)
+        self.llm_router.on_call = self._record_llm_call
+        self.prompt_budget = PromptBudgetManager()
+        self.decision_mode_stats = {'text': 0, 'vision': 0, 'requested': 0}
+        self.prompt_token_stats = {'requests': 0, 'dynamic_tokens': 0, 'input_tokens': 0, 'cached_tokens': 0, 'output_tokens': 0}
+        self._prepared_action = None  # Element handle resolved while the decision streams
+        if enable_ai:
+            self.llm_router.warm_up()
         self.multi_browser = multi_browser
         self.browser_count = browser_count
         self.browser_pool = []
@@ -1390,6 +5004,11 @@ class MegaAdvancedBrowserAgent:
             self.data_extractor = DataExtractor(self.driver)
             self.performance_monitor = PerformanceMonitor(self.driver)
             self.form_filler = SmartFormFiller(self.driver)
+            self.element_index = (DOMSnapshotElementScanner(self.driver) if ELEMENT_SCAN_BACKEND == "cdp"
+                                  else IncrementalElementIndex(self.driver))
+            self.page_state = PageStateTracker(self.driver)
+            self.page_text_view = PageTextView(self.driver)
+            self.plan_verifier = PlanVerifier(self.driver, self.element_index.ID_ATTRIBUTE)
             
             # Enable network logging
             self.network_interceptor.enable_network_logging()
@@ -1403,8 +5022,31 @@ class MegaAdvancedBrowserAgent:
             raise
         
         # Initialize data structures
-        self.elements_cache: List[ElementInfo] = []
+        self.elements_cache: ElementTable = ElementTable.empty()
+        self.element_ranker = ElementRelevanceRanker()
+        renderer_class = OpenCVAnnotationRenderer if ANNOTATION_BACKEND == "opencv" else AnnotationRenderer
+        self.annotation_renderer = renderer_class(prerender_ids=ELEMENT_SCAN_LIMIT)
+        self.screenshot_encoder = ScreenshotEncoder()
+        self.screenshot_capture = ScreenshotCapture(self.driver)
+        self.screencast = ScreencastBuffer(self.driver)
+        # Worker threads reach the page over their own DevTools connection; the driver stays on this thread
+        self.devtools = DevToolsChannel(self.driver)
+        if PIPELINE_ENABLED:
+            self.devtools.connect()
+        self.step_timer = StepTimer()
+        self.overlay_updater = OverlayUpdater(self.driver, self.devtools, timer=self.step_timer)
+        self.pipeline = ThreadPoolExecutor(max_workers=1, thread_name_prefix="step-pipeline")
+        self.pipeline_capture = ScreenshotCapture(self.driver, send_cdp=self.devtools.call)
+        # Renderer for the pipeline thread, created on first use like _artifact_renderer
+        self._pipeline_renderer: Optional[AnnotationRenderer] = None
+        self._screenshot_expected = DECISION_MODE == "vision"
+        if SCREENCAST_ENABLED:
+            self.screencast.start()
+        self.visual_stability = VisualStabilityDetector(self.driver, self.screenshot_capture, screencast=self.screencast)
+        # ((page state key, prompt element ids), (annotated screenshot b64, mime type)) of the last step
+        self._annotation_cache: Optional[Tuple[Tuple[str, Tuple[int, ...]], Tuple[str, str]]] = None
         self.action_history: List[ActionResult] = []
+        self._history_lock = threading.Lock()  # The artifact writer fills in screenshot paths of recorded results
         self.session_data = {
             'start_time': datetime.now(),
             'total_actions': 0,
@@ -1642,7 +5284,7 @@ class MegaAdvancedBrowserAgent:
                 }}, {duration});
             }}
             '''
-            self.driver.execute_script(show_bubble_js)
+            self.overlay_updater.update('analysis', show_bubble_js)
         except Exception as e:
             logger.warning(f"Could not show AI analysis: {e}")
 
@@ -1824,7 +5466,7 @@ class MegaAdvancedBrowserAgent:
                 }}
             }}
             '''
-            self.driver.execute_script(progress_js)
+            self.overlay_updater.update('progress', progress_js)
         except Exception as e:
             logger.warning(f"Could not show progress: {e}")
 
@@ -1910,581 +5552,443 @@ class MegaAdvancedBrowserAgent:
                 }}
             }}
             '''
-            self.driver.execute_script(status_js)
+            self.overlay_updater.update('status', status_js)
         except Exception as e:
             logger.warning(f"Could not activate status bar: {e}")
 
     def get_screenshot_as_png(self):
         """Get screenshot as PNG bytes."""
-        return self.driver.get_screenshot_as_png()
+        return self.screenshot_capture.capture('png')
 
-    def _get_advanced_interactive_elements(self) -> List[ElementInfo]:
-        """Get all interactive elements with advanced analysis including iframes."""
-        script = '''
-        const elements = [];
-        
-        // Function to extract elements from a document (main or iframe)
-        function extractElementsFromDocument(doc, frameOffset = {x: 0, y: 0}) {
-            const selectors = 'a, button, input, textarea, select, [role="button"], [role="link"], ' +
-                '[onclick], [tabindex]:not([tabindex="-1"]), [contenteditable="true"], ' +
-                '[data-testid], [data-cy], .btn, .button, .link, .clickable, ' +
-                'form, label, option, summary, details, [href], [src]';
-            
-            const docElements = Array.from(doc.querySelectorAll(selectors));
-            
-            for (const el of docElements) {
-                try {
-                    const rect = el.getBoundingClientRect();
-                    const style = doc.defaultView.getComputedStyle(el);
-                    
-                    // Adjust coordinates for iframe offset
-                    const adjustedRect = {
-                        x: rect.x + frameOffset.x,
-                        y: rect.y + frameOffset.y,
-                        width: rect.width,
-                        height: rect.height,
-                        top: rect.top + frameOffset.y,
-                        left: rect.left + frameOffset.x,
-                        bottom: rect.bottom + frameOffset.y,
-                        right: rect.right + frameOffset.x
-                    };
-                    
-                    if (adjustedRect.width > 0 && adjustedRect.height > 0 && 
-                        adjustedRect.top >= -100 && adjustedRect.left >= -100 &&
-                        adjustedRect.bottom <= window.innerHeight + 100 && 
-                        adjustedRect.right <= window.innerWidth + 100 &&
-                        style.visibility !== 'hidden' && 
-                        style.display !== 'none') {
-                        
-                        const tagName = el.tagName.toLowerCase();
-                        const elementType = el.type || 'unknown';
-                        const isVisible = adjustedRect.top >= 0 && adjustedRect.left >= 0 && 
-                                         adjustedRect.bottom <= window.innerHeight && 
-                                         adjustedRect.right <= window.innerWidth;
-                        
-                        // Fast text extraction with fallbacks
-                        let label = '';
-                        if (el.textContent && el.textContent.trim()) {
-                            label = el.textContent.trim();
-                        } else if (el.getAttribute('aria-label')) {
-                            label = el.getAttribute('aria-label');
-                        } else if (el.getAttribute('placeholder')) {
-                            label = el.getAttribute('placeholder');
-                        } else if (el.getAttribute('title')) {
-                            label = el.getAttribute('title');
-                        } else if (el.getAttribute('alt')) {
-                            label = el.getAttribute('alt');
-                        } else if (el.getAttribute('value')) {
-                            label = el.getAttribute('value');
-                        } else {
-                            label = tagName;
-                        }
-                        
-                        // Fast confidence calculation
-                        let confidence = 0.5;
-                        if (isVisible) confidence += 0.2;
-                        if (el.onclick || el.getAttribute('onclick')) confidence += 0.1;
-                        if (tagName === 'button' || tagName === 'a') confidence += 0.1;
-                        if (el.getAttribute('role')) confidence += 0.1;
-                        
-                        // Only collect essential attributes for speed
-                        const attributes = {
-                            id: el.id || '',
-                            class: el.className || '',
-                            name: el.name || '',
-                            type: el.type || '',
-                            role: el.getAttribute('role') || ''
-                        };
-                        
-                        // Skip file input elements to avoid typing errors
-                        if (tagName === 'input' && (el.type === 'file' || elementType === 'file')) {
-                            continue;
-                        }
-                        
-                        // Add data attribute for iframe tracking
-                        el.setAttribute('data-element-id', elements.length + 1);
-                        
-                        elements.push({
-                            element: el,
-                            tagName: tagName,
-                            label: label.substring(0, 100).replace(/\\s+/g, ' '),
-                            elementType: elementType,
-                            isVisible: isVisible,
-                            isClickable: tagName === 'button' || tagName === 'a' || 
-                                       el.onclick || el.getAttribute('onclick') || 
-                                       el.getAttribute('role') === 'button',
-                            isFormField: ['input', 'textarea', 'select'].includes(tagName),
-                            coordinates: [adjustedRect.x, adjustedRect.y, adjustedRect.width, adjustedRect.height],
-                            attributes: attributes,
-                            textContent: el.textContent ? el.textContent.substring(0, 100) : '',
-                            confidenceScore: Math.min(confidence, 1.0),
-                            frameSource: frameOffset.x === 0 && frameOffset.y === 0 ? 'main' : 'iframe'
-                        });
-                    }
-                } catch (e) {
-                    // Skip errors for speed
-                }
-            }
-        }
-        
-        // Extract from main document
-        extractElementsFromDocument(document);
-        
-        // Extract from iframes (faster approach)
-        const iframes = document.querySelectorAll('iframe');
-        for (const iframe of iframes) {
-            try {
-                // Check if iframe is accessible (same origin)
-                const iframeDoc = iframe.contentDocument || iframe.contentWindow.document;
-                if (iframeDoc) {
-                    const iframeRect = iframe.getBoundingClientRect();
-                    const frameOffset = {
-                        x: iframeRect.x,
-                        y: iframeRect.y
-                    };
-                    extractElementsFromDocument(iframeDoc, frameOffset);
-                }
-            } catch (e) {
-                // Skip cross-origin iframes
-                console.log('Skipping cross-origin iframe');
-            }
-        }
-        
-        // Fast sort by confidence and visibility
-        const elementData = elements.map((el, i) => ({
-            ...el,
-            id: i + 1
-        })).sort((a, b) => {
-            if (a.isVisible && !b.isVisible) return -1;
-            if (!a.isVisible && b.isVisible) return 1;
-            return b.confidenceScore - a.confidenceScore;
-        });
-        
-        return elementData;
-        '''
-        
+    def _get_advanced_interactive_elements(self) -> ElementTable:
+        """Get all interactive elements with advanced analysis including iframes.
+
+        Elements come from the persistent in-page index, so each call only pays
+        for the part of the DOM that changed since the previous step - or, with
+        ELEMENT_SCAN_BACKEND=cdp, from a single DOMSnapshot of the frame tree.
+        """
         try:
             # Faster wait with shorter timeout
-            WebDriverWait(self.driver, 5).until(
-                lambda d: d.find_element(By.TAG_NAME, "body")
-            )
-            raw_elements = self.driver.execute_script(script)
-            
-            # Faster conversion to ElementInfo objects
-            elements = []
-            for raw_element in raw_elements[:50]:  # Limit to top 50 elements for speed
-                try:
-                    element_info = ElementInfo(
-                        id=raw_element['id'],
-                        element=raw_element['element'],
-                        tag_name=raw_element['tagName'],
-                        label=raw_element['label'],
-                        element_type=raw_element['elementType'],
-                        is_visible=raw_element['isVisible'],
-                        is_clickable=raw_element['isClickable'],
-                        is_form_field=raw_element['isFormField'],
-                        coordinates=tuple(raw_element['coordinates']),
-                        attributes=raw_element['attributes'],
-                        text_content=raw_element['textContent'],
-                        confidence_score=raw_element['confidenceScore']
-                    )
-                    elements.append(element_info)
-                except Exception as e:
-                    # Skip errors for speed
-                    continue
+            WebDriverWait(self.driver, 5).until(
+                lambda d: d.find_element(By.TAG_NAME, "body")
+            )
+            # Fast vectorized sort by visibility and confidence
+            # Keep a wide candidate set - the relevance ranker picks the prompt subset per step
+            elements = self.element_index.collect().sorted_by_priority()[:ELEMENT_SCAN_LIMIT]
             
             # Log iframe detection results
-            iframe_elements = [e for e in elements if e.attributes.get('frameSource') == 'iframe']
-            if iframe_elements:
-                logger.info(f"Found {len(iframe_elements)} elements inside iframes")
+            iframe_count = int(np.count_nonzero(elements.frame_paths != ''))
+            if iframe_count:
+                logger.info(f"Found {iframe_count} elements inside iframes")
             
-            logger.info(f"Found {len(elements)} advanced interactive elements (including iframes)")
+            delta = self.element_index.last_delta
+            logger.info(f"Found {len(elements)} advanced interactive elements (including iframes) - "
+                        f"delta: +{delta.get('upserts', 0)}/-{delta.get('removed', 0)} of {delta.get('tracked', 0)} tracked"
+                        f"{' (full scan)' if delta.get('reset') else ''}")
             return elements
             
         except Exception as e:
             logger.error(f"Error getting interactive elements: {e}")
-            return []
-
-    def _draw_advanced_labels_on_image(self, screenshot_png: bytes, elements: List[ElementInfo]) -> bytes:
-        """Draw advanced element labels with BETTER VISIBILITY and proper numbering."""
-        image = Image.open(BytesIO(screenshot_png))
-        draw = ImageDraw.Draw(image)
-        
-        # Load fonts with proper fallback
-        try:
-            title_font = ImageFont.truetype("arial.ttf", 16)  # Larger font
-            label_font = ImageFont.truetype("arial.ttf", 14)  # Larger font
-            small_font = ImageFont.truetype("arial.ttf", 11)  # Larger font
-        except (IOError, OSError):
-            try:
-                title_font = ImageFont.truetype("Arial.ttf", 16)
-                label_font = ImageFont.truetype("Arial.ttf", 14)
-                small_font = ImageFont.truetype("Arial.ttf", 11)
-            except (IOError, OSError):
-                title_font = ImageFont.load_default()
-                label_font = ImageFont.load_default()
-                small_font = ImageFont.load_default()
+            self.element_index.reset()
+            return ElementTable.empty()
 
-        # ENHANCED color mapping with BRIGHT, VISIBLE colors
-        color_map = {
-            'a': (0, 255, 0),             # Bright Green for links
-            'input': (255, 165, 0),       # Bright Orange for inputs
-            'textarea': (255, 140, 0),    # Dark Orange for textareas
-            'button': (0, 150, 255),      # Bright Blue for buttons
-            'select': (255, 0, 255),      # Magenta for selects
-            'form': (255, 20, 147),       # Deep Pink for forms
-            'label': (165, 42, 42),       # Brown for labels
-        }
+    def _draw_advanced_labels_on_image(self, screenshot_png: bytes, elements: ElementTable,
+                                       encoder: ScreenshotEncoder = None, renderer: AnnotationRenderer = None) -> bytes:
+        """Draw advanced element labels with BETTER VISIBILITY and proper numbering.
         
-        # Draw elements with ENHANCED VISIBILITY
-        valid_element_count = 0
-        for element_info in elements:
-            if not element_info.is_visible or element_info.confidence_score < 0.3:
-                continue  # Skip invisible or low-confidence elements
-                
-            valid_element_count += 1
-            try:
-                x, y, w, h = element_info.coordinates
-                label_id = str(valid_element_count)  # Use sequential numbering for visible elements
-                tag_name = element_info.tag_name
-                
-                # Get BRIGHT color based on element type
-                if element_info.is_form_field:
-                    color = color_map.get(tag_name, (255, 165, 0))  # Bright Orange
-                elif element_info.is_clickable:
-                    color = color_map.get(tag_name, (0, 150, 255))  # Bright Blue
-                else:
-                    color = color_map.get(tag_name, (128, 128, 128))  # Gray default
-                
-                # Draw THICKER element outline for better visibility
-                outline_width = max(3, int(element_info.confidence_score * 5))
-                
-                # Draw multiple outline layers for better visibility
-                for i in range(outline_width):
-                    draw.rectangle((x-i, y-i, x + w + i, y + h + i), outline=color, width=1)
-                
-                # Create LARGER, MORE VISIBLE label
-                text_bbox = draw.textbbox((0, 0), label_id, font=label_font)
-                text_width = text_bbox[2] - text_bbox[0]
-                text_height = text_bbox[3] - text_bbox[1]
-                
-                # LARGER label background with better positioning
-                padding = 8
-                label_width = text_width + (padding * 2)
-                label_height = text_height + (padding * 2)
-                
-                # Position label at top-left with better visibility
-                label_x = max(2, x - 2)
-                label_y = max(2, y - label_height - 4)
-                
-                # Draw TRANSPARENT label background (less intrusive)
-                label_bg_coords = [label_x, label_y, label_x + label_width, label_y + label_height]
-                
-                # Semi-transparent background instead of black
-                transparent_color = tuple(list(color) + [180])  # Add alpha for transparency
-                draw.rectangle(label_bg_coords, fill=color)
-                
-                # Thin outline for contrast without heavy black border
-                draw.rectangle(label_bg_coords, outline=(255, 255, 255), width=1)
-                
-                # Clean text without heavy shadow
-                draw.text((label_x + padding, label_y + padding), 
-                         label_id, font=label_font, fill=(255, 255, 255))
-                
-                # Simplified element type indicator (no black background)
-                indicator_x = x + w - 15
-                indicator_y = y + 2
-                
-                if element_info.is_form_field:
-                    type_indicator = "📝" if tag_name == 'textarea' else "💬" if tag_name == 'input' else "📋"
-                elif element_info.is_clickable:
-                    type_indicator = "👆"
-                else:
-                    type_indicator = "👁️"
-                
-                # Draw indicator with minimal background
-                draw.text((indicator_x, indicator_y), type_indicator, font=small_font)
-                
-                # Simplified confidence indicator (smaller, less intrusive)
-                confidence_size = max(6, int(element_info.confidence_score * 8))
-                confidence_color = (0, 255, 0) if element_info.confidence_score > 0.8 else (255, 255, 0) if element_info.confidence_score > 0.6 else (255, 0, 0)
-                
-                conf_x = x + w - confidence_size - 2
-                conf_y = y + h - confidence_size - 2
-                draw.ellipse([conf_x, conf_y, conf_x + confidence_size, conf_y + confidence_size], 
-                           fill=confidence_color, outline=(255, 255, 255), width=1)
-                
-                # Update element_info id to match visible numbering
-                element_info.id = valid_element_count
-                
-            except Exception as e:
-                logger.warning(f"Error drawing label for element {element_info.id}: {e}")
-                continue
-        
-        # Add ENHANCED professional watermark
-        try:
-            timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-            url = self.driver.current_url[:50] + "..." if len(self.driver.current_url) > 50 else self.driver.current_url
-            watermark_text = f"🤖 Mega AI Agent | {timestamp} | Elements: {valid_element_count}"
-            
-            # Get image dimensions
-            img_width, img_height = image.size;
-            
-            # Calculate watermark position
-            watermark_bbox = draw.textbbox((0, 0), watermark_text, font=small_font)
-            watermark_width = watermark_bbox[2] - watermark_bbox[0]
-            watermark_height = watermark_bbox[3] - watermark_bbox[1]
-            
-            # Enhanced background for watermark
-            bg_padding = 8
-            bg_coords = [0, img_height - watermark_height - bg_padding * 2, 
-                        watermark_width + bg_padding * 2, img_height]
-            
-            # Black background with border
-            draw.rectangle(bg_coords, fill=(0, 0, 0))
-            draw.rectangle([1, img_height - watermark_height - bg_padding * 2 + 1, 
-                          watermark_width + bg_padding * 2 - 1, img_height - 1], 
-                         outline=(255, 255, 255), width=1)
-            
-            # Watermark text
-            draw.text((bg_padding, img_height - watermark_height - bg_padding), 
-                     watermark_text, font=small_font, fill=(255, 255, 255))
-            
-        except Exception as e:
-            logger.warning(f"Could not add watermark: {e}")
-        
-        # Convert back to bytes with optimization
-        buffer = BytesIO()
-        image.save(buffer, format="PNG", optimize=True, quality=95)
-        return buffer.getvalue()
+        Returns full-size PNG bytes, or the encoder's downscaled format when given.
+        """
+        labelled_count = int(np.count_nonzero(elements.mask(visible=True, min_confidence=0.3)))
+        timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        watermark_text = f"🤖 Mega AI Agent | {timestamp} | Elements: {labelled_count}"
+        return (renderer or self.annotation_renderer).render(screenshot_png, elements, footer=watermark_text, encoder=encoder)
 
     def save_advanced_screenshot(self, filename: str = None, annotate: bool = True) -> str:
-        """Save advanced screenshot with optional annotations."""
+        """Save advanced screenshot with optional annotations.
+        
+        Screenshots go through the content-addressed ScreenshotStore, so the
+        returned path is shared with earlier identical frames; `filename` is
+        recorded as the frame's label.
+        """
         try:
             timestamp = datetime.now().strftime('%Y%m%d_%H%M%S_%f')[:-3]  # Include milliseconds
             if filename is None:
                 filename = f"screenshot_{timestamp}.png"
             
-            filepath = os.path.join('screenshots', filename)
-            
-            if annotate and self.elements_cache:
-                screenshot_png = self.get_screenshot_as_png()
-                annotated_screenshot = self._draw_advanced_labels_on_image(screenshot_png, self.elements_cache)
-                with open(filepath, 'wb') as f:
-                    f.write(annotated_screenshot)
-            else:
-                self.driver.save_screenshot(filepath)
-            
-            logger.info(f"📸 Advanced screenshot saved: {filepath}")
-            return filepath
+            screenshot_png = self.get_screenshot_as_png()
+            return self._store_screenshot(screenshot_png, self.elements_cache if annotate else None, filename)
         except Exception as e:
             logger.error(f"Error saving screenshot: {e}")
             return None
-
-    def decide_next_action(self, objective: str, annotated_screenshot_b64: str, elements: List[ElementInfo], last_action_feedback: str) -> Dict:
-        """Get AI decision with STREAMING response capability."""
-        self.show_ai_analysis("🤖 AI is analyzing with advanced streaming algorithms...")
-        self.activate_status_bar(True)
+    
+    def _store_screenshot(self, screenshot_png: bytes, elements: Optional[ElementTable], filename: str,
+                          renderer: AnnotationRenderer = None) -> str:
+        """Annotate (when elements are given) and archive a raw capture."""
+        if elements:
+            # Key on the raw capture and overlay geometry, not the timestamped render
+            content_key = screenshot_png + elements.ids.tobytes() + elements.coordinates.tobytes()
+            annotated_screenshot = self._draw_advanced_labels_on_image(screenshot_png, elements, renderer=renderer)
+            filepath = self.screenshot_store.put(annotated_screenshot, label=filename, content_key=content_key)
+        else:
+            filepath = self.screenshot_store.put(screenshot_png, label=filename)
         
-        headers = {
-            "Authorization": f"Bearer {API_KEY}",
-            "Content-Type": "application/json"
-        }
+        logger.info(f"📸 Advanced screenshot saved: {filepath} ({filename})")
+        return filepath
+    
+    def _record_action_result(self, result: ActionResult, filename: str):
+        """Grab the raw screenshot now; annotate, archive and log the result in the background.
         
-        # Create enhanced element descriptions with ONLY VISIBLE elements
-        element_descriptions = []
-        visible_elements = [e for e in elements if e.is_visible and e.confidence_score >= 0.3]
+        With the pipeline the capture itself runs on the pipeline thread over the
+        DevTools channel, so the main thread goes straight on to settling.
+        """
+        with self._history_lock:
+            self.action_history.append(result)
+        if PIPELINE_ENABLED and self.devtools.connect():
+            self.pipeline.submit(self._capture_and_persist, result, self.elements_cache, filename)
+            return
+        try:
+            screenshot_png = self.get_screenshot_as_png()
+        except Exception as e:
+            logger.error(f"Error capturing screenshot: {e}")
+            screenshot_png = None
+        self.artifact_writer.submit(self._persist_action_result, result, screenshot_png, self.elements_cache, filename)
+    
+    def _capture_and_persist(self, result: ActionResult, elements: ElementTable, filename: str):
+        with self.step_timer.phase('capture'):
+            try:
+                screenshot_png = self.pipeline_capture.capture('png')
+            except Exception as e:
+                logger.error(f"Error capturing screenshot: {e}")
+                screenshot_png = None
+        self.artifact_writer.submit(self._persist_action_result, result, screenshot_png, elements, filename)
+    
+    def _persist_action_result(self, result: ActionResult, screenshot_png: Optional[bytes],
+                               elements: ElementTable, filename: str):
+        with self.step_timer.phase('persist'):
+            if screenshot_png is not None:
+                try:
+                    if self._artifact_renderer is None:
+                        self._artifact_renderer = type(self.annotation_renderer)(prerender_ids=ELEMENT_SCAN_LIMIT)
+                    screenshot_path = self._store_screenshot(screenshot_png, elements, filename,
+                                                             renderer=self._artifact_renderer)
+                    with self._history_lock:
+                        result.screenshot_path = screenshot_path
+                except Exception as e:
+                    logger.error(f"Error saving screenshot: {e}")
+            self.db.log_action(result)
+    
+    def _record_llm_call(self, call: LLMCallMetrics):
+        """Log an LLM call's telemetry on the writer thread."""
+        tokens_per_second = f", {call.tokens_per_second:.0f} tok/s" if call.tokens_per_second else ""
+        logger.info(f"📡 LLM call {call.provider or '-'}: {'ok' if call.success else 'failed'} "
+                    f"{call.ttft or 0:.2f}s TTFT, {call.latency:.2f}s total{tokens_per_second}, "
+                    f"{call.request_bytes / 1024:.0f} KB sent ({call.image_bytes / 1024:.0f} KB image), "
+                    f"{call.chunks} chunks, {call.attempts} attempt(s), ${call.cost:.4f}")
+        self.artifact_writer.submit(self.db.log_llm_call, call, self.step_timer.steps + 1)
+    
+    def _flush_artifacts(self):
+        """Wait until queued captures and screenshot/database writes have finished."""
+        self.pipeline.submit(lambda: None).result()
+        self.artifact_writer.flush()
+    
+    def _action_history_snapshot(self, limit: int = None) -> List[ActionResult]:
+        """Copies of the last `limit` (default all) recorded results, taken under the history lock."""
+        with self._history_lock:
+            recent = self.action_history[-limit:] if limit else self.action_history
+            return [replace(result) for result in recent]
+
+    def decide_next_action(self, objective: str, annotated_screenshot_b64: Optional[str], elements: ElementTable,
+                           last_action_feedback: str, image_mime_type: str = "image/png", page_text: str = "",
+                           screenshot_loader: Callable[[], Tuple[str, str]] = None) -> Dict:
+        """Get AI decision with STREAMING response capability.
         
-        for i, e in enumerate(visible_elements[:30], 1):  # Renumber visible elements
-            confidence_indicator = "🟢" if e.confidence_score > 0.8 else "🟡" if e.confidence_score > 0.6 else "🔴"
-            type_indicator = "📝" if e.is_form_field else "👆" if e.is_clickable else "👁️"
-            visibility_indicator = "✅"  # All are visible now
-            
-            description = f"- ID {i}: {confidence_indicator}{type_indicator}{visibility_indicator} \"{e.label[:40]}\" ({e.tag_name}) [conf:{e.confidence_score:.1f}]"
-            element_descriptions.append(description)
-            # Update element ID to match visible numbering
-            e.id = i
+        `elements` is the ranked prompt selection (see ElementRelevanceRanker.select).
+        Without a screenshot the decision is made from `page_text` and element
+        coordinates; if the model answers REQUEST_SCREENSHOT, `screenshot_loader`
+        supplies (base64, mime type) and the model is asked again with the image.
+        A confident decision made earlier for the same objective, page and
+        feedback is returned from the DecisionCache without calling the model.
+        """
+        try:
+            current_url = self.driver.current_url
+        except Exception:
+            current_url = ""
+        self._decision_cache_url = current_url
+        self._decision_cache_key = self.decision_cache.key(objective, current_url, elements, last_action_feedback)
+        cached_decision = self.decision_cache.get(self._decision_cache_key)
+        self._decision_from_cache = cached_decision is not None
+        if cached_decision is not None:
+            self._prepared_action = None
+            logger.info(f"♻️ Decision cache hit ({self.decision_cache.hit_rate:.0%} hit rate this session)")
+            print(f"♻️ Reusing cached decision: {json.dumps(cached_decision.get('action'))}")
+            return cached_decision
         
-        element_descriptions_text = "\n".join(element_descriptions)
+        self.show_ai_analysis("🤖 AI is analyzing with advanced streaming algorithms...")
+        self.activate_status_bar(True)
         
-        system_prompt = f"""You are a powerful AI web automation agent with STREAMING response capabilities. Your goal is to achieve objectives through precise actions.
-
-**CONTEXT:**
-- **Objective:** {objective}
-- **URL:** {self.driver.current_url}
-- **Previous Result:** {last_action_feedback}
-- **Screenshot:** Shows NUMBERED interactive elements with colored boxes
-
-**VISIBLE ELEMENTS (Confidence ≥ 0.3):**
-{element_descriptions_text}
-
-**AVAILABLE ACTIONS:**
-1. NAVIGATE - Go to URL: {{"url": "https://example.com"}}
-2. CLICK - Click element: {{"id": 1}}
-3. TYPE - Type text: {{"id": 1, "text": "search query"}}
-4. HOVER - Hover element: {{"id": 1}}
-5. SCROLL - Scroll page: {{"direction": "down", "pixels": 500}}
-6. WAIT - Wait time: {{"seconds": 2}}
-7. PRESS_KEY - Press key: {{"key": "Enter"}}
-8. CLEAR - Clear input: {{"id": 1}}
-9. SELECT - Select option: {{"id": 1, "option": "value"}}
-10. TAKE_SCREENSHOT - Screenshot: {{}}
-11. EXECUTE_JS - JavaScript: {{"script": "code"}}
-12. REFRESH - Reload page: {{}}
-13. GO_BACK - Browser back: {{}}
-14. ANSWER - Complete task: {{"text": "Final answer"}}
-
-**RESPONSE FORMAT (Required JSON):**
-{{
-    "thought": "Detailed reasoning about next action",
-    "confidence": 0.9,
-    "reasoning": "Why this action will help achieve the objective",
-    "action": {{
-        "name": "ACTION_NAME",
-        "parameters": {{
-            "id": 1,
-            "text": "if_needed"
-        }}
-    }}
-}}
-
-**CRITICAL RULES:**
-- Use ONLY the numbered IDs from the visible elements list above
-- Always provide confidence score (0.0-1.0)
-- Be specific and goal-oriented
-- Handle errors gracefully
-"""
-
-        payload = {
-            "model": MODEL_NAME,
-            "messages": [
-                {"role": "system", "content": system_prompt},
-                {
-                    "role": "user",
-                    "content": [
-                        {
-                            "type": "image_url",
-                            "image_url": {"url": f"data:image/png;base64,{annotated_screenshot_b64}"}
-                        }
-                    ]
-                }
-            ],
-            "max_tokens": 1500,
-            "response_format": {"type": "json_object"},
-            "temperature": 0.2,  # Lower for more consistent responses
-            "stream": True  # Enable streaming
-        }
-
+        request = None
         try:
-            # STREAMING RESPONSE IMPLEMENTATION
-            response = requests.post(API_ENDPOINT_URL, headers=headers, json=payload, timeout=90, stream=True)
-            response.raise_for_status()
-            
-            # Collect streaming response
-            content = ""
-            print("🔄 AI Streaming Response: ", end="", flush=True)
-            
-            for line in response.iter_lines():
-                if line:
-                    line_text = line.decode('utf-8')
-                    if line_text.startswith('data: '):
-                        try:
-                            data_str = line_text[6:]  # Remove 'data: ' prefix
-                            if data_str.strip() == '[DONE]':
-                                break
-                            
-                            data = json.loads(data_str)
-                            if 'choices' in data and len(data['choices']) > 0:
-                                delta = data['choices'][0].get('delta', {})
-                                if 'content' in delta:
-                                    chunk = delta['content']
-                                    content += chunk
-                                    print(chunk, end="", flush=True)  # Stream to console
-                                    time.sleep(0.01)  # Small delay for visual effect
-                        except json.JSONDecodeError:
-                            continue
-            
-            print("\n")  # New line after streaming
-            
-            if content:
-                decision = json.loads(content)
+            while True:
+                # Static, cacheable system prompt; everything per-step goes in a budgeted user-message suffix
+                prompt_suffix, listed_elements = self.prompt_budget.build(
+                    objective, current_url, last_action_feedback, elements,
+                    page_text=page_text if annotated_screenshot_b64 is None else None
+                )
+                
+                # Provider-neutral request; the router picks the provider and formats the payload
+                request = LLMRequest(
+                    system_prompt=PromptBudgetManager.SYSTEM_PROMPT,
+                    user_text=prompt_suffix,
+                    image_b64=annotated_screenshot_b64,
+                    image_mime_type=image_mime_type,
+                    max_tokens=1500,
+                    temperature=0.2  # Lower for more consistent responses
+                )
+                
+                # STREAMING RESPONSE IMPLEMENTATION
+                # Collect streaming response; the action starts as soon as its object closes
+                parser = StreamingJSONParser()
+                self._prepared_action = None
+                print("🔄 AI Streaming Response: ", end="", flush=True)
+                
+                for chunk in self.llm_router.stream(request):
+                    print(chunk, end="", flush=True)  # Stream to console
+                    if 'action' in parser.feed(chunk):
+                        self._prepare_action(parser.values['action'])
+                
+                print("\n")  # New line after streaming
+                self._log_prompt_tokens(prompt_suffix, listed_elements, len(elements), annotated_screenshot_b64)
+                
+                if not parser.text:
+                    return {"thought": "Empty streaming response", "action": None}
+                decision = parser.result()
+                
+                action = decision.get('action') or {}
+                if action.get('name') == 'REQUEST_SCREENSHOT' and annotated_screenshot_b64 is None and screenshot_loader:
+                    print("🖼️ AI asked for the screenshot - deciding again with it attached")
+                    self.decision_mode_stats['requested'] += 1
+                    annotated_screenshot_b64, image_mime_type = screenshot_loader()
+                    continue
                 
                 # Log enhanced decision details
                 thought = decision.get('thought', 'No thought provided')
                 confidence = decision.get('confidence', 0.5)
                 reasoning = decision.get('reasoning', 'No reasoning provided')
                 
-                logger.info(f"🧠 AI Decision - Confidence: {confidence:.2f}")
+                logger.info(f"🧠 AI Decision ({self.llm_router.last_provider}) - Confidence: {confidence:.2f}")
                 logger.info(f"💭 Thought: {thought}")
                 logger.info(f"🎯 Reasoning: {reasoning}")
                 
                 return decision
-            else:
-                return {"thought": "Empty streaming response", "action": None}
                 
         except Exception as e:
             logger.error(f"Error getting AI decision: {e}")
+            if request is None:
+                # Failed while building the request; there is nothing to retry
+                return {"thought": f"Error: {e}", "action": None}
             # Fallback to non-streaming if streaming fails
             try:
-                payload["stream"] = False
-                response = requests.post(API_ENDPOINT_URL, headers=headers, json=payload, timeout=60)
-                response.raise_for_status()
-                data = response.json()
-                if "choices" in data and len(data["choices"]) > 0:
-                    content = data["choices"][0]["message"]["content"]
-                    return json.loads(content)
-            except:
-                pass
+                parser = StreamingJSONParser()
+                parser.feed(self.llm_router.complete(request, read_timeout=60, retry=True))
+                self._log_prompt_tokens(prompt_suffix, listed_elements, len(elements), annotated_screenshot_b64)
+                return parser.result()
+            except Exception as fallback_error:
+                logger.error(f"Non-streaming fallback failed: {fallback_error}")
             return {"thought": f"Error: {e}", "action": None}
         finally:
             self.activate_status_bar(False)
 
-    def _switch_to_iframe_if_needed(self, element_id: int) -> bool:
-        """Switch to iframe if the target element is inside one."""
+    def _decision_view(self, elements: ElementTable, recent_failure: bool) -> Tuple[str, Optional[str]]:
+        """(page text, reason to attach the screenshot or None) under DECISION_MODE."""
+        if DECISION_MODE == "vision":
+            self.decision_mode_stats['vision'] += 1
+            return "", "vision mode"
+        
+        view = self.page_text_view.capture()
+        reason = None if DECISION_MODE == "text" else self.page_text_view.screenshot_reason(view, elements, recent_failure)
+        if reason:
+            self.decision_mode_stats['vision'] += 1
+            logger.info(f"🖼️ Screenshot attached: {reason}")
+            return "", reason
+        self.decision_mode_stats['text'] += 1
+        logger.info("📝 Text-only decision")
+        return self.page_text_view.render(view, PROMPT_TEXT_VIEW_TOKENS), None
+    
+    def _annotated_screenshot(self, annotation_key: Tuple, elements: ElementTable, capture: Future = None,
+                              renderer: AnnotationRenderer = None) -> Tuple[str, str]:
+        """(base64, mime type) of the annotated screenshot for the model, reused while the page is unchanged.
+        
+        On the pipeline thread `capture` is the pending (png, scale) from
+        _start_screenshot_capture and `renderer` that thread's own renderer.
+        """
+        if annotation_key[0] is not None and self._annotation_cache and self._annotation_cache[0] == annotation_key:
+            return self._annotation_cache[1]
+        
+        # Newest screencast frame if streaming, otherwise capture at the model's resolution;
+        # either way annotate with scaled coordinates
+        if capture is not None:
+            screenshot_png, capture_scale = capture.result()
+        else:
+            with self.step_timer.phase('capture'):
+                frame = self.screencast.current_frame()
+                if frame is not None:
+                    screenshot_png, capture_scale = frame.data, frame.scale
+                else:
+                    screenshot_png, capture_scale = self.screenshot_capture.capture_viewport(
+                        'png', max_edge=self.screenshot_encoder.max_edge
+                    )
+        with self.step_timer.phase('annotate'):
+            annotated_screenshot = self._draw_advanced_labels_on_image(
+                screenshot_png,
+                elements.scaled(capture_scale) if capture_scale != 1.0 else elements,
+                encoder=self.screenshot_encoder, renderer=renderer
+            )
+        screenshot = (base64.b64encode(annotated_screenshot).decode('utf-8'), self.screenshot_encoder.mime_type)
+        self._annotation_cache = (annotation_key, screenshot)
+        logger.debug(f"Screenshot payload: {len(screenshot_png) / 1024:.0f} KB capture -> "
+                     f"{len(annotated_screenshot) / 1024:.0f} KB {self.screenshot_encoder.image_format}")
+        return screenshot
+    
+    def _start_screenshot_capture(self, page_key: Optional[str]) -> Optional[Future]:
+        """Start capturing the model screenshot on the pipeline thread while the main thread scans.
+        
+        Only when the step will probably send a screenshot (vision mode, or the
+        previous step needed one) and the cached annotation is for another page.
+        """
+        if not (PIPELINE_ENABLED and self._screenshot_expected):
+            return None
+        if page_key is not None and self._annotation_cache and self._annotation_cache[0][0] == page_key:
+            return None
+        frame = self.screencast.current_frame()
+        if frame is not None:
+            return self.pipeline.submit(lambda: (frame.data, frame.scale))
+        if not self.devtools.connect():
+            return None
+        
+        def capture():
+            with self.step_timer.phase('capture'):
+                return self.pipeline_capture.capture_viewport('png', max_edge=self.screenshot_encoder.max_edge)
+        return self.pipeline.submit(capture)
+    
+    def _start_annotation(self, annotation_key: Tuple, elements: ElementTable, capture: Future) -> Future:
+        """Annotate the pipelined capture on the pipeline thread; resolves to (base64, mime type)."""
+        def annotate():
+            if self._pipeline_renderer is None:
+                self._pipeline_renderer = type(self.annotation_renderer)(prerender_ids=ELEMENT_SCAN_LIMIT)
+            return self._annotated_screenshot(annotation_key, elements, capture, renderer=self._pipeline_renderer)
+        return self.pipeline.submit(annotate)
+    
+    def _load_screenshot(self, annotation_key: Tuple, elements: ElementTable,
+                         annotation: Optional[Future]) -> Tuple[str, str]:
+        """Result of the pipelined annotation, or an inline capture if there is none or it failed."""
+        if annotation is not None:
+            try:
+                return annotation.result()
+            except Exception as e:
+                logger.warning(f"Pipelined screenshot failed, capturing inline: {e}")
+        return self._annotated_screenshot(annotation_key, elements)
+    
+    def _log_prompt_tokens(self, prompt_suffix: str, listed_elements: int, ranked_elements: int,
+                           image_b64: Optional[str] = None):
+        """Log estimated prompt size and image payload next to the provider's reported token counts."""
+        dynamic_tokens = ElementRelevanceRanker.estimate_tokens(prompt_suffix)
+        usage = self.llm_router.last_usage
+        stats = self.prompt_token_stats
+        stats['requests'] += 1
+        stats['dynamic_tokens'] += dynamic_tokens
+        for key in ('input_tokens', 'cached_tokens', 'output_tokens'):
+            stats[key] += usage.get(key, 0)
+        reported = (f"{usage.get('input_tokens', 0)} in ({usage.get('cached_tokens', 0)} cached), "
+                    f"{usage.get('output_tokens', 0)} out" if usage else "not reported")
+        image = f"{len(image_b64) * 3 // 4 / 1024:.0f} KB image" if image_b64 else "text only"
+        logger.info(f"🧮 Prompt ~{self.prompt_budget.system_tokens} static + ~{dynamic_tokens} dynamic tokens "
+                    f"({listed_elements}/{ranked_elements} elements, {image}) | {self.llm_router.last_provider}: {reported}")
+
+    def _prepare_action(self, action: Any):
+        """Start on a streamed action while the rest of the response arrives.
+        
+        For element actions in the main document the handle is resolved and the
+        cursor moved now; execute_advanced_action reuses both when the final
+        decision names the same element. Iframe targets are left alone because
+        resolving them switches the driver's frame.
+        """
+        if not isinstance(action, dict):
+            return
+        params = action.get("parameters") or {}
+        element_id = params.get("id") if isinstance(params, dict) else None
+        if action.get("name") not in ["CLICK", "TYPE", "HOVER", "CLEAR", "SELECT", "RIGHT_CLICK", "DOUBLE_CLICK", "GET_TEXT"] or element_id is None:
+            return
+        
         try:
-            # Check if element is in iframe
-            iframe_check_script = f"""
-            const element = document.querySelector('[data-element-id="{element_id}"]');
-            if (!element) return null;
-            
-            // Check if element is inside iframe
-            let currentDoc = element.ownerDocument;
-            if (currentDoc !== document) {{
-                // Find the iframe that contains this document
-                const iframes = document.querySelectorAll('iframe');
-                for (const iframe of iframes) {{
-                    try {{
-                        if (iframe.contentDocument === currentDoc) {{
-                            return {{
-                                found: true,
-                                iframe: iframe,
-                                iframeIndex: Array.from(document.querySelectorAll('iframe')).indexOf(iframe)
-                            }};
-                        }}
-                    }} catch (e) {{
-                        // Cross-origin iframe
-                    }}
-                }}
-            }}
-            return {{found: false}};
-            """
-            
-            result = self.driver.execute_script(iframe_check_script)
-            
-            if result and result.get('found'):
-                iframe_index = result.get('iframeIndex', 0)
-                iframes = self.driver.find_elements(By.TAG_NAME, "iframe")
-                if iframe_index < len(iframes):
-                    self.driver.switch_to.frame(iframes[iframe_index])
-                    logger.info(f"Switched to iframe {iframe_index} for element {element_id}")
-                    return True
-            
+            element_info = self.elements_cache.find(element_id) or self.element_index.table.find(element_id)
+            if not element_info or element_info.frame_path:
+                return
+            element, was_in_iframe = self._resolve_element_handle(element_info)
+            if was_in_iframe:
+                # Re-resolved into an iframe; leave it to execute_advanced_action
+                self._switch_back_from_iframe()
+                return
+            self.move_cursor_like_human(element)
+            self._prepared_action = {"id": element_id, "element": element}
+            logger.debug(f"Prepared element {element_id} while the response was streaming")
+        except Exception as e:
+            logger.debug(f"Early preparation of element {element_id} skipped: {e}")
+
+    def _switch_to_iframe_if_needed(self, element_info: ElementInfo) -> bool:
+        """Switch to the (possibly nested) iframe the target element lives in."""
+        return self._switch_to_frame_path(element_info.frame_path, element_info.id)
+
+    def _switch_to_frame_path(self, frame_path: str, element_id: int) -> bool:
+        """Follow an iframe index path such as '0/2' from the main document."""
+        if not frame_path:
             return False
+        
+        try:
+            for frame_index in frame_path.split('/'):
+                iframes = self.driver.find_elements(By.TAG_NAME, "iframe")
+                self.driver.switch_to.frame(iframes[int(frame_index)])
+            logger.info(f"Switched to iframe {frame_path} for element {element_id}")
+            return True
             
         except Exception as e:
-            logger.warning(f"Error checking iframe for element {element_id}: {e}")
+            logger.warning(f"Error switching to iframe for element {element_id}: {e}")
+            self._switch_back_from_iframe()
             return False
 
+    def _find_by_element_id(self, element_id: int, frame_path: str) -> Tuple[WebElement, bool]:
+        was_in_iframe = self._switch_to_frame_path(frame_path, element_id)
+        try:
+            selector = f'[{self.element_index.ID_ATTRIBUTE}="{element_id}"]'
+            return self.driver.find_element(By.CSS_SELECTOR, selector), was_in_iframe
+        except Exception:
+            if was_in_iframe:
+                self._switch_back_from_iframe()
+            raise
+
+    def _resolve_element_handle(self, element_info: ElementInfo) -> Tuple[WebElement, bool]:
+        """Resolve the WebElement for an indexed element by its id attribute.
+        
+        If the id is gone (the node was re-rendered), the element is re-resolved
+        by fingerprint through the in-page index in one targeted lookup instead
+        of a full rescan. Returns the element and whether the driver was switched
+        into an iframe; callers must switch back once they are done with it.
+        """
+        try:
+            element, was_in_iframe = self._find_by_element_id(element_info.id, element_info.frame_path)
+        except NoSuchElementException:
+            logger.warning(f"Element {element_info.id} not found by id, re-resolving by fingerprint...")
+            resolved = self.element_index.resolve(element_info.fingerprint)
+            if not resolved:
+                raise
+            if resolved.get('element') is not None:
+                element, was_in_iframe = resolved['element'], False
+            else:
+                element, was_in_iframe = self._find_by_element_id(resolved['id'], resolved.get('framePath', ''))
+            logger.info(f"Recovered stale element {element_info.id} as {resolved['id']}")
+        
+        element_info.element = element
+        return element, was_in_iframe
+
     def _switch_back_from_iframe(self):
         """Switch back to main content from iframe."""
         try:
@@ -2493,6 +5997,46 @@ class MegaAdvancedBrowserAgent:
         except Exception as e:
             logger.warning(f"Error switching back from iframe: {e}")
 
+    def execute_plan(self, decision: Dict) -> ActionResult:
+        """Run the decision's action and its planned follow-ups ("then"), checking each step's "expect".
+        
+        Stops at the first failed action, unmet post-condition or ANSWER and
+        returns the last step's result. For multi-step plans and unmet checks
+        the message gets a per-step summary for the next prompt, and
+        metadata['plan_complete'] tells whether every step ran and held.
+        """
+        steps = [decision.get("action")] + [step for step in (decision.get("then") or []) if isinstance(step, dict)]
+        steps = steps[:max(1, PLAN_MAX_STEPS)]
+        summary = []
+        complete = False
+        
+        for index, step in enumerate(steps):
+            try:
+                start_url = self.driver.current_url
+            except Exception:
+                start_url = ""
+            if index:
+                print(f"📋 Plan step {index + 1}/{len(steps)}: {step.get('name')} {json.dumps(step.get('parameters', {}))}")
+            result = self.execute_advanced_action(decision if index == 0 else {"action": step})
+            if not result.success or result.action_type == "ANSWER":
+                result.metadata['plan_complete'] = result.success
+                return result
+            
+            unmet = self.plan_verifier.verify(step, start_url)
+            if unmet:
+                summary.append(f"{step.get('name')} ⚠️ {'; '.join(unmet)}")
+                break
+            summary.append(f"{step.get('name')} ✓")
+            if index < len(steps) - 1:
+                self.visual_stability.wait()  # Let the step's effects land before the next one
+        else:
+            complete = True
+        
+        if len(steps) > 1 or not complete:
+            result.message = f"{result.message} | Plan {len(summary) - (not complete)}/{len(steps)} verified: {', '.join(summary)}"
+        result.metadata['plan_complete'] = complete
+        return result
+
     def execute_advanced_action(self, decision: Dict) -> ActionResult:
         """Execute the AI's decision with advanced error handling and logging."""
         start_time = time.time()
@@ -2569,46 +6113,38 @@ class MegaAdvancedBrowserAgent:
                     else:
                         return self._create_error_result(action_name, f"Element ID not provided for {action_name} action", start_time, action_start_time)
                 
-                # Get target element with enhanced error handling and stale element recovery
+                # Resolve the target WebElement lazily; ids are stable, so the full
+                # index mirror can serve ids that fell outside the prompt's top rows
                 target_element = None
-                target_element_info = None
+                target_element_info = self.elements_cache.find(element_id) or self.element_index.table.find(element_id)
+                was_in_iframe = False
+                prepared = self._prepared_action if self._prepared_action and self._prepared_action["id"] == element_id else None
+                self._prepared_action = None
                 
-                for element_info in self.elements_cache:
-                    if element_info.id == element_id:
-                        try:
-                            # Test if element is still valid
-                            _ = element_info.element.is_displayed()
-                            target_element = element_info.element
-                            target_element_info = element_info
-                            break
-                        except StaleElementReferenceException:
-                            # Element is stale, try to re-find it
-                            logger.warning(f"Element {element_id} is stale, attempting to re-find...")
-                            try:
-                                # Re-detect elements and update cache
-                                self.elements_cache = self.get_advanced_elements()
-                                # Try to find the element again by similar attributes
-                                for new_element_info in self.elements_cache:
-                                    if (new_element_info.tag_name == element_info.tag_name and 
-                                        new_element_info.label == element_info.label):
-                                        target_element = new_element_info.element
-                                        target_element_info = new_element_info
-                                        logger.info(f"Successfully recovered stale element {element_id}")
-                                        break
-                            except Exception as recovery_error:
-                                logger.error(f"Failed to recover stale element: {recovery_error}")
-                                continue
+                if target_element_info and prepared:
+                    target_element = prepared["element"]
+                elif target_element_info:
+                    try:
+                        target_element, was_in_iframe = self._resolve_element_handle(target_element_info)
+                    except (NoSuchElementException, StaleElementReferenceException) as e:
+                        logger.error(f"Failed to recover stale element {element_id}: {e}")
                 
                 if not target_element:
-                    available_ids = [e.id for e in self.elements_cache[:20]]
+                    available_ids = self.elements_cache.ids[:20].tolist()
                     return self._create_error_result(action_name, f"Element ID {element_id} not found. Available: {available_ids}", start_time, action_start_time)
                 
-                # Move cursor to element with human-like movement
-                self.move_cursor_like_human(target_element)
-                self.show_progress(75)
-                
-                # Execute specific action
-                result = self._execute_element_action(action_name, params, target_element, target_element_info, start_time, action_start_time)
+                try:
+                    # Move cursor to element with human-like movement (already done while streaming)
+                    if not prepared:
+                        self.move_cursor_like_human(target_element)
+                    self.show_progress(75)
+                    
+                    # Execute specific action
+                    result = self._execute_element_action(action_name, params, target_element, target_element_info, start_time, action_start_time)
+                finally:
+                    # Always switch back from iframe
+                    if was_in_iframe:
+                        self._switch_back_from_iframe()
                 self.show_progress(100)
                 return result
             
@@ -2619,7 +6155,7 @@ class MegaAdvancedBrowserAgent:
                 
                 scroll_amount = pixels if direction == "down" else -pixels
                 self.driver.execute_script(f"window.scrollBy(0, {scroll_amount});")
-                time.sleep(0.5)  # Wait for scroll to complete
+                self.visual_stability.wait()  # Lazy-loaded content and sticky headers
                 
                 return self._create_success_result("SCROLL", f"✅ Scrolled {direction} {pixels}px", start_time, action_start_time)
             
@@ -2718,39 +6254,28 @@ class MegaAdvancedBrowserAgent:
         try:
             if action_name == "CLICK":
                 self.show_ai_analysis(f"🎯 Clicking {target_element_info.label[:30]}...")
+                in_iframe = bool(target_element_info.frame_path)
                 
-                # Check if element is in iframe and switch if needed
-                was_in_iframe = self._switch_to_iframe_if_needed(target_element_info.id)
+                # Advanced click strategies with iframe support
+                strategies = [
+                    lambda: target_element.click(),
+                    lambda: self.driver.execute_script("arguments[0].click();", target_element),
+                    lambda: ActionChains(self.driver).click(target_element).perform(),
+                    lambda: self.driver.execute_script("arguments[0].dispatchEvent(new MouseEvent('click', {bubbles: true}));", target_element),
+                    lambda: ActionChains(self.driver).move_to_element(target_element).click().perform()
+                ]
                 
-                try:
-                    # Re-find element if we switched to iframe
-                    if was_in_iframe:
-                        target_element = self.driver.find_element(By.XPATH, f"//*[@data-element-id='{target_element_info.id}']")
-                    
-                    # Advanced click strategies with iframe support
-                    strategies = [
-                        lambda: target_element.click(),
-                        lambda: self.driver.execute_script("arguments[0].click();", target_element),
-                        lambda: ActionChains(self.driver).click(target_element).perform(),
-                        lambda: self.driver.execute_script("arguments[0].dispatchEvent(new MouseEvent('click', {bubbles: true}));", target_element),
-                        lambda: ActionChains(self.driver).move_to_element(target_element).click().perform()
-                    ]
-                    
-                    for i, strategy in enumerate(strategies):
-                        try:
-                            self.driver.execute_script("arguments[0].scrollIntoView({block: 'center'});", target_element)
-                            time.sleep(0.3)
-                            strategy()
-                            logger.info(f"✅ Click successful using strategy {i+1}" + (" (iframe)" if was_in_iframe else ""))
-                            return self._create_success_result("CLICK", f"✅ Successfully clicked {target_element_info.label[:50]}" + (" (iframe)" if was_in_iframe else ""), start_time, action_start_time, target_element_info.id)
-                        except Exception as e:
-                            if i == len(strategies) - 1:
-                                raise e
-                            continue
-                finally:
-                    # Always switch back from iframe
-                    if was_in_iframe:
-                        self._switch_back_from_iframe()
+                for i, strategy in enumerate(strategies):
+                    try:
+                        self.driver.execute_script("arguments[0].scrollIntoView({block: 'center'});", target_element)
+                        self.visual_stability.wait(max_wait=1.0, quiet_period=0.1)
+                        strategy()
+                        logger.info(f"✅ Click successful using strategy {i+1}" + (" (iframe)" if in_iframe else ""))
+                        return self._create_success_result("CLICK", f"✅ Successfully clicked {target_element_info.label[:50]}" + (" (iframe)" if in_iframe else ""), start_time, action_start_time, target_element_info.id)
+                    except Exception as e:
+                        if i == len(strategies) - 1:
+                            raise e
+                        continue
             
             elif action_name == "TYPE":
                 text = params.get("text", "")
@@ -2768,11 +6293,10 @@ class MegaAdvancedBrowserAgent:
                     
                     # Scroll and focus with better timing
                     self.driver.execute_script("arguments[0].scrollIntoView({block: 'center', behavior: 'smooth'});", target_element)
-                    time.sleep(0.5)
+                    self.visual_stability.wait()
                     
                     # Focus the element first
                     self.driver.execute_script("arguments[0].focus();", target_element)
-                    time.sleep(0.2)
                     
                     # Try multiple clearing methods
                     try:
@@ -2780,11 +6304,8 @@ class MegaAdvancedBrowserAgent:
                     except:
                         # Fallback: Select all and delete
                         target_element.send_keys(Keys.CONTROL + "a")
-                        time.sleep(0.1)
                         target_element.send_keys(Keys.DELETE)
                     
-                    time.sleep(0.2)
-                    
                     # Type with enhanced error handling
                     try:
                         # Try direct send_keys first
@@ -2818,7 +6339,7 @@ class MegaAdvancedBrowserAgent:
             elif action_name == "HOVER":
                 self.show_ai_analysis(f"👆 Hovering over {target_element_info.label[:30]}...")
                 ActionChains(self.driver).move_to_element(target_element).perform()
-                time.sleep(0.5)
+                self.visual_stability.wait()  # Hover menus and tooltips animate in
                 return self._create_success_result("HOVER", f"✅ Successfully hovered over {target_element_info.label[:30]}", start_time, action_start_time, target_element_info.id)
             
             elif action_name == "CLEAR":
@@ -2879,40 +6400,27 @@ class MegaAdvancedBrowserAgent:
         best_candidate = None
         best_score = 0
         
-        for element_info in self.elements_cache:
-            if not element_info.is_form_field:
-                continue
-                
-            score = 0
-            label_lower = element_info.label.lower();
+        # Score every form field at once over the table columns
+        fields = self.elements_cache.where(form_field=True)
+        if len(fields):
+            labels_lower = np.char.lower(fields.labels.astype(str))
+            attribute_columns = [ElementTable.ATTRIBUTE_NAMES.index(name) for name in ('name', 'id', 'class')]
+            attributes_lower = np.char.lower(fields.attributes[:, attribute_columns].astype(str))
             
-            # Check for search-related terms
+            scores = np.zeros(len(fields), dtype=np.float32)
             for term in search_terms:
-                if term in label_lower:
-                    score += 0.3;
-            
-            # Prefer visible elements
-            if element_info.is_visible:
-                score += 0.2;
+                # Check for search-related terms in labels and attributes
+                scores += 0.3 * (np.char.find(labels_lower, term) >= 0)
+                scores += 0.2 * (np.char.find(attributes_lower, term) >= 0).sum(axis=1)
             
-            # Prefer elements with higher confidence
-            score += element_info.confidence_score * 0.3;
+            scores += 0.2 * fields.visible  # Prefer visible elements
+            scores += 0.3 * fields.confidence  # Prefer elements with higher confidence
+            scores += 0.1 * (fields.tag_names == 'input')  # Prefer input fields over textareas
             
-            # Prefer input fields over textareas
-            if element_info.tag_name == 'input':
-                score += 0.1;
-            
-            # Check element attributes
-            for attr_name, attr_value in element_info.attributes.items():
-                if attr_name in ['placeholder', 'name', 'id', 'class']:
-                    attr_lower = attr_value.lower();
-                    for term in search_terms:
-                        if term in attr_lower:
-                            score += 0.2;
-            
-            if score > best_score:
-                best_score = score;
-                best_candidate = element_info.id;
+            best_row = int(np.argmax(scores))
+            if scores[best_row] > 0:
+                best_score = float(scores[best_row])
+                best_candidate = int(fields.ids[best_row])
         
         logger.info(f"Auto-detected input field: ID {best_candidate} with score {best_score:.2f}")
         return best_candidate
@@ -2920,40 +6428,37 @@ class MegaAdvancedBrowserAgent:
     def _create_success_result(self, action_type: str, message: str, start_time: float, timestamp: datetime, element_id: int = None) -> ActionResult:
         """Create a successful action result."""
         self.session_data['successful_actions'] += 1
-        screenshot_path = self.save_advanced_screenshot(f"success_{action_type.lower()}_{timestamp.strftime('%H%M%S')}.png")
         
+        # screenshot_path is filled in by the artifact writer
         result = ActionResult(
             success=True,
             action_type=action_type,
             message=message,
             duration=time.time() - start_time,
-            screenshot_path=screenshot_path,
+            screenshot_path=None,
             element_id=element_id,
             error_details=None,
             timestamp=timestamp
         )
         
-        self.action_history.append(result)
-        self.db.log_action(result)
+        self._record_action_result(result, f"success_{action_type.lower()}_{timestamp.strftime('%H%M%S')}.png")
         return result
 
     def _create_error_result(self, action_type: str, message: str, start_time: float, timestamp: datetime, element_id: int = None) -> ActionResult:
         """Create an error action result."""
-        screenshot_path = self.save_advanced_screenshot(f"error_{action_type.lower()}_{timestamp.strftime('%H%M%S')}.png")
-        
+        # screenshot_path is filled in by the artifact writer
         result = ActionResult(
             success=False,
             action_type=action_type,
             message=f"❌ {message}",
             duration=time.time() - start_time,
-            screenshot_path=screenshot_path,
+            screenshot_path=None,
             element_id=element_id,
             error_details=message,
             timestamp=timestamp
         )
         
-        self.action_history.append(result)
-        self.db.log_action(result)
+        self._record_action_result(result, f"error_{action_type.lower()}_{timestamp.strftime('%H%M%S')}.png")
         return result
 
     def _extract_url_from_command(self, command: str) -> Optional[str]:
@@ -3046,6 +6551,7 @@ class MegaAdvancedBrowserAgent:
             if self.session_data['total_actions'] > 0:
                 success_rate = (self.session_data['successful_actions'] / self.session_data['total_actions']) * 100
             
+            self._flush_artifacts()
             report_data = {
                 'session_start': self.session_data['start_time'],
                 'session_end': end_time,
@@ -3054,8 +6560,10 @@ class MegaAdvancedBrowserAgent:
                 'successful_actions': self.session_data['successful_actions'],
                 'success_rate': round(success_rate, 1),
                 'websites_visited': len(self.session_data['websites_visited']),
-                'actions': self.action_history[-20:],  # Last 20 actions
-                'total_duration': session_duration
+                'actions': self._action_history_snapshot(20),  # Last 20 actions
+                'total_duration': session_duration,
+                'filmstrip': self.screencast.filmstrip() if self.screencast.timeline else [],
+                'llm_calls': self.db.llm_call_summary(self.session_data['start_time'])
             }
             
             report_path = self.report_generator.generate_html_report(report_data)
@@ -3173,10 +6681,10 @@ class MegaAdvancedBrowserAgent:
                             logger.info("Cloudflare CAPTCHA checkbox detected, clicking...")
                             # Scroll into view and click
                             self.driver.execute_script("arguments[0].scrollIntoView(true);", checkbox)
-                            time.sleep(1)
+                            self.visual_stability.wait(max_wait=1.0)
                             checkbox.click()
                             logger.info("Cloudflare CAPTCHA checkbox clicked successfully")
-                            time.sleep(3)  # Wait for verification
+                            self.visual_stability.wait()  # Wait for verification
                             return True
                 except:
                     continue
@@ -3193,10 +6701,10 @@ class MegaAdvancedBrowserAgent:
                         if not checkbox.is_selected():
                             logger.info("Found 'Verify you are human' checkbox, clicking...")
                             self.driver.execute_script("arguments[0].scrollIntoView(true);", checkbox)
-                            time.sleep(1)
+                            self.visual_stability.wait(max_wait=1.0)
                             checkbox.click()
                             logger.info("Human verification checkbox clicked successfully")
-                            time.sleep(3)
+                            self.visual_stability.wait()
                             return True
             except:
                 pass
@@ -3230,8 +6738,8 @@ class MegaAdvancedBrowserAgent:
             if captcha_images:
                 logger.info("Image CAPTCHA detected")
                 # Screenshot and solve
-                captcha_images[0].screenshot("temp/captcha.png")
-                solution = self.captcha_solver.solve_image_captcha("temp/captcha.png")
+                captcha_png = self.screenshot_capture.capture_element(captcha_images[0])
+                solution = self.captcha_solver.solve_image_captcha(captcha_png)
                 
                 if solution:
                     # Find input field and enter solution
@@ -3385,6 +6893,157 @@ class MegaAdvancedBrowserAgent:
         self._generate_performance_report(metrics_list)
         return metrics_list
     
+    def benchmark_element_scanners(self, iterations: int = 5, synthetic_elements: int = 0) -> Dict[str, Dict[str, float]]:
+        """Compare scan latency of the JS index and the CDP DOMSnapshot scanner on the current page.
+        
+        With synthetic_elements > 0 a fixture of that many mixed interactive
+        elements is appended to the page first (and removed afterwards).
+        """
+        if synthetic_elements:
+            self.driver.execute_script("""
+                const fixture = document.createElement('div');
+                fixture.id = 'ai-benchmark-fixture';
+                const kinds = ['button', 'a', 'input', 'select', 'textarea'];
+                for (let i = 0; i < arguments[0]; i++) {
+                    const el = document.createElement(kinds[i % kinds.length]);
+                    if (el.tagName === 'A') el.href = '#item-' + i;
+                    if (el.tagName === 'INPUT') el.placeholder = 'Field ' + i;
+                    el.textContent = el.tagName === 'INPUT' ? '' : 'Item ' + i;
+                    fixture.appendChild(el);
+                }
+                document.body.appendChild(fixture);
+            """, synthetic_elements)
+        
+        def timed(scan) -> Tuple[List[float], int]:
+            samples, found = [], 0
+            for _ in range(iterations):
+                start = time.perf_counter()
+                found = len(scan())
+                samples.append((time.perf_counter() - start) * 1000)
+            return samples, found
+        
+        js_index = IncrementalElementIndex(self.driver)
+        snapshot_scanner = DOMSnapshotElementScanner(self.driver)
+        results = {}
+        try:
+            runs = {
+                'js_full': lambda: (js_index.reset(), js_index.collect())[1],
+                'js_delta': js_index.collect,
+                'cdp_snapshot': snapshot_scanner.collect
+            }
+            for name, scan in runs.items():
+                samples, found = timed(scan)
+                results[name] = {
+                    'mean_ms': float(np.mean(samples)),
+                    'p50_ms': float(np.percentile(samples, 50)),
+                    'min_ms': float(np.min(samples)),
+                    'elements': found
+                }
+        finally:
+            if synthetic_elements:
+                self.driver.execute_script(
+                    "const f = document.getElementById('ai-benchmark-fixture'); if (f) f.remove();")
+            # The benchmark's JS index shares the page-level index with the agent
+            self.element_index.reset()
+        
+        report = f"""
+        Element Scanner Benchmark
+        =========================
+        URL: {self.driver.current_url}
+        Iterations: {iterations}
+        Synthetic elements: {synthetic_elements}
+        
+        """
+        for name, stats in results.items():
+            report += (f"\n{name:<14} mean {stats['mean_ms']:8.1f} ms   p50 {stats['p50_ms']:8.1f} ms   "
+                       f"min {stats['min_ms']:8.1f} ms   elements {stats['elements']}")
+        report += ("\n\njs_full re-emits every tracked element from the in-page index; js_delta is the "
+                   "per-step cost with no DOM changes; cdp_snapshot is one DOMSnapshot.captureSnapshot "
+                   "call plus Python-side parsing (out-of-process iframes are not included).")
+        
+        report_file = f"reports/element_scan_benchmark_{datetime.now().strftime('%Y%m%d_%H%M%S')}.txt"
+        with open(report_file, 'w') as f:
+            f.write(report)
+        
+        logger.info(f"Element scanner benchmark saved to {report_file}")
+        return results
+    
+    def benchmark_annotation_backends(self, sizes: Tuple[int, ...] = (50, 200, 1000),
+                                      iterations: int = 3) -> Dict[str, Dict[int, float]]:
+        """Time the PIL and OpenCV annotation backends on the current screenshot.
+        
+        Element tables of each size are synthesized with random boxes over the
+        viewport, so the numbers do not depend on the page's own elements.
+        """
+        screenshot_png = self.get_screenshot_as_png()
+        width, height = Image.open(BytesIO(screenshot_png)).size
+        rng = np.random.default_rng(0)
+        renderers = {
+            'pil': AnnotationRenderer(prerender_ids=max(sizes)),
+            'opencv': OpenCVAnnotationRenderer(prerender_ids=max(sizes))
+        }
+        tags = np.array(['a', 'button', 'input', 'select', 'div'], dtype=object)
+        
+        base_image = Image.open(BytesIO(screenshot_png))
+        base_image.load()
+        base_array = cv2.imdecode(np.frombuffer(screenshot_png, dtype=np.uint8), cv2.IMREAD_COLOR)
+        draw_only = {
+            'pil': lambda elements: renderers['pil'].draw(base_image, elements),
+            'opencv': lambda elements: renderers['opencv'].draw_array(base_array.copy(), elements)
+        }
+        
+        def best_of(run) -> float:
+            samples = []
+            for _ in range(iterations):
+                start = time.perf_counter()
+                run()
+                samples.append((time.perf_counter() - start) * 1000)
+            return float(np.min(samples))
+        
+        results = {name: {} for name in list(renderers) + [f"{name}_draw" for name in renderers]}
+        for size in sizes:
+            w = rng.integers(20, 240, size)
+            h = rng.integers(14, 48, size)
+            elements = ElementTable(
+                ids=np.arange(1, size + 1),
+                coordinates=np.stack([rng.integers(0, max(1, width - 240), size),
+                                      rng.integers(40, max(41, height - 48), size), w, h], axis=1),
+                confidence=rng.uniform(0.3, 1.0, size),
+                visible=np.ones(size, dtype=bool),
+                clickable=rng.random(size) < 0.7,
+                form_field=rng.random(size) < 0.2,
+                tag_names=tags[rng.integers(0, len(tags), size)],
+                labels=[f"Element {i}" for i in range(size)],
+                element_types=[''] * size,
+                attributes=[[''] * len(ElementTable.ATTRIBUTE_NAMES)] * size,
+                text_content=[''] * size,
+                frame_paths=[''] * size
+            )
+            for name, renderer in renderers.items():
+                results[name][size] = best_of(
+                    lambda: renderer.render(screenshot_png, elements, footer=f"Benchmark | Elements: {size}"))
+                results[f"{name}_draw"][size] = best_of(lambda: draw_only[name](elements))
+        
+        report = f"""
+        Annotation Backend Benchmark
+        ============================
+        Screenshot: {width}x{height}
+        Iterations: {iterations} (best of)
+        
+        """
+        report += f"\n{'elements':>10}" + "".join(f"{name:>14}" for name in results)
+        for size in sizes:
+            report += f"\n{size:>10}" + "".join(f"{results[name][size]:>11.1f} ms" for name in results)
+        report += ("\n\npil/opencv cover decode, annotation and PNG encode of one screenshot; "
+                   "the _draw columns time the annotation step alone.")
+        
+        report_file = f"reports/annotation_benchmark_{datetime.now().strftime('%Y%m%d_%H%M%S')}.txt"
+        with open(report_file, 'w') as f:
+            f.write(report)
+        
+        logger.info(f"Annotation backend benchmark saved to {report_file}")
+        return results
+    
     def _generate_performance_report(self, metrics: List[PerformanceMetrics]):
         """Generate performance analysis report."""
         if not metrics:
@@ -3634,7 +7293,7 @@ class MegaAdvancedBrowserAgent:
         print("="*80)
         print(f"🖥️  System: {platform.system()} {platform.release()}")
         print(f"🐍 Python: {python_version} | 💾 RAM: {memory_gb}GB | 🔧 CPU: {cpu_count} cores")
-        print(f"🧠 AI Model: {MODEL_NAME} | 🌐 Provider: Mistral AI")
+        print(f"🧠 AI Model: {MODEL_NAME} | 🌐 Providers: {', '.join(LLM_PROVIDERS)}")
         print(f"📊 Session: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
         print("="*80)
     
@@ -3664,6 +7323,7 @@ class MegaAdvancedBrowserAgent:
                 os.environ['API_KEY'] = api_key
                 global API_KEY
                 API_KEY = api_key
+                AI_CONFIGS[DEFAULT_AI_PROVIDER]["api_key"] = api_key
                 print("✅ API key set for this session!")
                 print("💾 Don't forget to add it to your .env file for permanent use")
                 return
@@ -3782,6 +7442,7 @@ class MegaAdvancedBrowserAgent:
         current_time = datetime.now()
         session_duration = (current_time - self.session_data['start_time']).total_seconds()
         success_rate = (self.session_data['successful_actions'] / max(1, self.session_data['total_actions'])) * 100
+        self._flush_artifacts()
         
         print("\n" + "="*70)
         print("📊 ENHANCED SESSION STATISTICS")
@@ -3793,7 +7454,40 @@ class MegaAdvancedBrowserAgent:
         print(f"🌐 Websites Visited:    {len(self.session_data['websites_visited'])}")
         print(f"📝 Forms Filled:        {self.session_data.get('forms_filled', 0)}")
         print(f"🔍 Searches Performed:  {self.session_data.get('searches_performed', 0)}")
-        print(f"📸 Screenshots Taken:   {len([a for a in self.action_history if a.screenshot_path])}")
+        print(f"📸 Screenshots Taken:   {len([a for a in self._action_history_snapshot() if a.screenshot_path])}")
+        store_stats = self.screenshot_store.stats
+        print(f"🗂️ Unique Screenshots:  {store_stats['stored']} ({store_stats['deduplicated']} deduplicated, "
+              f"{store_stats['bytes_written'] / 1024:.0f} KB written)")
+        cache_stats = self.decision_cache.stats
+        print(f"♻️ Decision Cache:      {cache_stats['hits']} hits / {cache_stats['misses']} misses "
+              f"({self.decision_cache.hit_rate:.0%} hit rate, {cache_stats['stored']} stored)")
+        for provider, latency in self.llm_router.latency_summary().items():
+            if latency['samples']:
+                print(f"⏱️ LLM First Token:     {provider} p50 {latency['p50']:.2f}s / p95 {latency['p95']:.2f}s "
+                      f"({latency['samples']} calls)")
+        mode_stats = self.decision_mode_stats
+        if mode_stats['text'] or mode_stats['vision']:
+            print(f"📝 Decision Inputs:     {mode_stats['text']} text-only, {mode_stats['vision']} with screenshot "
+                  f"({mode_stats['requested']} screenshots requested by the AI)")
+        token_stats = self.prompt_token_stats
+        if token_stats['input_tokens']:
+            print(f"🧮 LLM Tokens:          {token_stats['input_tokens']} in ({token_stats['cached_tokens']} cached), "
+                  f"{token_stats['output_tokens']} out over {token_stats['requests']} calls")
+        if self.llm_router.stats['hedged']:
+            print(f"🏁 Hedged LLM Calls:    {self.llm_router.stats['hedged']} "
+                  f"({self.llm_router.stats['hedge_wins']} won by the backup provider)")
+        for summary in self.db.llm_call_summary(self.session_data['start_time']):
+            tokens_per_second = f", {summary['tokens_per_second']:.0f} tok/s" if summary['tokens_per_second'] else ""
+            print(f"📡 LLM Calls:           {summary['provider'] or '-'} {summary['calls']} calls "
+                  f"({summary['failures']} failed, {summary['retries']} retries), "
+                  f"{summary['avg_ttft'] or 0:.2f}s TTFT / {summary['avg_latency']:.2f}s total{tokens_per_second}, "
+                  f"{summary['request_bytes'] / 1024:.0f} KB sent, ${summary['cost']:.4f}")
+        timer = self.step_timer
+        if timer.steps:
+            slowest = sorted(timer.totals.items(), key=lambda item: -item[1])[:4]
+            print(f"⏱️ Step Timing:         {timer.wall_seconds / timer.steps:.2f}s avg, "
+                  f"{timer.overlap_seconds / timer.steps:.2f}s overlapped | " +
+                  ", ".join(f"{name} {seconds / timer.steps:.2f}s" for name, seconds in slowest))
         print(f"⚡ Avg Action Duration: {sum(a.duration for a in self.action_history)/max(1, len(self.action_history)):.2f}s")
         
         # Performance indicators
@@ -4005,20 +7699,30 @@ class MegaAdvancedBrowserAgent:
                 while time.time() - start_time < task_timeout and step_counter < max_steps:
                     step_counter += 1
                     print(f"\n--- 🔄 Step {step_counter}/{max_steps} ---")
+                    self.step_timer.start_step()
                     
                     try:
+                        # Cheap structural key first - after WAIT, failures and retries the page is usually identical
+                        with self.step_timer.phase('state'):
+                            page_key = self.page_state.capture()
+                            page_unchanged = self.page_state.is_unchanged(page_key) and bool(self.elements_cache)
+                        # The screenshot is captured on the pipeline thread while elements are scanned
+                        screenshot_capture = self._start_screenshot_capture(page_key)
+                        
                         # Get advanced elements with confidence scoring (faster detection)
                         retry_count = 0
-                        max_retries = 2  # Reduced retries for speed
+                        max_retries = 0 if page_unchanged else 2  # Reduced retries for speed
+                        if page_unchanged:
+                            print("♻️ Page unchanged since last step - reusing detected elements")
                         
                         while retry_count < max_retries:
-                            # Clear cache for fresh detection
-                            self.elements_cache = []
-                            self.elements_cache = self._get_advanced_interactive_elements()
+                            # Incremental detection - only DOM changes since the last step are re-scanned
+                            with self.step_timer.phase('scan'):
+                                self.elements_cache = self._get_advanced_interactive_elements()
                             if self.elements_cache or retry_count == max_retries - 1:
                                 break
                             print(f"⏳ No elements found, retrying... ({retry_count + 1}/{max_retries})")
-                            time.sleep(1)  # Reduced wait time
+                            self.visual_stability.wait(max_wait=1.0)
                             retry_count += 1
                         
                         if not self.elements_cache:
@@ -4026,24 +7730,42 @@ class MegaAdvancedBrowserAgent:
                             # Try to solve CAPTCHA if present
                             if self.solve_captcha_on_page():
                                 print("✅ CAPTCHA solved! Retrying element detection...")
-                                time.sleep(2)  # Wait for page to reload after CAPTCHA
+                                self.visual_stability.wait()  # Wait for page to reload after CAPTCHA
                                 continue
                             else:
                                 print("⚠️ No CAPTCHA found. Waiting for page to load...")
-                                time.sleep(3)
+                                self.visual_stability.wait()
                                 continue
                         
-                        print(f"🔍 Found {len(self.elements_cache)} interactive elements (avg confidence: {sum(e.confidence_score for e in self.elements_cache)/len(self.elements_cache):.2f})")
+                        print(f"🔍 Found {len(self.elements_cache)} interactive elements (avg confidence: {self.elements_cache.confidence.mean():.2f})")
+                        self.page_state.remember(page_key)
+                        
+                        # Rank elements against the objective; the image and prompt share the selection
+                        with self.step_timer.phase('rank'):
+                            prompt_elements = self.element_ranker.select(
+                                self.elements_cache, objective, last_action_feedback,
+                                token_budget=self.prompt_budget.element_budget(objective, self.driver.current_url, last_action_feedback)
+                            )
+                        annotation_key = (page_key, tuple(prompt_elements.ids.tolist()))
+                        # Annotate on the pipeline thread while the text view is read
+                        annotation = (self._start_annotation(annotation_key, prompt_elements, screenshot_capture)
+                                      if screenshot_capture is not None else None)
+                        load_screenshot = lambda: self._load_screenshot(annotation_key, prompt_elements, annotation)
                         
-                        # Take advanced screenshot and annotate
-                        screenshot_png = self.get_screenshot_as_png()
-                        annotated_screenshot = self._draw_advanced_labels_on_image(screenshot_png, self.elements_cache)
-                        annotated_screenshot_b64 = base64.b64encode(annotated_screenshot).decode('utf-8')
+                        # Text-only decision unless the page or a recent failure calls for the screenshot
+                        with self.step_timer.phase('view'):
+                            page_text, screenshot_reason = self._decision_view(
+                                prompt_elements, recent_failure=consecutive_failures > 0 or action_retry_count > 0
+                            )
+                        self._screenshot_expected = DECISION_MODE == "vision" or screenshot_reason is not None
+                        annotated_screenshot_b64, image_mime_type = load_screenshot() if screenshot_reason else (None, "image/png")
                         
                         # Get AI decision with advanced analysis
-                        decision = self.decide_next_action(
-                            objective, annotated_screenshot_b64, self.elements_cache, last_action_feedback
-                        )
+                        with self.step_timer.phase('decide'):
+                            decision = self.decide_next_action(
+                                objective, annotated_screenshot_b64, prompt_elements, last_action_feedback,
+                                image_mime_type=image_mime_type, page_text=page_text, screenshot_loader=load_screenshot
+                            )
                         
                         if not decision or not decision.get('action'):
                             print("❌ Failed to get AI decision")
@@ -4059,10 +7781,22 @@ class MegaAdvancedBrowserAgent:
                         print(f"🤔 AI Analysis: {thought}")
                         print(f"🎯 Confidence: {confidence:.2f} | Reasoning: {reasoning[:100]}...")
                         
-                        # Execute advanced action
-                        result = self.execute_advanced_action(decision)
+                        # Execute the action and any planned follow-ups, verifying each step locally
+                        with self.step_timer.phase('act'):
+                            result = self.execute_plan(decision)
                         print(f"📋 Result: {result.message}")
                         
+                        # Remember confident decisions that worked; forget cached ones that did not
+                        plan_held = result.success and result.metadata.get('plan_complete', True)
+                        if plan_held and not self._decision_from_cache:
+                            self.decision_cache.put(self._decision_cache_key, objective, self._decision_cache_url, decision)
+                        elif not plan_held and self._decision_from_cache:
+                            self.decision_cache.invalidate(self._decision_cache_key)
+                        
+                        # Hover, focus and similar effects are invisible to the page-state key
+                        if result.success and result.action_type != "WAIT":
+                            self.page_state.invalidate()
+                        
                         if result.message == "🏁 Task finished.":
                             print(f"\n🎉 Objective completed successfully in {step_counter} steps!")
                             print(f"📊 Success Rate: {self.session_data['successful_actions']}/{self.session_data['total_actions']} ({(self.session_data['successful_actions']/max(1, self.session_data['total_actions'])*100):.1f}%)")
@@ -4072,7 +7806,7 @@ class MegaAdvancedBrowserAgent:
                             action_retry_count += 1
                             if action_retry_count <= max_action_retries:
                                 print(f"🔄 Action failed, retrying... ({action_retry_count}/{max_action_retries})")
-                                time.sleep(random.uniform(1.0, 2.0))  # Brief delay before retry
+                                self.visual_stability.wait()  # Let the page settle before retrying
                                 continue  # Retry the same action
                             else:
                                 consecutive_failures += 1
@@ -4086,8 +7820,10 @@ class MegaAdvancedBrowserAgent:
                         
                         last_action_feedback = result.message
                         
-                        # Human-like delay between actions
-                        time.sleep(random.uniform(1.5, 2.5))
+                        # Wait for the action's effects to settle before the next observation;
+                        # its screenshot is captured and persisted meanwhile
+                        with self.step_timer.phase('settle'):
+                            self.visual_stability.wait()
                         
                     except KeyboardInterrupt:
                         print("\n⏹️ Task interrupted by user.")
@@ -4099,6 +7835,8 @@ class MegaAdvancedBrowserAgent:
                             print(f"💥 Critical errors occurred. Stopping task.")
                             break
                         continue
+                    finally:
+                        self.step_timer.finish_step()
                 
                 else:
                     # Loop ended due to timeout or max steps
@@ -4129,6 +7867,11 @@ class MegaAdvancedBrowserAgent:
             if final_report:
                 print(f"📊 Final report saved: {final_report}")
             
+            self.overlay_updater.close()
+            self.pipeline.shutdown(wait=True)
+            self.artifact_writer.close()
+            self.screencast.stop()
+            self.devtools.close()
             self.driver.quit()
             print("🧹 Browser closed successfully.")
         except Exception as e:
@@ -4144,10 +7887,10 @@ class MegaAdvancedBrowserAgent:
                 "url": self.driver.current_url,
                 "title": self.driver.title,
                 "elements_count": len(self.elements_cache),
-                "visible_elements": sum(1 for e in self.elements_cache if e.is_visible),
-                "form_fields": sum(1 for e in self.elements_cache if e.is_form_field),
-                "clickable_elements": sum(1 for e in self.elements_cache if e.is_clickable),
-                "avg_confidence": sum(e.confidence_score for e in self.elements_cache) / len(self.elements_cache) if self.elements_cache else 0,
+                "visible_elements": int(np.count_nonzero(self.elements_cache.visible)),
+                "form_fields": int(np.count_nonzero(self.elements_cache.form_field)),
+                "clickable_elements": int(np.count_nonzero(self.elements_cache.clickable)),
+                "avg_confidence": float(self.elements_cache.confidence.mean()) if len(self.elements_cache) else 0,
                 "page_load_state": self.driver.execute_script('return document.readyState'),
                 "session_stats": self.session_data
             }
@@ -4174,6 +7917,7 @@ class MegaAdvancedBrowserAgent:
         current_time = datetime.now()
         session_duration = (current_time - self.session_data['start_time']).total_seconds()
         success_rate = (self.session_data['successful_actions'] / max(1, self.session_data['total_actions'])) * 100
+        self._flush_artifacts()
         
         print(f"\n📊 SESSION STATISTICS")
         print("=" * 50)
@@ -4184,7 +7928,9 @@ class MegaAdvancedBrowserAgent:
         print(f"🌐 Websites Visited: {len(self.session_data['websites_visited'])}")
         print(f"📝 Forms Filled: {self.session_data.get('forms_filled', 0)}")
         print(f"🔍 Searches Performed: {self.session_data.get('searches_performed', 0)}")
-        print(f"📸 Screenshots Taken: {len([a for a in self.action_history if a.screenshot_path])}")
+        print(f"📸 Screenshots Taken: {len([a for a in self._action_history_snapshot() if a.screenshot_path])}")
+        print(f"♻️ Decision Cache Hit Rate: {self.decision_cache.hit_rate:.0%} "
+              f"({self.decision_cache.stats['hits']}/{self.decision_cache.stats['hits'] + self.decision_cache.stats['misses']})")
         print(f"⚡ Avg Action Duration: {sum(a.duration for a in self.action_history)/max(1, len(self.action_history)):.2f}s")
         print("=" * 50)
 
@@ -4339,6 +8085,16 @@ class MegaAdvancedBrowserAgent:
 
     def cleanup(self):
         """Clean up resources and close browser."""
+        if hasattr(self, 'overlay_updater'):
+            self.overlay_updater.close()
+        if hasattr(self, 'pipeline'):
+            self.pipeline.shutdown(wait=True)
+        if hasattr(self, 'artifact_writer'):
+            self.artifact_writer.close()
+        if hasattr(self, 'screencast'):
+            self.screencast.stop()
+        if hasattr(self, 'devtools'):
+            self.devtools.close()
         try:
             if hasattr(self, 'driver') and self.driver:
                 self.driver.quit()
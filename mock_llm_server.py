@@ -0,0 +1,378 @@
+"""
+Local OpenAI/Mistral-compatible chat completions server for offline runs of the agent.
+
+Three modes:
+  * default  - answers every request with a fixed decision (--response)
+  * --replay - answers from a fixture file recorded earlier, deterministically
+  * --record - forwards to a real endpoint and appends each request/response pair to a fixture file
+
+Streaming (SSE) and non-streaming responses are supported. Artificial time-to-first-token,
+token rate and jitter make latency benchmarks reproducible.
+
+Point the agent at it with:
+    MISTRAL_ENDPOINT=http://127.0.0.1:8765/v1/chat/completions MISTRAL_API_KEY=mock python agent.py
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import random
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional, Tuple
+
+import requests
+from dotenv import load_dotenv
+
+load_dotenv()
+
+DEFAULT_RESPONSE = {
+    "action": {"name": "WAIT", "parameters": {"seconds": 1}},
+    "confidence": 0.5,
+    "thought": "Mock server decision",
+    "reasoning": "Default response of mock_llm_server.py"
+}
+
+
+def estimate_tokens(text: str) -> int:
+    """Rough token count (~4 characters per token), the same estimate the agent uses."""
+    return max(1, len(text) // 4) if text else 0
+
+
+def prompt_text(payload: Dict) -> str:
+    """Concatenated text of all messages; images are left out so re-captured screenshots still match."""
+    parts = []
+    for message in payload.get("messages", []):
+        content = message.get("content")
+        if isinstance(content, str):
+            parts.append(content)
+        else:
+            parts.extend(part.get("text", "") for part in content or [] if part.get("type") == "text")
+    return "\n".join(parts)
+
+
+def fixture_key(payload: Dict) -> str:
+    return hashlib.sha256(prompt_text(payload).encode("utf-8")).hexdigest()
+
+
+def image_bytes(payload: Dict) -> int:
+    total = 0
+    for message in payload.get("messages", []):
+        content = message.get("content")
+        if isinstance(content, list):
+            for part in content:
+                if part.get("type") == "image_url":
+                    total += len(part["image_url"]["url"].partition(",")[2]) * 3 // 4
+    return total
+
+
+class FixtureStore:
+    """Recorded request/response pairs in a JSONL file.
+
+    Replay is deterministic: a request gets the next unused recording with
+    the same prompt text, otherwise the next unused recording in file order,
+    so a trajectory replays even when page details drift between runs. Each
+    of those fallbacks is counted and warned about; strict stores refuse them.
+    """
+
+    def __init__(self, path: str, strict: bool = False):
+        self.path = path
+        self.strict = strict
+        self.records: List[Dict] = []
+        self.fallbacks = 0
+        self._used = set()
+        self._lock = threading.Lock()
+        if os.path.exists(path):
+            with open(path, encoding="utf-8") as f:
+                self.records = [json.loads(line) for line in f if line.strip()]
+
+    def next_response(self, payload: Dict) -> Optional[Dict]:
+        key = fixture_key(payload)
+        with self._lock:
+            unused = [i for i in range(len(self.records)) if i not in self._used]
+            matching = [i for i in unused if self.records[i]["key"] == key]
+            if not matching and (self.strict or not unused):
+                return None
+            if matching:
+                index = matching[0]
+            else:
+                index = unused[0]
+                self.fallbacks += 1
+                print(f"⚠️ No recording matches this prompt, replaying recording {index + 1} in file order")
+            self._used.add(index)
+            return self.records[index]
+
+    def append(self, payload: Dict, text: str, usage: Dict, ttft: float, duration: float):
+        record = {
+            "key": fixture_key(payload),
+            "model": payload.get("model"),
+            "stream": bool(payload.get("stream")),
+            "prompt": prompt_text(payload),
+            "image_bytes": image_bytes(payload),
+            "response": text,
+            "usage": usage,
+            "ttft": round(ttft, 3),
+            "duration": round(duration, 3),
+            "recorded_at": time.time()
+        }
+        with self._lock:
+            self.records.append(record)
+            self._used.add(len(self.records) - 1)
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+
+class MockLLMHandler(BaseHTTPRequestHandler):
+    """POST /v1/chat/completions in the OpenAI/Mistral wire format."""
+
+    protocol_version = "HTTP/1.1"
+    server: "MockLLMServer"
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+    def do_GET(self):
+        if self.path.rstrip("/") in ("", "/health"):
+            health = {"status": "ok", "mode": self.server.mode, "requests": self.server.request_count}
+            if self.server.mode == "replay":
+                health["fallbacks"] = self.server.fixtures.fallbacks
+            self._send_json(200, health)
+        else:
+            self._send_json(404, {"error": {"message": f"Unknown path {self.path}"}})
+
+    def do_POST(self):
+        if not self.path.rstrip("/").endswith("/chat/completions"):
+            self._send_json(404, {"error": {"message": f"Unknown path {self.path}"}})
+            return
+        try:
+            payload = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+        except (ValueError, json.JSONDecodeError) as e:
+            self._send_json(400, {"error": {"message": f"Invalid JSON body: {e}"}})
+            return
+        self.server.request_count += 1
+
+        if self.server.mode == "record":
+            self._proxy(payload)
+            return
+
+        text, usage, ttft = self.server.default_text, None, self.server.ttft
+        if self.server.fixtures is not None:
+            record = self.server.fixtures.next_response(payload)
+            if record is None:
+                reason = "matches this prompt" if self.server.fixtures.strict else "left in the fixture file"
+                self._send_json(500, {"error": {"message": f"No recorded response {reason}"}})
+                return
+            text, usage = record["response"], record.get("usage")
+            if self.server.recorded_latency:
+                ttft = record.get("ttft", ttft)
+        usage = usage or {
+            "prompt_tokens": estimate_tokens(prompt_text(payload)),
+            "completion_tokens": estimate_tokens(text),
+            "total_tokens": estimate_tokens(prompt_text(payload)) + estimate_tokens(text)
+        }
+
+        time.sleep(max(0.0, ttft + random.uniform(-self.server.jitter, self.server.jitter)))
+        if payload.get("stream"):
+            self._stream(payload, text, usage)
+        else:
+            self._send_json(200, {
+                "id": f"mock-{uuid.uuid4().hex[:12]}",
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": payload.get("model", "mock"),
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": text}, "finish_reason": "stop"}],
+                "usage": usage
+            })
+
+    def _stream(self, payload: Dict, text: str, usage: Dict):
+        """Emit the text as chat.completion.chunk events at the configured token rate."""
+        completion_id = f"mock-{uuid.uuid4().hex[:12]}"
+
+        def chunk(delta: Dict, finish_reason: str = None, **extra) -> Dict:
+            return {"id": completion_id, "object": "chat.completion.chunk", "created": int(time.time()),
+                    "model": payload.get("model", "mock"),
+                    "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}], **extra}
+
+        self._start_event_stream()
+        interval = 1.0 / self.server.tokens_per_second if self.server.tokens_per_second > 0 else 0.0
+        self._write_event(chunk({"role": "assistant", "content": ""}))
+        for index in range(0, len(text), 4 * self.server.tokens_per_chunk):
+            self._write_event(chunk({"content": text[index:index + 4 * self.server.tokens_per_chunk]}))
+            time.sleep(interval * self.server.tokens_per_chunk)
+        # Mistral always reports usage on the last chunk; OpenAI only with stream_options.include_usage
+        self._write_event(chunk({}, "stop", usage=usage))
+        self._write_chunk(b"data: [DONE]\n\n")
+        self._write_chunk(b"")
+
+    def _proxy(self, payload: Dict):
+        """Forward to the upstream endpoint, relay the response and record it."""
+        headers = {"Content-Type": "application/json",
+                   "Authorization": self.server.upstream_authorization or self.headers.get("Authorization", "")}
+        started = time.time()
+        try:
+            upstream = requests.post(self.server.upstream, headers=headers, json=payload,
+                                     stream=bool(payload.get("stream")), timeout=(10, 120))
+        except requests.RequestException as e:
+            self._send_json(502, {"error": {"message": f"Upstream request failed: {e}"}})
+            return
+        if upstream.status_code != 200:
+            try:
+                error = upstream.json()
+            except ValueError:
+                error = {"error": {"message": upstream.text}}
+            self._send_json(upstream.status_code, error)
+            return
+
+        # The record is written before the response completes, so a client that has its
+        # answer can rely on the fixture containing it
+        if not payload.get("stream"):
+            data = upstream.json()
+            ttft = duration = time.time() - started
+            self._record(payload, data["choices"][0]["message"]["content"], data.get("usage") or {}, ttft, duration)
+            self._send_json(200, data)
+        else:
+            self._start_event_stream()
+            text_parts, usage, ttft = [], {}, None
+            for line in upstream.iter_lines(decode_unicode=True):
+                self._write_chunk(f"{line}\n".encode("utf-8"))
+                if not line or not line.startswith("data:") or line[5:].strip() == "[DONE]":
+                    continue
+                event = json.loads(line[5:])
+                delta = ((event.get("choices") or [{}])[0].get("delta") or {}).get("content")
+                if delta:
+                    ttft = ttft if ttft is not None else time.time() - started
+                    text_parts.append(delta)
+                usage = event.get("usage") or usage
+            duration = time.time() - started
+            self._record(payload, "".join(text_parts), usage, ttft or duration, duration)
+            self._write_chunk(b"")
+
+    def _record(self, payload: Dict, text: str, usage: Dict, ttft: float, duration: float):
+        self.server.fixtures.append(payload, text, usage, ttft, duration)
+        print(f"📼 Recorded response {len(self.server.fixtures.records)} ({ttft:.2f}s to first token, "
+              f"{duration:.2f}s total)")
+
+    def _send_json(self, status: int, data: Dict):
+        body = json.dumps(data).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _start_event_stream(self):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Cache-Control", "no-cache")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+
+    def _write_event(self, event: Dict):
+        self._write_chunk(f"data: {json.dumps(event)}\n\n".encode("utf-8"))
+
+    def _write_chunk(self, data: bytes):
+        """One HTTP chunk; an empty one ends the response."""
+        self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+        self.wfile.flush()
+
+
+class MockLLMServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address: Tuple[str, int], response: Dict = None, ttft: float = 0.3,
+                 tokens_per_second: float = 60.0, tokens_per_chunk: int = 1, jitter: float = 0.0,
+                 replay: str = None, record: str = None, upstream: str = None, upstream_key: str = None,
+                 recorded_latency: bool = False, strict: bool = False, verbose: bool = False):
+        super().__init__(address, MockLLMHandler)
+        self.default_text = json.dumps(response or DEFAULT_RESPONSE)
+        self.ttft = ttft
+        self.tokens_per_second = tokens_per_second
+        self.tokens_per_chunk = max(1, tokens_per_chunk)
+        self.jitter = jitter
+        self.recorded_latency = recorded_latency
+        self.verbose = verbose
+        self.upstream = upstream
+        self.upstream_authorization = f"Bearer {upstream_key}" if upstream_key else None
+        self.request_count = 0
+        if record:
+            if not upstream:
+                raise ValueError("Recording needs an upstream endpoint")
+            self.mode, self.fixtures = "record", FixtureStore(record)
+        elif replay:
+            if not os.path.exists(replay):
+                raise FileNotFoundError(f"Fixture file not found: {replay}")
+            self.mode, self.fixtures = "replay", FixtureStore(replay, strict=strict)
+        else:
+            self.mode, self.fixtures = "default", None
+
+    @property
+    def endpoint(self) -> str:
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}/v1/chat/completions"
+
+    def start(self) -> threading.Thread:
+        """Serve on a background thread (for tests and benchmarks)."""
+        thread = threading.Thread(target=self.serve_forever, name="mock-llm-server", daemon=True)
+        thread.start()
+        return thread
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local OpenAI/Mistral-compatible mock LLM server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=int(os.getenv("MOCK_LLM_PORT", "8765")))
+    parser.add_argument("--ttft", type=float, default=0.3, help="Seconds before the first token")
+    parser.add_argument("--tokens-per-second", type=float, default=60.0, help="Streaming rate (0 = as fast as possible)")
+    parser.add_argument("--tokens-per-chunk", type=int, default=1, help="Tokens per streamed chunk")
+    parser.add_argument("--jitter", type=float, default=0.0, help="Random +/- seconds added to the first-token delay")
+    parser.add_argument("--seed", type=int, default=None, help="Seed for the jitter")
+    parser.add_argument("--response", default=None, help="Default decision as JSON, or @file.json")
+    parser.add_argument("--replay", metavar="FIXTURE", help="Answer from a recorded fixture file")
+    parser.add_argument("--recorded-latency", action="store_true",
+                        help="When replaying, wait each recording's own time to first token")
+    parser.add_argument("--strict", action="store_true",
+                        help="When replaying, answer only with recordings of the same prompt instead of falling "
+                             "back to file order")
+    parser.add_argument("--record", metavar="FIXTURE", help="Proxy to --upstream and append pairs to this file")
+    parser.add_argument("--upstream", default=os.getenv("MISTRAL_UPSTREAM", "https://api.mistral.ai/v1/chat/completions"),
+                        help="Real endpoint used when recording")
+    parser.add_argument("--upstream-key", default=os.getenv("MISTRAL_API_KEY"),
+                        help="API key for the upstream (defaults to MISTRAL_API_KEY, else the client's header)")
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args()
+
+    response = None
+    if args.response:
+        if args.response.startswith("@"):
+            with open(args.response[1:], encoding="utf-8") as f:
+                response = json.load(f)
+        else:
+            response = json.loads(args.response)
+    if args.seed is not None:
+        random.seed(args.seed)
+
+    server = MockLLMServer(
+        (args.host, args.port), response=response, ttft=args.ttft, tokens_per_second=args.tokens_per_second,
+        tokens_per_chunk=args.tokens_per_chunk, jitter=args.jitter, replay=args.replay, record=args.record,
+        upstream=args.upstream, upstream_key=args.upstream_key, recorded_latency=args.recorded_latency,
+        strict=args.strict, verbose=args.verbose
+    )
+    print(f"🧪 Mock LLM server ({server.mode}) listening on {server.endpoint}")
+    if server.mode == "record":
+        print(f"📼 Recording {args.upstream} into {args.record}")
+    elif server.mode == "replay":
+        print(f"▶️ Replaying {len(server.fixtures.records)} recorded responses from {args.replay}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print("\n⏹️ Mock LLM server stopped.")
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,25 @@
+import os
+import subprocess
+import sys
+import warnings
+from pathlib import Path
+
+import pytest
+
+
+@pytest.mark.parametrize("module", ["agent.py", "mock_llm_server.py"])
+def test_compiles_with_warnings_as_errors(module):
+    """Invalid escapes in embedded JavaScript warn on import and fail to compile under -W error."""
+    source = (Path(__file__).parent / module).read_text(encoding="utf-8")
+    with warnings.catch_warnings():
+        warnings.simplefilter("error")
+        compile(source, module, "exec")
+
+
+@pytest.mark.parametrize("plan_max_steps, follow_ups", [("4", "3"), ("6", "5")])
+def test_system_prompt_states_the_configured_plan_length(plan_max_steps, follow_ups):
+    """PLAN_MAX_STEPS is read at import, so the prompt is checked in a fresh interpreter."""
+    script = "from agent import PromptBudgetManager; print(PromptBudgetManager.SYSTEM_PROMPT)"
+    prompt = subprocess.run([sys.executable, "-c", script], capture_output=True, text=True, check=True,
+                            cwd=Path(__file__).parent, env={**os.environ, "PLAN_MAX_STEPS": plan_max_steps}).stdout
+    assert f'"then" lists up to {follow_ups} follow-up actions' in prompt
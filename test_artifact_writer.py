@@ -0,0 +1,32 @@
+import threading
+
+from agent import ArtifactWriter
+
+
+def test_counters_add_up_across_submitting_threads():
+    """Jobs submitted from several threads, with a full queue blocking some of them, are all counted."""
+    writer = ArtifactWriter(max_pending=4)
+    done = []
+
+    def job(value):
+        if value % 7 == 0:
+            raise ValueError(value)
+        done.append(value)
+
+    def submit_many(offset):
+        for value in range(offset, offset + 500):
+            writer.submit(job, value)
+
+    threads = [threading.Thread(target=submit_many, args=(offset,)) for offset in range(0, 2000, 500)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    writer.flush()
+    stats = writer.stats
+    writer.close()
+
+    failed = len([value for value in range(2000) if value % 7 == 0])
+    assert stats['submitted'] == 2000
+    assert stats['completed'] == len(done) == 2000 - failed and stats['failed'] == failed
+    assert stats['blocked_seconds'] >= 0
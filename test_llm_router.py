@@ -0,0 +1,221 @@
+import json
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+import pytest
+
+from agent import (AI_CONFIGS, AdvancedDatabase, AnthropicMessagesAdapter, GeminiAdapter, LLMClient, LLMRequest, LLMRouter,
+                   OpenAIChatAdapter)
+from mock_llm_server import DEFAULT_RESPONSE, MockLLMServer
+
+DECISION_TEXT = json.dumps(DEFAULT_RESPONSE)
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    """Anthropic Messages and Gemini streamGenerateContent responses, or a 500 when failing."""
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        self.server.requests.append(self.path)
+        if self.server.api == "fail":
+            self.send_response(500)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        if self.server.api == "anthropic":
+            events = [{"type": "message_start", "message": {"usage": {"input_tokens": 120, "cache_read_input_tokens": 80}}}]
+            events += [{"type": "content_block_delta", "delta": {"type": "text_delta", "text": DECISION_TEXT[i:i + 10]}}
+                       for i in range(0, len(DECISION_TEXT), 10)]
+            events.append({"type": "message_delta", "usage": {"output_tokens": 42}})
+            lines = [f"event: {event['type']}\ndata: {json.dumps(event)}\n\n" for event in events]
+        else:
+            events = [{"candidates": [{"content": {"parts": [{"text": DECISION_TEXT[i:i + 10]}]}}]}
+                      for i in range(0, len(DECISION_TEXT), 10)]
+            events[-1]["usageMetadata"] = {"promptTokenCount": 150, "cachedContentTokenCount": 0,
+                                           "candidatesTokenCount": 40}
+            lines = [f"data: {json.dumps(event)}\n\n" for event in events]
+        body = "".join(lines).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+@contextmanager
+def serving(server):
+    server.daemon_threads = True
+    if isinstance(server, MockLLMServer):
+        server.start()
+    else:
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        yield server
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def stub(api):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubHandler)
+    server.api, server.requests = api, []
+    return server
+
+
+def endpoint(server, path="/v1/chat/completions"):
+    host, port = server.server_address[:2]
+    return f"http://{host}:{port}{path}"
+
+
+def request(image=None):
+    return LLMRequest(system_prompt="system", user_text="objective", image_b64=image,
+                      image_mime_type="image/webp", max_tokens=200, temperature=0.2, json_mode=True)
+
+
+@pytest.fixture
+def configure(monkeypatch):
+    """Point a provider at a URL with a key, restored after the test."""
+    def apply(provider, url):
+        monkeypatch.setitem(AI_CONFIGS[provider], "endpoint", url)
+        monkeypatch.setitem(AI_CONFIGS[provider], "api_key", "test-key")
+    for provider in AI_CONFIGS:
+        monkeypatch.setitem(AI_CONFIGS[provider], "api_key", "")
+    return apply
+
+
+def test_adapter_payloads():
+    openai = OpenAIChatAdapter("openai", dict(AI_CONFIGS["openai"], api_key="k"))
+    url, headers, payload = openai.build(request(image="QUJD"), stream=True)
+    assert url == AI_CONFIGS["openai"]["endpoint"] and headers["Authorization"] == "Bearer k"
+    assert payload["messages"][0] == {"role": "system", "content": "system"}
+    assert payload["messages"][1]["content"][1]["image_url"]["url"] == "data:image/webp;base64,QUJD"
+    assert payload["response_format"] == {"type": "json_object"}
+    assert payload["stream_options"] == {"include_usage": True}
+
+    anthropic = AnthropicMessagesAdapter("anthropic", dict(AI_CONFIGS["anthropic"], api_key="k"))
+    _, headers, payload = anthropic.build(request(image="QUJD"), stream=False)
+    assert headers["x-api-key"] == "k" and headers["anthropic-version"] == AnthropicMessagesAdapter.API_VERSION
+    assert payload["system"][0]["cache_control"] == {"type": "ephemeral"}
+    assert payload["messages"][0]["content"][0]["source"]["data"] == "QUJD"
+
+    gemini = GeminiAdapter("gemini", dict(AI_CONFIGS["gemini"], api_key="k"))
+    url, headers, payload = gemini.build(request(), stream=True)
+    assert url.endswith(":streamGenerateContent?alt=sse") and headers["x-goog-api-key"] == "k"
+    assert payload["generationConfig"]["responseMimeType"] == "application/json"
+    assert gemini.build(request(), stream=False)[0] == AI_CONFIGS["gemini"]["endpoint"]
+
+
+@pytest.mark.parametrize("provider, usage", [
+    ("mistral", None),
+    ("anthropic", {"input_tokens": 200, "cached_tokens": 80, "output_tokens": 42}),
+    ("gemini", {"input_tokens": 150, "cached_tokens": 0, "output_tokens": 40}),
+])
+def test_stream_and_usage_per_adapter(configure, provider, usage):
+    if provider == "mistral":
+        server = MockLLMServer(("127.0.0.1", 0), ttft=0, tokens_per_second=0)
+        url = None
+    else:
+        server = stub(provider)
+        url = "/v1/messages" if provider == "anthropic" else "/v1beta/models/m:generateContent"
+    with serving(server):
+        configure(provider, server.endpoint if url is None else endpoint(server, url))
+        router = LLMRouter([provider], client=LLMClient(), hedge_deadline=0)
+        chunks = list(router.stream(request()))
+        assert len(chunks) > 1 and "".join(chunks) == DECISION_TEXT
+        assert router.last_provider == provider
+        assert router.last_call.success and router.last_call.chunks == len(chunks)
+        if usage is None:
+            assert router.last_usage["output_tokens"] > 0
+        else:
+            assert router.last_usage == usage
+        if provider == "gemini":
+            assert server.requests[-1].endswith(":streamGenerateContent?alt=sse")
+
+
+def test_failover_before_first_token(configure):
+    with serving(stub("fail")) as failing, serving(MockLLMServer(("127.0.0.1", 0), ttft=0)) as backup:
+        configure("openai", endpoint(failing))
+        configure("mistral", backup.endpoint)
+        router = LLMRouter(["openai", "mistral"], client=LLMClient(), hedge_deadline=0)
+        assert "".join(router.stream(request())) == DECISION_TEXT
+        assert router.last_provider == "mistral"
+        assert router.stats["failovers"] == 1 and router.stats["hedged"] == 0
+        assert router.last_call.failover and router.last_call.attempts == 2
+        assert router.complete(request()) == DECISION_TEXT
+        assert router.last_call.failover and not router.last_call.streamed
+
+
+def test_all_providers_failing_raises(configure):
+    with serving(stub("fail")) as failing:
+        configure("openai", endpoint(failing))
+        router = LLMRouter(["openai"], client=LLMClient(), hedge_deadline=0)
+        with pytest.raises(Exception):
+            list(router.stream(request()))
+        assert not router.last_call.success and isinstance(router.last_call.error, str)
+
+
+def test_hedge_starts_backup_after_deadline(configure):
+    slow = MockLLMServer(("127.0.0.1", 0), ttft=1.5, tokens_per_second=0)
+    fast = MockLLMServer(("127.0.0.1", 0), ttft=0.05, tokens_per_second=0)
+    with serving(slow), serving(fast):
+        configure("openai", slow.endpoint)
+        configure("mistral", fast.endpoint)
+        router = LLMRouter(["openai", "mistral"], client=LLMClient(), hedge_deadline=0.2)
+        started = time.time()
+        assert "".join(router.stream(request())) == DECISION_TEXT
+        assert time.time() - started < 1.0
+        assert router.stats["hedged"] == 1 and router.stats["hedge_wins"] == 1
+        assert router.last_provider == "mistral" and router.last_call.hedged
+
+
+def test_ttft_percentiles_ranking_and_auto_hedge(configure):
+    configure("openai", "http://127.0.0.1:9/unused")
+    configure("mistral", "http://127.0.0.1:9/unused")
+    router = LLMRouter(["openai", "mistral"], client=LLMClient(), hedge_deadline=None)
+    primary = router.adapters[0]
+    assert router.percentile("openai", 50) is None
+    assert router._hedge_after(primary) is None  # "auto" waits for MIN_SAMPLES
+
+    openai_samples = [0.9, 1.1, 1.0, 1.4, 2.5]
+    mistral_samples = [0.2, 0.3, 0.25, 0.4]
+    for seconds in openai_samples:
+        router._record_ttft("openai", seconds)
+    for seconds in mistral_samples:
+        router._record_ttft("mistral", seconds)
+    assert router.percentile("openai", 50) == pytest.approx(np.percentile(openai_samples, 50))
+    assert router._hedge_after(primary) == pytest.approx(np.percentile(openai_samples, 95))
+    summary = router.latency_summary()
+    assert summary["openai"]["samples"] == 5 and summary["mistral"]["samples"] == 4
+    assert summary["mistral"]["p95"] == pytest.approx(np.percentile(mistral_samples, 95))
+
+    # Unmeasured providers keep their configured order behind measured ones
+    assert [adapter.name for adapter in router.ranked()] == ["openai", "mistral"]
+    router._record_ttft("mistral", 0.3)
+    assert [adapter.name for adapter in router.ranked()] == ["mistral", "openai"]
+
+    for _ in range(LLMRouter.WINDOW):
+        router._record_ttft("openai", 0.1)
+    assert router.latency_summary()["openai"]["samples"] == LLMRouter.WINDOW
+    assert router.percentile("openai", 95) == pytest.approx(0.1)
+
+
+def test_early_close_after_failover_logs_a_string_error(configure, tmp_path):
+    """Closing the stream mid-way still yields a call record that SQLite can store."""
+    with serving(stub("fail")) as failing, serving(MockLLMServer(("127.0.0.1", 0), ttft=0)) as backup:
+        configure("openai", endpoint(failing))
+        configure("mistral", backup.endpoint)
+        router = LLMRouter(["openai", "mistral"], client=LLMClient(), hedge_deadline=0)
+        stream = router.stream(request())
+        next(stream)
+        stream.close()
+        call = router.last_call
+        assert not call.success and isinstance(call.error, str) and call.failover
+        AdvancedDatabase(str(tmp_path / "agent.db")).log_llm_call(call)
@@ -0,0 +1,194 @@
+import json
+import os
+import tempfile
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+
+import pytest
+import requests
+
+from agent import (AI_CONFIGS, AdvancedDatabase, DecisionCache, ElementTable, LLMClient, LLMRouter,
+                   MegaAdvancedBrowserAgent, PromptBudgetManager)
+from mock_llm_server import DEFAULT_RESPONSE, MockLLMServer
+
+
+def chat(endpoint, text, stream=False):
+    payload = {
+        "model": "mistral-large-latest",
+        "messages": [{"role": "user", "content": [{"type": "text", "text": text}]}],
+        "stream": stream
+    }
+    response = requests.post(endpoint, json=payload, stream=stream, timeout=10)
+    response.raise_for_status()
+    if not stream:
+        return response.json()["choices"][0]["message"]["content"]
+    parts = []
+    for line in response.iter_lines(decode_unicode=True):
+        if line.startswith("data:") and line[5:].strip() != "[DONE]":
+            event = json.loads(line[5:])
+            parts.append(event["choices"][0]["delta"].get("content") or "")
+    return "".join(parts)
+
+
+def test_mock_llm_server():
+    """Default, record and replay modes answer identically streamed and non-streamed."""
+    upstream = MockLLMServer(("127.0.0.1", 0), ttft=0, tokens_per_second=0)
+    upstream.start()
+    fixture = os.path.join(tempfile.mkdtemp(), "fixture.jsonl")
+    recorder = MockLLMServer(("127.0.0.1", 0), record=fixture, upstream=upstream.endpoint)
+    recorder.start()
+    try:
+        decision = json.loads(chat(upstream.endpoint, "hello"))
+        assert decision["action"]["name"] == "WAIT"
+        assert chat(upstream.endpoint, "hello", stream=True) == json.dumps(decision)
+
+        assert chat(recorder.endpoint, "first", stream=True) == json.dumps(decision)
+        assert chat(recorder.endpoint, "second") == json.dumps(decision)
+
+        replay = MockLLMServer(("127.0.0.1", 0), replay=fixture, ttft=0, tokens_per_second=0)
+        replay.start()
+        try:
+            assert [record["prompt"] for record in replay.fixtures.records] == ["first", "second"]
+            # Matching prompts are answered first, the rest in recorded order
+            assert chat(replay.endpoint, "second", stream=True) == json.dumps(decision)
+            assert chat(replay.endpoint, "anything") == json.dumps(decision)
+            assert replay.fixtures.next_response({"messages": []}) is None
+            assert replay.fixtures.fallbacks == 1
+            assert requests.get(replay.endpoint.replace("/v1/chat/completions", "/health"), timeout=10).json() == {
+                "status": "ok", "mode": "replay", "requests": 2, "fallbacks": 1}
+        finally:
+            replay.shutdown()
+            replay.server_close()
+    finally:
+        recorder.shutdown()
+        recorder.server_close()
+        upstream.shutdown()
+        upstream.server_close()
+
+
+class PlainTextError(BaseHTTPRequestHandler):
+    """An upstream that fails with an HTML error page instead of a JSON body."""
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        self.send_error(503, "Service Unavailable")
+
+
+def test_strict_replay_and_non_json_upstream_error():
+    """Strict replay refuses unmatched prompts; a non-JSON upstream error is relayed as a JSON error."""
+    fixture = os.path.join(tempfile.mkdtemp(), "fixture.jsonl")
+    with open(fixture, "w", encoding="utf-8") as f:
+        f.write(json.dumps({"key": "0" * 64, "prompt": "other", "response": "{}"}) + "\n")
+    replay = MockLLMServer(("127.0.0.1", 0), replay=fixture, strict=True, ttft=0)
+    replay.start()
+    upstream = ThreadingHTTPServer(("127.0.0.1", 0), PlainTextError)
+    threading.Thread(target=upstream.serve_forever, daemon=True).start()
+    host, port = upstream.server_address[:2]
+    recorder = MockLLMServer(("127.0.0.1", 0), record=os.path.join(tempfile.mkdtemp(), "out.jsonl"),
+                             upstream=f"http://{host}:{port}/v1/chat/completions")
+    recorder.start()
+    try:
+        response = requests.post(replay.endpoint, json={"messages": [{"role": "user", "content": "hello"}]}, timeout=10)
+        assert response.status_code == 500 and "matches this prompt" in response.json()["error"]["message"]
+        assert replay.fixtures.fallbacks == 0
+
+        response = requests.post(recorder.endpoint, json={"messages": []}, timeout=10)
+        assert response.status_code == 503 and "Service Unavailable" in response.json()["error"]["message"]
+        assert recorder.fixtures.records == []
+    finally:
+        for server in (recorder, upstream, replay):
+            server.shutdown()
+            server.server_close()
+
+
+class OfflineBrowser:
+    """Stands in for the WebDriver and the overlay, so a decision can be made without Chrome."""
+
+    current_url = "https://example.com/search"
+
+    def update(self, *args):
+        pass
+
+
+def offline_agent(monkeypatch, tmp_path, endpoint):
+    """A MegaAdvancedBrowserAgent with only what decide_next_action needs, deciding through `endpoint`."""
+    for provider in AI_CONFIGS:
+        monkeypatch.setitem(AI_CONFIGS[provider], "api_key", "")
+    monkeypatch.setitem(AI_CONFIGS["mistral"], "endpoint", endpoint)
+    monkeypatch.setitem(AI_CONFIGS["mistral"], "api_key", "mock")
+
+    agent = MegaAdvancedBrowserAgent.__new__(MegaAdvancedBrowserAgent)
+    agent.driver = agent.overlay_updater = OfflineBrowser()
+    agent.decision_cache = DecisionCache(AdvancedDatabase(str(tmp_path / "agent.db")), enabled=False)
+    agent.prompt_budget = PromptBudgetManager()
+    agent.llm_router = LLMRouter(["mistral"], client=LLMClient(), hedge_deadline=0)
+    agent.decision_mode_stats = {'text': 0, 'vision': 0, 'requested': 0}
+    agent.prompt_token_stats = {'requests': 0, 'dynamic_tokens': 0, 'input_tokens': 0, 'cached_tokens': 0,
+                                'output_tokens': 0}
+    agent._prepared_action = None
+    return agent
+
+
+def decide(agent):
+    return agent.decide_next_action("Find the docs", None, ElementTable.empty(), "", page_text="Docs")
+
+
+def broken_stream(request):
+    raise ConnectionError("stream dropped")
+    yield
+
+
+def test_agent_decides_against_mock_server(monkeypatch, tmp_path):
+    """decide_next_action parses the mock's decision, streamed and through the non-streaming fallback."""
+    server = MockLLMServer(("127.0.0.1", 0), ttft=0, tokens_per_second=0)
+    server.start()
+    try:
+        agent = offline_agent(monkeypatch, tmp_path, server.endpoint)
+        assert decide(agent) == DEFAULT_RESPONSE
+        assert agent.llm_router.last_call.streamed and agent.llm_router.last_call.chunks > 1
+
+        monkeypatch.setattr(agent.llm_router, "stream", broken_stream)
+        assert decide(agent) == DEFAULT_RESPONSE
+        assert not agent.llm_router.last_call.streamed and agent.llm_router.last_provider == "mistral"
+        assert server.request_count == 2 and agent.prompt_token_stats['requests'] == 2
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_decision_errors_are_reported(monkeypatch, tmp_path, caplog):
+    """A request that was never built is not retried; a failing fallback is logged, not swallowed."""
+    agent = offline_agent(monkeypatch, tmp_path, "http://127.0.0.1:9/v1/chat/completions")
+
+    def broken_build(*args, **kwargs):
+        raise ValueError("budget exceeded")
+    monkeypatch.setattr(agent.prompt_budget, "build", broken_build)
+    assert decide(agent) == {"thought": "Error: budget exceeded", "action": None}
+    assert "fallback" not in caplog.text
+
+    monkeypatch.undo()
+    agent = offline_agent(monkeypatch, tmp_path, "http://127.0.0.1:9/v1/chat/completions")
+    monkeypatch.setattr(agent.llm_router, "stream", broken_stream)
+
+    def broken_complete(request, **kwargs):
+        raise ConnectionError("provider down")
+    monkeypatch.setattr(agent.llm_router, "complete", broken_complete)
+    assert decide(agent) == {"thought": "Error: stream dropped", "action": None}
+    assert "Non-streaming fallback failed: provider down" in caplog.text
+
+
+def test_prepared_action_leaves_iframes_alone(monkeypatch, tmp_path):
+    """An element re-resolved into an iframe while streaming is not prepared, and the driver switches back."""
+    agent = offline_agent(monkeypatch, tmp_path, "http://127.0.0.1:9/v1/chat/completions")
+    element_info = SimpleNamespace(frame_path="")
+    agent.elements_cache = SimpleNamespace(find=lambda element_id: element_info)
+    switched_back = []
+    monkeypatch.setattr(agent, "_resolve_element_handle", lambda info: (object(), True))
+    monkeypatch.setattr(agent, "_switch_back_from_iframe", lambda: switched_back.append(True))
+    monkeypatch.setattr(agent, "move_cursor_like_human", lambda element: pytest.fail("cursor moved into an iframe"))
+
+    agent._prepare_action({"name": "CLICK", "parameters": {"id": 7}})
+    assert switched_back == [True] and agent._prepared_action is None
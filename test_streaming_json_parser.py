@@ -0,0 +1,60 @@
+import json
+
+from agent import StreamingJSONParser
+
+DECISION = {
+    "action": {"name": "TYPE", "parameters": {"id": 3, "text": "say \"hi\" {now} [ok] \\ done"}},
+    "then": [{"name": "PRESS_KEY", "parameters": {"key": "Enter"}}],
+    "confidence": 0.85,
+    "thought": "Search box is focused, braces } and quotes \" are just text",
+    "reasoning": "Typing the query, then submitting"
+}
+
+
+def feed_in_chunks(text, size):
+    parser = StreamingJSONParser()
+    completed = []
+    for i in range(0, len(text), size):
+        completed.append(parser.feed(text[i:i + size]))
+    return parser, completed
+
+
+def test_partial_chunks_of_any_size():
+    """Every chunking of the stream, down to single characters, yields the same object."""
+    text = json.dumps(DECISION)
+    for size in (1, 2, 3, 7, 16, len(text)):
+        parser, completed = feed_in_chunks(text, size)
+        assert parser.complete
+        assert parser.result() == DECISION
+        assert [key for keys in completed for key in keys] == list(DECISION)
+
+
+def test_escaped_quotes_and_braces_inside_strings():
+    text = json.dumps({"action": {"name": "EXECUTE_JS", "parameters": {"script": "if (a) { b(\"}\"); } // \\\" ]"}},
+                       "thought": "{[\"\\"})
+    parser, _ = feed_in_chunks(text, 1)
+    assert parser.values["action"]["parameters"]["script"] == "if (a) { b(\"}\"); } // \\\" ]"
+    assert parser.values["thought"] == "{[\"\\"
+    assert parser.complete
+
+
+def test_action_completes_before_trailing_text_streams():
+    """The action is available as soon as its object closes, while thought/reasoning are still arriving."""
+    text = json.dumps(DECISION)
+    action_end = text.index('"then"')
+    parser = StreamingJSONParser()
+    assert parser.feed(text[:action_end - 3]) == []
+    assert "action" not in parser.values
+    assert parser.feed(text[action_end - 3:action_end]) == ["action"]
+    assert parser.values["action"] == DECISION["action"]
+    assert not parser.complete
+    assert "thought" not in parser.values
+
+
+def test_text_around_the_object_and_scalars():
+    parser = StreamingJSONParser()
+    parser.feed('```json\n{"confidence": 0.')
+    assert "confidence" not in parser.values
+    assert parser.feed('9, "done": true, "note": null}') == ["confidence", "done", "note"]
+    parser.feed('\n```')
+    assert parser.result() == {"confidence": 0.9, "done": True, "note": None}